@@ -0,0 +1,645 @@
+import collections
+import decimal
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import database
+
+# PostgreSQL numeric division: NUMERIC_MIN_SIG_DIGITS, DEC_DIGITS (digits per base-10000 digit) and
+# NUMERIC_MAX_DISPLAY_SCALE, see select_div_scale() in src/backend/utils/adt/numeric.c
+NUMERIC_MIN_SIG_DIGITS: int = 16
+DEC_DIGITS: int = 4
+NUMERIC_MAX_DISPLAY_SCALE: int = 1000
+# sequences per block of pairwise_histogram(), a block pair takes BLOCK_SIZE x BLOCK_SIZE x 4 bytes
+# plus BLOCK_SIZE x L x (number of distinct values) x 4 bytes per block
+BLOCK_SIZE: int = 1024
+# arrays of SequenceMatrix that MatrixCache keeps in <name>.npy files, the rest is in META_FILE
+MATRIX_ARRAYS: List[str] = ['matrix', 'sequence_ids', 'sequence_types', 'person_ids', 'person_rows', 'person_regions']
+META_FILE: str = 'meta.json'
+
+
+def numeric_div(dividend: int, divisor: int) -> Decimal:
+    """
+    numeric_div(1, 3) -> Decimal('0.33333333333333333333')
+    Divides non-negative integers with the result scale and rounding of PostgreSQL `numeric / numeric`,
+    so frequency / SUM(frequency) is equal to (and prints like) the `p` column of the SQL queries.
+    """
+    def weight(value: int) -> Tuple[int, int]:
+        # weight and the first digit of the value in the base-10000 representation of numeric
+        if value == 0:
+            return 0, 0
+        weight_: int = (len(str(value)) - 1) // DEC_DIGITS
+        return weight_, value // 10000 ** weight_
+
+    weight_1, first_digit_1 = weight(dividend)
+    weight_2, first_digit_2 = weight(divisor)
+    quotient_weight: int = weight_1 - weight_2 - (1 if first_digit_1 <= first_digit_2 else 0)
+    scale: int = min(max(NUMERIC_MIN_SIG_DIGITS - quotient_weight * DEC_DIGITS, 0), NUMERIC_MAX_DISPLAY_SCALE)
+
+    quotient, remainder = divmod(dividend * 10 ** scale, divisor)
+    if 2 * remainder >= divisor:  # round half away from zero
+        quotient += 1
+
+    return Decimal(f'{quotient}E-{scale}')
+
+
+def summary(frequencies: np.ndarray) -> dict:
+    """
+    Database.distribution_summary() of a histogram: frequencies[diff_num] is the number of people (pairs)
+    that differ in diff_num positions. Sums and products of numeric values are exact in PostgreSQL, std and
+    coeff are double precision, so the values are equal to the ones of the SQL queries.
+    """
+    distribution: List[dict] = []
+    total: int = int(frequencies.sum())
+    for diff_num in np.flatnonzero(frequencies):
+        frequency: int = int(frequencies[diff_num])
+        distribution.append({'diff_num': int(diff_num), 'frequency': frequency, 'p': numeric_div(frequency, total)})
+
+    values: dict = {'mean': None, 'std': None, 'mode': None, 'min': None, 'max': None, 'coeff': None}
+    if not distribution:
+        return {'distribution': distribution, 'values': values}
+
+    with decimal.localcontext() as context:
+        context.prec = 10 * NUMERIC_MAX_DISPLAY_SCALE  # large enough for every product to be exact
+        mean: Decimal = sum(x['diff_num'] * x['p'] for x in distribution)
+        variance: Decimal = sum((x['diff_num'] - mean) * (x['diff_num'] - mean) * x['p'] for x in distribution)
+
+    max_frequency: int = max(x['frequency'] for x in distribution)
+    values['mean'] = mean
+    values['std'] = math.sqrt(float(variance))
+    values['mode'] = min(x['diff_num'] for x in distribution if x['frequency'] == max_frequency)
+    values['min'] = distribution[0]['diff_num']
+    values['max'] = distribution[-1]['diff_num']
+    values['coeff'] = values['std'] / float(mean) if mean else None
+
+    return {'distribution': distribution, 'values': values}
+
+
+def encode(fasta: List[bytes], length: int) -> np.ndarray:
+    # one row per sequence, one byte per position, 0 after the end of shorter sequences
+    buffer: bytes = b''.join(x[:length].ljust(length, b'\0') for x in fasta)
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(len(fasta), length)
+
+
+def pairwise_histogram(sequences: np.ndarray, weights: np.ndarray = None, block_size: int = BLOCK_SIZE) -> np.ndarray:
+    """
+    Histogram of the number of different positions of every unordered pair of people, frequencies[diff_num],
+    the same as SUM(pair_count) of fasta_diff in the "each to each" queries.
+    :param sequences: distinct sequences (haplotypes), one per row
+    :param weights: number of people with every sequence, 1 each if None. A pair of sequences stands for
+        weight_1 * weight_2 pairs of people, the weight * (weight - 1) / 2 pairs of people that share a sequence
+        differ in 0 positions, so the cost depends on the number of distinct sequences only
+    :param block_size: rows are compared block by block, so memory is bounded by the block size: the number of
+        equal positions of two blocks is a product of their one-hot encodings and the number of positions that
+        both have (not 0) is a product of their masks, the float32 sums are exact for up to 2 ** 24 positions.
+        Positions with the same value in every row add nothing to the distances and are left out
+    """
+    return _pair_histogram(sequences, weights, None, None, block_size)
+
+
+def cross_histogram(
+        sequences_1: np.ndarray, weights_1: np.ndarray, sequences_2: np.ndarray, weights_2: np.ndarray,
+        block_size: int = BLOCK_SIZE
+) -> np.ndarray:
+    # pairwise_histogram() of the pairs of a person of the first group and a person of the second one
+    return _pair_histogram(sequences_1, weights_1, sequences_2, weights_2, block_size)
+
+
+def _pair_histogram(
+        sequences_1: np.ndarray, weights_1: Optional[np.ndarray], sequences_2: Optional[np.ndarray],
+        weights_2: Optional[np.ndarray], block_size: int
+) -> np.ndarray:
+    length: int = sequences_1.shape[1]
+    frequencies: np.ndarray = np.zeros(length + 1, dtype=np.int64)
+    weights_1 = np.ones(len(sequences_1), dtype=np.int64) if weights_1 is None else np.asarray(weights_1, np.int64)
+
+    within: bool = sequences_2 is None
+    if within:
+        frequencies[0] = np.sum(weights_1 * (weights_1 - 1) // 2)
+        sequences_2, weights_2 = sequences_1, weights_1
+        rows: np.ndarray = sequences_1
+    else:
+        weights_2 = np.ones(len(sequences_2), dtype=np.int64) if weights_2 is None else np.asarray(weights_2, np.int64)
+        rows = np.concatenate([sequences_1, sequences_2])
+
+    if not len(sequences_1) or not len(sequences_2):
+        return frequencies
+
+    constant: np.ndarray = np.all(rows == rows[0], axis=0) & (rows[0] != 0)
+    sequences_1, sequences_2, rows = sequences_1[:, ~constant], sequences_2[:, ~constant], rows[:, ~constant]
+    # one-hot columns: the (position, value) pairs that occur, 0 (no position) matches nothing
+    occurring: np.ndarray = np.zeros((rows.shape[1], 256), dtype=bool)
+    for position, column in enumerate(rows.T):
+        occurring[position] = np.bincount(column, minlength=256) > 0
+    occurring[:, 0] = False
+    positions, values = np.nonzero(occurring)
+    values = values.astype(np.uint8)
+
+    for start_1 in range(0, len(sequences_1), block_size):
+        block_1: np.ndarray = sequences_1[start_1:start_1 + block_size]
+        one_hot_1: np.ndarray = (block_1[:, positions] == values).astype(np.float32)
+        present_1: np.ndarray = (block_1 != 0).astype(np.float32)
+
+        for start_2 in range(start_1 if within else 0, len(sequences_2), block_size):
+            block_2: np.ndarray = sequences_2[start_2:start_2 + block_size]
+            compared: np.ndarray = present_1 @ (block_2 != 0).astype(np.float32).T
+            equal: np.ndarray = one_hot_1 @ (block_2[:, positions] == values).astype(np.float32).T
+            distances: np.ndarray = np.rint(compared - equal).astype(np.int64)
+            pair_counts: np.ndarray = np.outer(
+                weights_1[start_1:start_1 + block_size], weights_2[start_2:start_2 + block_size]
+            )
+
+            if within and start_1 == start_2:
+                upper: Tuple[np.ndarray, np.ndarray] = np.triu_indices(len(block_1), k=1)
+                distances, pair_counts = distances[upper], pair_counts[upper]
+
+            # float64 sums of pair counts are exact below 2 ** 53
+            frequencies += np.rint(
+                np.bincount(distances.ravel(), weights=pair_counts.ravel(), minlength=length + 1)
+            ).astype(np.int64)
+
+    return frequencies
+
+
+def _haplotypes(counts: Dict[str, int], length: int) -> Tuple[np.ndarray, np.ndarray]:
+    # {fasta: people} -> encoded sequences and weights
+    return encode([x.encode() for x in counts], length), np.array(list(counts.values()), dtype=np.int64)
+
+
+class PairHistograms:
+    """
+    pairwise_histogram() of the people of every region kept up to date in pair_histogram: only the pairs of the
+    people added (removed) since the snapshot a histogram was saved with are computed and added to (subtracted from)
+    it, so the cost depends on the size of the change. The people of the regions and their changes (person_change,
+    see ddl.sql) are read once, as of one snapshot, for all the regions of a report:
+
+    histograms = PairHistograms(db)
+    histograms.update('BG'), histograms.update('ALL')
+    db.commit()
+    """
+
+    def __init__(self, db: database.Database, block_size: int = BLOCK_SIZE):
+        self._db: database.Database = db
+        self._block_size: int = block_size
+        # region -> {fasta: people with the crawled sequence}, 'ALL' included, as of snapshot
+        self.snapshot: Optional[str] = None
+        self._people: Dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+        for snapshot, region, fasta, count in db.get_region_haplotypes():
+            self.snapshot = snapshot
+            if region is not None:
+                self._people[region][fasta] += count
+                self._people['ALL'][fasta] += count
+        # saved snapshot -> Database.get_person_changes() since it
+        self._changes: Dict[str, list] = {}
+
+    def update(self, region: str) -> np.ndarray:
+        saved = self._db.get_pair_histogram(region)
+        people: collections.Counter = self._people[region]
+
+        if saved is None:
+            length: int = max((len(x.encode()) for x in people), default=0)
+            frequencies: np.ndarray = pairwise_histogram(*_haplotypes(people, length), self._block_size)
+        else:
+            frequencies = self._update(region, saved)
+
+        frequencies = np.trim_zeros(frequencies, 'b')
+        if saved is None or saved['snapshot'] != self.snapshot:
+            self._db.save_pair_histogram(region, self.snapshot, frequencies.tolist())
+
+        return frequencies
+
+    def _update(self, region: str, saved: dict) -> np.ndarray:
+        if saved['snapshot'] not in self._changes:
+            self._changes[saved['snapshot']] = self._db.get_person_changes(self.snapshot, saved['snapshot'])
+
+        # person id -> sequence of the changed person if it is in the region (the latest change wins)
+        saved_people: Dict[int, Optional[str]] = {}
+        changed_people: Dict[int, Optional[str]] = {}
+        for applied, _, person_id, person_region, sequence_type, fasta in self._changes[saved['snapshot']]:
+            in_region: bool = sequence_type == 0 and person_region is not None and region in ('ALL', person_region)
+            if applied:
+                saved_people[person_id] = fasta if in_region else None
+            changed_people[person_id] = fasta if in_region else None
+
+        removed: collections.Counter = collections.Counter(
+            x for person_id, x in saved_people.items() if x is not None and changed_people[person_id] != x
+        )
+        added: collections.Counter = collections.Counter(
+            x for person_id, x in changed_people.items() if x is not None and saved_people.get(person_id) != x
+        )
+        if not added and not removed:
+            return np.array(saved['frequencies'], dtype=np.int64)
+
+        # the people of both snapshots
+        kept: collections.Counter = self._people[region] - added
+
+        length: int = max([len(saved['frequencies']) - 1] + [len(x.encode()) for x in kept + removed + added])
+        frequencies: np.ndarray = np.zeros(length + 1, dtype=np.int64)
+        frequencies[:len(saved['frequencies'])] = saved['frequencies']
+
+        kept_sequences, kept_weights = _haplotypes(kept, length)
+        for counts, sign in ((added, 1), (removed, -1)):
+            if counts:
+                sequences, weights = _haplotypes(counts, length)
+                frequencies += sign * (
+                    pairwise_histogram(sequences, weights, self._block_size)
+                    + cross_histogram(sequences, weights, kept_sequences, kept_weights, self._block_size)
+                )
+
+        return frequencies
+
+
+def update_pair_histogram(db: database.Database, region: str, block_size: int = BLOCK_SIZE) -> np.ndarray:
+    # PairHistograms of one region, the caller commits
+    return PairHistograms(db, block_size).update(region)
+
+
+def read_arrays(db: database.Database) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    The MATRIX_ARRAYS of SequenceMatrix and their metadata ({'length': L, 'ragged': ..., 'regions': [...],
+    'names': [[row, name], ...]}) read from the database.
+    """
+    sequences: list = db.execute_query('SELECT id, sequence_type, name, fasta FROM public.sequence ORDER BY id', None)
+    people: list = db.execute_query(
+        'SELECT public.person.id, public.region.name, public.person.sequence_id '
+        'FROM public.person INNER JOIN public.region ON public.person.region_id = public.region.id '
+        'ORDER BY public.person.id', None
+    )
+
+    fasta: List[bytes] = [x[3].encode() for x in sequences]
+    length: int = max((len(x) for x in fasta), default=0)
+    rows: Dict[int, int] = {x[0]: i for i, x in enumerate(sequences)}
+    regions, person_regions = np.unique([x[1] for x in people], return_inverse=True)
+
+    arrays: Dict[str, np.ndarray] = {
+        'matrix': encode(fasta, length),
+        'sequence_ids': np.array([x[0] for x in sequences], dtype=np.int64),
+        'sequence_types': np.array([x[1] for x in sequences], dtype=np.int32),
+        'person_ids': np.array([x[0] for x in people], dtype=np.int64),
+        'person_rows': np.array([rows[x[2]] for x in people], dtype=np.int64),
+        'person_regions': person_regions.reshape(-1).astype(np.int64),  # a column in some NumPy versions
+    }
+    meta: dict = {
+        'length': length,
+        'ragged': any(len(x) != length for x in fasta),
+        'regions': regions.tolist(),
+        'names': [[row, x[2]] for row, x in enumerate(sequences) if x[2] is not None],
+    }
+
+    return arrays, meta
+
+
+class MatrixCache:
+    """
+    The arrays of SequenceMatrix in <directory>/<database>/<dataset_version>/<name>.npy files (<database> is a digest
+    of Database.identity(), so databases can share the directory), opened with np.load(mmap_mode='r'): processes that
+    load the same version share one page-cached copy instead of reading the sequences from the database each.
+    A missing version is read from the database, written to a temporary directory and renamed into place, then the
+    other versions of the database are removed (processes that still map them keep their pages, a process that finds
+    its version removed before opening it reads the database). Needs dataset_version
+    (migrations/0003_dataset_version.up.sql or ddl_sqlite.sql), transactions that changed the data
+    (dataset_version() is None) read the database.
+    """
+
+    def __init__(self, directory: str):
+        self._directory: str = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _database_directory(self, db: database.Database) -> str:
+        digest: str = hashlib.sha256(db.identity().encode('utf-8')).hexdigest()[:16]
+        directory: str = os.path.join(self._directory, digest)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def load(self, db: database.Database) -> Tuple[Dict[str, np.ndarray], dict]:
+        version: Optional[int] = db.dataset_version()
+        if version is None:
+            return read_arrays(db)
+
+        path: str = os.path.join(self._database_directory(db), str(version))
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            arrays, meta = read_arrays(db)
+            # a commit between the two reads would store newer data under the old version
+            if db.dataset_version() != version:
+                return arrays, meta
+            self._write(path, arrays, meta)
+
+        try:
+            with open(os.path.join(path, META_FILE), encoding='utf-8') as file:
+                meta = json.load(file)
+            return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in MATRIX_ARRAYS}, meta
+        except FileNotFoundError:
+            # a newer version was written by another process meanwhile, this one is out of date
+            return read_arrays(db)
+
+    def _write(self, path: str, arrays: Dict[str, np.ndarray], meta: dict):
+        directory: str = os.path.dirname(path)
+        temporary: str = tempfile.mkdtemp(dir=directory, prefix='.')
+        for name in MATRIX_ARRAYS:
+            np.save(os.path.join(temporary, f'{name}.npy'), arrays[name])
+        with open(os.path.join(temporary, META_FILE), 'w', encoding='utf-8') as file:
+            json.dump(meta, file)
+
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            shutil.rmtree(temporary, ignore_errors=True)  # another process has written the version and cleaned up
+            return
+        self._remove_versions(directory, keep=os.path.basename(path))
+
+    @staticmethod
+    def _remove_versions(directory: str, keep: str = None):
+        # temporary directories of the processes that are writing are hidden ('.' names)
+        for name in os.listdir(directory):
+            if name != keep and not name.startswith('.'):
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    def clear(self):
+        for name in os.listdir(self._directory):
+            shutil.rmtree(os.path.join(self._directory, name), ignore_errors=True)
+
+
+class SequenceMatrix:
+    """
+    In-memory analytics over all sequences, a drop-in data source for TabBuilder:
+
+    matrix = SequenceMatrix(database.Database(conn))
+    TabBuilder(wrapper, matrix).build('IF')
+
+    Every sequence is a row of an N x L uint8 matrix (one byte per position, 0 after the end of shorter
+    sequences), every person is a sequence row and a region index. The statistics are computed with
+    vectorized NumPy operations and give the same results as the SQL queries of Database, other calls
+    (select(), commit(), ...) are passed to the Database.
+    """
+
+    def __init__(
+            self, db: database.Database, block_size: int = BLOCK_SIZE, incremental: bool = False,
+            cache: 'MatrixCache' = None
+    ):
+        # incremental: "each to each" histograms are kept in pair_histogram and updated with the people
+        # added or removed since, see PairHistograms
+        # cache: the arrays are memory-mapped from a MatrixCache instead of being read from the database
+        self._db: database.Database = db
+        self._cache: Optional[MatrixCache] = cache
+        self._block_size: int = block_size
+        self._incremental: bool = incremental
+        self._histograms: Dict[Tuple[Optional[str], str], np.ndarray] = {}
+        self.load()
+
+    def __getattr__(self, name: str):
+        return getattr(self._db, name)
+
+    def load(self):
+        arrays, meta = self._cache.load(self._db) if self._cache is not None else read_arrays(self._db)
+
+        self.length: int = meta['length']
+        self.matrix: np.ndarray = arrays['matrix']
+        self.sequence_ids: np.ndarray = arrays['sequence_ids']
+        self.sequence_types: np.ndarray = arrays['sequence_types']
+        self.sequence_names: np.ndarray = np.full(len(self.matrix), None, dtype=object)
+        # positions missing from one of the sequences are not compared, as the SQL joins on position
+        self._ragged: bool = meta['ragged']
+
+        self._references: Dict[str, np.ndarray] = {}
+        for row, name in meta['names']:
+            self.sequence_names[row] = name
+            self._references.setdefault(name, self.matrix[row])
+
+        self.person_ids: np.ndarray = arrays['person_ids']
+        self.person_rows: np.ndarray = arrays['person_rows']
+        self.regions: np.ndarray = np.array(meta['regions'], dtype=str)
+        self.person_regions: np.ndarray = arrays['person_regions']
+
+        self._histograms.clear()
+        # read by the first "each to each" histogram of an incremental matrix
+        self._pair_histograms: Optional[PairHistograms] = None
+        self._allele_counts: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._wild_types: Optional[Dict[str, str]] = None
+        # wild_types() computes them, calculate_wilds() stores them as well
+        self._wild_types_stored: bool = False
+
+    def _count_differences(self, rows: np.ndarray, vector: np.ndarray) -> np.ndarray:
+        different: np.ndarray = (rows != vector) & (vector != 0)
+        if self._ragged:
+            different &= rows != 0
+        return np.count_nonzero(different, axis=1)
+
+    def _people(self, region: str, sequence_type: Optional[int] = None) -> np.ndarray:
+        # sequence rows of the people of the region
+        mask: np.ndarray = np.ones(len(self.person_rows), dtype=bool)
+        if region != 'ALL':
+            mask &= self.regions[self.person_regions] == region
+        if sequence_type is not None:
+            mask &= self.sequence_types[self.person_rows] == sequence_type
+        return self.person_rows[mask]
+
+    def _histogram(self, base_name: Optional[str], region: str) -> np.ndarray:
+        key: Tuple[Optional[str], str] = (base_name, region)
+        if key not in self._histograms:
+            if base_name is None:
+                self._histograms[key] = self._histogram_each_to_each(region)
+            else:
+                self._histograms[key] = self._histogram_to_base(base_name, region)
+        return self._histograms[key]
+
+    def _histogram_to_base(self, base_name: str, region: str) -> np.ndarray:
+        return np.bincount(self._differences_to_base(base_name, self._people(region)), minlength=1)
+
+    def _differences_to_base(self, base_name: str, rows: np.ndarray) -> np.ndarray:
+        differences: np.ndarray = np.zeros(len(rows), dtype=np.int64)
+
+        base: np.ndarray = self._references.get(base_name)
+        if base is not None:
+            # people with a sequence that is not a crawled one (sequence_type != 0) differ in 0 positions
+            crawled: np.ndarray = self.sequence_types[rows] == 0
+            differences[crawled] = self._count_differences(self.matrix[rows[crawled]], base)
+
+        return differences
+
+    def _histogram_each_to_each(self, region: str) -> np.ndarray:
+        if self._incremental:
+            if self._pair_histograms is None:
+                self._pair_histograms = PairHistograms(self._db, self._block_size)
+            return self._pair_histograms.update(region)
+
+        rows, weights = np.unique(self._people(region, sequence_type=0), return_counts=True)
+        return pairwise_histogram(self.matrix[rows], weights, self._block_size)
+
+    def distribution_summary(self, base_name: str, region: str) -> dict:
+        return summary(self._histogram(base_name, region))
+
+    def distribution_summary_each_to_each(self, region: str) -> dict:
+        return summary(self._histogram(None, region))
+
+    def distribution_by_region(self, base_name: str) -> Dict[str, dict]:
+        # Database.distribution_by_region(): every person is compared once, 'ALL' is the sum of the regions
+        differences: np.ndarray = self._differences_to_base(base_name, self.person_rows)
+        width: int = self.length + 1
+        histograms: np.ndarray = np.bincount(
+            self.person_regions * width + differences, minlength=len(self.regions) * width
+        ).reshape(len(self.regions), width)
+
+        for region, frequencies in zip(self.regions, histograms):
+            self._histograms[(base_name, region)] = frequencies
+        self._histograms[(base_name, 'ALL')] = histograms.sum(axis=0)
+
+        return {region: self.distribution_summary(base_name, region) for region in [*self.regions, 'ALL']}
+
+    def distribution(self, base_name: str, region: str) -> List[dict]:
+        return self.distribution_summary(base_name, region)['distribution']
+
+    def distribution_each_to_each(self, region: str) -> List[dict]:
+        return self.distribution_summary_each_to_each(region)['distribution']
+
+    def math_expectation(self, base_name: str, region: str) -> List[dict]:
+        return [{'math_expectation': self.distribution_summary(base_name, region)['values']['mean']}]
+
+    def math_expectation_each_to_each(self, region: str) -> List[dict]:
+        return [{'math_expectation': self.distribution_summary_each_to_each(region)['values']['mean']}]
+
+    def std(self, base_name: str, region: str) -> List[dict]:
+        return [{'standart_dev': self.distribution_summary(base_name, region)['values']['std']}]
+
+    def std_each_to_each(self, region: str) -> List[dict]:
+        return [{'standart_dev': self.distribution_summary_each_to_each(region)['values']['std']}]
+
+    def mode(self, base_name: str, region: str) -> List[dict]:
+        return self._mode(self.distribution(base_name, region))
+
+    def mode_each_to_each(self, region: str) -> List[dict]:
+        return self._mode(self.distribution_each_to_each(region))
+
+    @staticmethod
+    def _mode(distribution: List[dict]) -> List[dict]:
+        max_frequency: int = max((x['frequency'] for x in distribution), default=None)
+        return [{'diff_num': x['diff_num']} for x in distribution if x['frequency'] == max_frequency]
+
+    def min_value(self, base_name: str, region: str) -> List[dict]:
+        return [{'min': self.distribution_summary(base_name, region)['values']['min']}]
+
+    def min_value_each_to_each(self, region: str) -> List[dict]:
+        return [{'min': self.distribution_summary_each_to_each(region)['values']['min']}]
+
+    def max_value(self, base_name: str, region: str) -> List[dict]:
+        return [{'max': self.distribution_summary(base_name, region)['values']['max']}]
+
+    def max_value_each_to_each(self, region: str) -> List[dict]:
+        return [{'max': self.distribution_summary_each_to_each(region)['values']['max']}]
+
+    def coeff(self, base_name: str, region: str) -> List[dict]:
+        return [{'koef': self.distribution_summary(base_name, region)['values']['coeff']}]
+
+    def coeff_each_to_each(self, region: str) -> List[dict]:
+        return [{'koef': self.distribution_summary_each_to_each(region)['values']['coeff']}]
+
+    def polim(self, base_name: str, region: str) -> List[tuple]:
+        # (count,) rows like Database.polim(): positions with more than one value among the people of the region
+        rows: np.ndarray = self._people(region)
+        rows = rows[(self.sequence_types[rows] == 0) | (self.sequence_names[rows] == base_name)]
+        sequences: np.ndarray = self.matrix[np.unique(rows)]
+        if not len(sequences):
+            return [(0,)]
+
+        highest: np.ndarray = sequences.max(axis=0)
+        lowest: np.ndarray = np.where(sequences == 0, 255, sequences).min(axis=0)
+        return [(int(np.count_nonzero(highest > lowest)),)]
+
+    def diff_between_base_and_wild(self, base_name: str, wild_name: str) -> List[tuple]:
+        base: np.ndarray = self._references.get(base_name)
+        wild: np.ndarray = self._references.get(wild_name)
+        if base is None or wild is None:
+            return []
+
+        count: int = int(self._count_differences(wild[np.newaxis], base)[0])
+        return [(count,)] if count else []
+
+    def _allele_count_tensor(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (values, counts): the values that occur and the regions x L x values tensor of how many people (with a
+        crawled sequence) of every region have the value on the position, see allele_count in ddl.sql.
+        """
+        if self._allele_counts is not None:
+            return self._allele_counts
+
+        crawled: np.ndarray = self.sequence_types[self.person_rows] == 0
+        keys, weights = np.unique(
+            self.person_regions[crawled] * len(self.matrix) + self.person_rows[crawled], return_counts=True
+        )
+        regions, rows = np.divmod(keys, len(self.matrix))
+
+        values: np.ndarray = np.unique(self.matrix[rows])
+        values = values[values != 0]
+        indexes: np.ndarray = np.full(256, -1, dtype=np.int64)
+        indexes[values] = np.arange(len(values))
+
+        # flat index of (region, position, value) of every position of every (region, sequence) pair
+        value_indexes: np.ndarray = indexes[self.matrix[rows]]
+        cells: np.ndarray = (regions[:, np.newaxis] * self.length + np.arange(self.length)) * len(values) + value_indexes
+        present: np.ndarray = value_indexes >= 0
+        counts: np.ndarray = np.bincount(
+            cells[present], weights=np.broadcast_to(weights[:, np.newaxis], cells.shape)[present],
+            minlength=len(self.regions) * self.length * len(values)
+        ).reshape(len(self.regions), self.length, len(values)).astype(np.int64)
+
+        self._allele_counts = values, counts
+        return self._allele_counts
+
+    def allele_counts(self, region: str) -> List[tuple]:
+        # (position, value, count) rows like Database.allele_counts(), ordered by position and value (in byte order)
+        values, counts = self._allele_count_tensor()
+        if region == 'ALL':
+            counts = counts.sum(axis=0)
+        elif region in self.regions:
+            counts = counts[np.flatnonzero(self.regions == region)[0]]
+        else:
+            return []
+
+        positions, value_indexes = np.nonzero(counts)
+        return [
+            (int(position) + 1, chr(values[value_index]), int(counts[position, value_index]))
+            for position, value_index in zip(positions, value_indexes)
+        ]
+
+    def wild_types(self) -> Dict[str, str]:
+        """
+        {'IF': 'TTCTTTCATG...', ..., 'ALL': ...}: the most frequent value on every position among the people of
+        every region (counted per person), the smallest value wins a tie. Alleles are counted for all regions in
+        one regions x L x values tensor, 'ALL' is the sum of the regions. Regions without people are left out.
+        """
+        if self._wild_types is not None:
+            return self._wild_types
+
+        values, counts = self._allele_count_tensor()
+        self._wild_types = {}
+        for region, region_counts in [*zip(self.regions, counts), ('ALL', counts.sum(axis=0))]:
+            if region_counts.any():
+                wild: np.ndarray = values[region_counts.argmax(axis=1)]  # the first maximum is the smallest value
+                self._wild_types[region] = wild[region_counts.any(axis=1)].tobytes().decode()
+
+        return self._wild_types
+
+    def wild_type(self, region: str) -> Optional[str]:
+        return self.wild_types().get(region)
+
+    def calculate_wild(self, region: str):
+        # the wild types of all regions are stored at the first call, even if wild_types() computed them before
+        if not self._wild_types_stored:
+            self.calculate_wilds()
+
+    def calculate_wilds(self):
+        wild_types: Dict[str, str] = self.wild_types()
+        self._db.upsert_wild_types(wild_types)
+        self._wild_types_stored = True
+
+        for region, fasta in wild_types.items():
+            name: str = f'WILD_TYPE_{region}'
+            self._references[name] = encode([fasta.encode()], self.length)[0]
+            self._histograms = {k: v for k, v in self._histograms.items() if k[0] != name}
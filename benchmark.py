@@ -0,0 +1,347 @@
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+from typing import Dict, Iterator, List
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+
+import analytics
+import database
+import main
+import migrate
+import tab_builder
+import xlsx_wrapper
+
+ADMIN_DSN: str = "dbname='postgres' user='postgres' host='localhost' password='gulayeva'"
+SIZES: List[int] = [1_000, 10_000, 100_000]
+REGIONS: List[str] = ['IF', 'BK', 'BG', 'ST', 'CH', 'KHM', 'ZA', 'LV']
+REPORT_REGIONS: int = 6
+LOADERS: List[str] = ['main', 'bulk']
+SEED: int = 2021
+
+NUCLEOTIDES: str = 'ACGT'
+TRANSITIONS: Dict[str, str] = {'A': 'G', 'G': 'A', 'C': 'T', 'T': 'C'}
+AMBIGUITY_CODES: Dict[frozenset, str] = {
+    frozenset('AG'): 'R', frozenset('CT'): 'Y', frozenset('AC'): 'M', frozenset('GT'): 'K',
+    frozenset('AT'): 'W', frozenset('CG'): 'S',
+}
+PACKAGE_DIR: str = os.path.dirname(os.path.abspath(__file__))
+
+
+class SequenceGenerator:
+    """
+    Seeded model of mitochondrial control region samples, every sequence as long as the reference (EVA):
+    - positions mutate at gamma-distributed rates (a few hypervariable sites), transitions are `kappa` times
+      more likely than transversions
+    - haplotypes form a tree: the root differs from the reference by Poisson(`root_mutations`) mutations,
+      each new haplotype descends from an earlier one with Poisson(`mutations`) mutations
+    - haplotype frequencies follow a power law (shared haplotypes), every region draws its own frequencies
+      around the common ones (Dirichlet with `region_concentration`), region sizes are Dirichlet(2) shares
+    - a few positions of the samples are read as IUPAC ambiguity codes (C/T -> Y, ...)
+    """
+
+    def __init__(
+            self,
+            reference: str = main.BASE_SEQUENCES['EVA'],
+            regions: List[str] = None,
+            seed: int = SEED,
+            people_per_haplotype: float = 2.0,
+            root_mutations: float = 8.0,
+            mutations: float = 1.5,
+            rate_shape: float = 0.3,
+            kappa: float = 20.0,
+            frequency_exponent: float = 1.1,
+            region_concentration: float = 50.0,
+            ambiguity_rate: float = 0.0005
+    ):
+        self._reference: str = reference
+        self._regions: List[str] = regions or REGIONS
+        self._rng: np.random.Generator = np.random.default_rng(seed)
+        self._people_per_haplotype: float = people_per_haplotype
+        self._root_mutations: float = root_mutations
+        self._mutations: float = mutations
+        self._kappa: float = kappa
+        self._frequency_exponent: float = frequency_exponent
+        self._region_concentration: float = region_concentration
+        self._ambiguity_rate: float = ambiguity_rate
+
+        rates = self._rng.gamma(rate_shape, size=len(reference))
+        self._site_rates: np.ndarray = rates / rates.sum()
+
+    def _mutate(self, fasta: List[str], mutations: float) -> List[str]:
+        fasta = list(fasta)
+        count = self._rng.poisson(mutations)
+        for position in self._rng.choice(len(fasta), size=count, p=self._site_rates):
+            base = fasta[position]
+            if self._rng.random() < self._kappa / (self._kappa + 1):
+                fasta[position] = TRANSITIONS[base]
+            else:
+                fasta[position] = self._rng.choice([x for x in NUCLEOTIDES if x not in (base, TRANSITIONS[base])])
+
+        return fasta
+
+    def haplotypes(self, count: int) -> List[str]:
+        # the population differs from the reference in about root_mutations positions
+        tree = [self._mutate(list(self._reference), self._root_mutations)]
+        while len(tree) < count:
+            # earlier haplotypes have more descendants
+            parent = tree[int(len(tree) * self._rng.random() ** 2)]
+            tree.append(self._mutate(parent, self._mutations))
+
+        return [''.join(x) for x in tree]
+
+    def _ambiguous(self, fasta: str) -> str:
+        positions = np.flatnonzero(self._rng.random(len(fasta)) < self._ambiguity_rate)
+        if not len(positions):
+            return fasta
+
+        fasta = list(fasta)
+        for position in positions:
+            fasta[position] = AMBIGUITY_CODES[frozenset((fasta[position], TRANSITIONS[fasta[position]]))]
+        return ''.join(fasta)
+
+    def people(self, count: int) -> Iterator[List[str]]:
+        """
+        [version, region, fasta] records of `count` people, the crawler csv rows
+        """
+        haplotypes = self.haplotypes(max(1, int(count / self._people_per_haplotype)))
+        common = np.arange(1, len(haplotypes) + 1, dtype=float) ** -self._frequency_exponent
+        common /= common.sum()
+
+        region_shares = self._rng.dirichlet(np.full(len(self._regions), 2.0))
+        region_of_people = self._rng.choice(len(self._regions), size=count, p=region_shares)
+        frequencies = self._rng.dirichlet(common * self._region_concentration + 1e-3, size=len(self._regions))
+
+        # one draw per region instead of one per person
+        haplotype_of_people = np.empty(count, dtype=np.int64)
+        for region in range(len(self._regions)):
+            people = np.flatnonzero(region_of_people == region)
+            haplotype_of_people[people] = self._rng.choice(len(haplotypes), size=len(people), p=frequencies[region])
+
+        for number, (region, haplotype) in enumerate(zip(region_of_people, haplotype_of_people), start=1):
+            yield [f'SYN{number:07d}.1', self._regions[region], self._ambiguous(haplotypes[haplotype])]
+
+    def write_csv(self, filename: str, count: int):
+        with open(filename, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['version', 'region', 'fasta'])
+            writer.writerows(self.people(count))
+
+
+class Benchmark:
+    """
+    Runs the benchmarks of one size against throw-away databases and collects
+    {'size': ..., 'group': ..., 'name': ..., 'seconds': ...} results.
+    """
+
+    def __init__(self, admin_dsn: str = ADMIN_DSN, compact: bool = False, keep: bool = False, repeat: int = 1):
+        self._admin_dsn: str = admin_dsn
+        self._compact: bool = compact
+        self._keep: bool = keep
+        self._repeat: int = repeat
+        self._connections: list = []
+        self.results: List[dict] = []
+
+    def _timed(self, size: int, group: str, name: str, function, *args, setup=None):
+        # the best of `repeat` runs, the output of the loaders is not printed. setup() runs before every run and
+        # is not timed
+        seconds = []
+        result = None
+        for _ in range(self._repeat):
+            if setup is not None:
+                setup()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                started = time.perf_counter()
+                result = function(*args)
+                seconds.append(time.perf_counter() - started)
+
+        self.results.append({'size': size, 'group': group, 'name': name, 'seconds': min(seconds)})
+        print(f'{size:>8} {group:<12} {name:<60} {min(seconds):10.3f}s', flush=True)
+        return result
+
+    def _connect(self, dsn: str):
+        # closed before the databases are dropped
+        conn = psycopg2.connect(dsn)
+        self._connections.append(conn)
+        return conn
+
+    def _admin(self, statement: str):
+        conn = psycopg2.connect(self._admin_dsn)
+        conn.autocommit = True
+        try:
+            conn.cursor().execute(statement)
+        finally:
+            conn.close()
+
+    def create_database(self, name: str) -> str:
+        self._admin(f'DROP DATABASE IF EXISTS {name}')
+        self._admin(f'CREATE DATABASE {name}')
+        dsn = psycopg2.extensions.make_dsn(self._admin_dsn, dbname=name)
+
+        # closed right away, so the database can be dropped by the next repetition of an ingest
+        conn = psycopg2.connect(dsn)
+        try:
+            db = database.Database(conn)
+            scripts = ['ddl.sql'] + (['ddl_compact.sql'] if self._compact else [])
+            for script in scripts:
+                with open(os.path.join(PACKAGE_DIR, script), encoding='utf-8') as file:
+                    db.execute_query(file.read(), None, fetch=False)
+            db.commit()
+            migrate.upgrade(db)
+        finally:
+            conn.close()
+
+        return dsn
+
+    def drop_database(self, name: str):
+        if not self._keep:
+            self._admin(f'DROP DATABASE IF EXISTS {name}')
+
+    def run_ingest(self, size: int, filename: str, loader: str) -> str:
+        name = f'nrbd_bench_{size}_{loader}'
+        dsn = psycopg2.extensions.make_dsn(self._admin_dsn, dbname=name)
+        loaders = {
+            'main': lambda: main.main(dsn, filename),
+            'bulk': lambda: main.bulk_main(dsn, filename, os.devnull),
+            'workers': lambda: main.parallel_main(dsn, filename),
+        }
+        # every repetition loads into a new database, a loaded one would only skip the rows (checkpoint, urls)
+        self._timed(size, 'ingest', loader, loaders[loader], setup=lambda: self.create_database(name))
+        return name
+
+    def run_statistics(self, size: int, dsn: str, region: str):
+        db = database.Database(self._connect(dsn))
+        for base_name in ['EVA', 'ANDREWS']:
+            for method in migrate.BASE_QUERIES:
+                for tab in ['ALL', region]:
+                    self._timed(size, 'statistic', f'{method}({base_name}, {tab})', getattr(db, method), base_name, tab)
+            self._timed(size, 'statistic', f'distribution_by_region({base_name})', db.distribution_by_region, base_name)
+        for tab in ['ALL', region]:
+            self._timed(size, 'statistic', f'polim(EVA, {tab})', db.polim, 'EVA', tab)
+        db.rollback()
+
+    def run_each_to_each(self, size: int, dsn: str, region: str):
+        db = database.Database(self._connect(dsn))
+        for method in migrate.EACH_TO_EACH_QUERIES:
+            self._timed(size, 'each_to_each', f'{method}({region})', getattr(db, method), region)
+        self._timed(size, 'each_to_each', 'distribution_summary_each_to_each(ALL)',
+                    db.distribution_summary_each_to_each, 'ALL')
+
+        matrix = self._timed(size, 'each_to_each', 'SequenceMatrix.load', analytics.SequenceMatrix, db)
+        for tab in ['ALL', region]:
+            # a new matrix every time, its histograms are cached
+            self._timed(size, 'each_to_each', f'SequenceMatrix.distribution_summary_each_to_each({tab})',
+                        lambda: analytics.SequenceMatrix(db).distribution_summary_each_to_each(tab))
+        self._timed(size, 'each_to_each', 'SequenceMatrix.distribution_by_region(EVA)',
+                    matrix.distribution_by_region, 'EVA')
+        db.rollback()
+
+    def run_report(self, size: int, dsn: str, tabs: List[str]):
+        def report(engine: bool):
+            db = database.Database(self._connect(dsn))
+            if engine:
+                db = analytics.SequenceMatrix(db)
+            with tempfile.TemporaryDirectory() as directory:
+                wrapper = xlsx_wrapper.XlsxWrapper(os.path.join(directory, 'report.xlsx'))
+                tab_builder.TabBuilder(wrapper, db).build_all(tabs)
+                wrapper.save()
+
+        self._timed(size, 'report', 'TabBuilder.build_all + XlsxWrapper.save (SQL)', report, False)
+        self._timed(size, 'report', 'TabBuilder.build_all + XlsxWrapper.save (SequenceMatrix)', report, True)
+
+    def run(self, size: int, generator: SequenceGenerator, loaders: List[str]):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, f'people_{size}.csv')
+            self._timed(size, 'generate', 'SequenceGenerator.write_csv', generator.write_csv, filename, size)
+
+            names = [self.run_ingest(size, filename, loader) for loader in loaders]
+
+        # the statistics are read from the database of the last loader
+        dsn = psycopg2.extensions.make_dsn(self._admin_dsn, dbname=names[-1])
+        db = database.Database(self._connect(dsn))
+        regions = [row[0] for row in db.execute_query(
+            'SELECT region.name FROM person INNER JOIN region ON person.region_id = region.id '
+            'GROUP BY region.name ORDER BY COUNT(*) DESC', None
+        )]
+        db.rollback()
+
+        # the biggest region, the report has a tab for ALL and for each of the REPORT_REGIONS biggest ones
+        self.run_statistics(size, dsn, regions[0])
+        self.run_each_to_each(size, dsn, regions[0])
+        self.run_report(size, dsn, ['ALL'] + regions[:REPORT_REGIONS])
+
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+        for name in names:
+            self.drop_database(name)
+
+
+def environment() -> dict:
+    return {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'psycopg2': psycopg2.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results: List[dict], baseline: List[dict]):
+    # seconds of this run / seconds of the baseline for the benchmarks both runs have
+    previous = {(x['size'], x['group'], x['name']): x['seconds'] for x in baseline}
+    for result in results:
+        key = (result['size'], result['group'], result['name'])
+        if key in previous and previous[key] > 0:
+            print(f"{result['size']:>8} {result['group']:<12} {result['name']:<45} "
+                  f"{previous[key]:10.3f}s -> {result['seconds']:10.3f}s  x{result['seconds'] / previous[key]:.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the nrbd loaders and reports on synthetic data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='write a synthetic crawler csv')
+    generate_parser.add_argument('filename')
+    generate_parser.add_argument('--people', type=int, default=SIZES[0])
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    run_parser.add_argument('--loaders', nargs='+', choices=['main', 'bulk', 'workers'], default=LOADERS)
+    run_parser.add_argument('--admin-dsn', default=ADMIN_DSN, help='a connection allowed to create databases')
+    run_parser.add_argument('--compact', action='store_true', help='create the databases with ddl_compact.sql')
+    run_parser.add_argument('--keep', action='store_true', help='do not drop the benchmark databases')
+    run_parser.add_argument('--repeat', type=int, default=1, help='the best of this many runs is reported')
+    run_parser.add_argument('--output', default='benchmark.json')
+    run_parser.add_argument('--compare', help='results of an earlier run to compare with')
+
+    for subparser in (generate_parser, run_parser):
+        subparser.add_argument('--seed', type=int, default=SEED)
+        subparser.add_argument('--regions', nargs='+', default=REGIONS)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        SequenceGenerator(regions=args.regions, seed=args.seed).write_csv(args.filename, args.people)
+    else:
+        benchmark_ = Benchmark(args.admin_dsn, compact=args.compact, keep=args.keep, repeat=args.repeat)
+        output_ = {'environment': environment(), 'parameters': vars(args), 'results': benchmark_.results}
+        try:
+            for size_ in args.sizes:
+                # the same people for every loader of a size
+                benchmark_.run(size_, SequenceGenerator(regions=args.regions, seed=args.seed + size_), args.loaders)
+        finally:
+            with open(args.output, 'w', encoding='utf-8') as file_:
+                json.dump(output_, file_, indent=2)
+
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as file_:
+                compare(benchmark_.results, json.load(file_)['results'])
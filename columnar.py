@@ -0,0 +1,201 @@
+import argparse
+import os
+import time
+from typing import Dict, Iterator, List
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import analytics
+import main
+
+FORMATS: Dict[str, str] = {'parquet': '.parquet', 'arrow': '.arrow'}
+TABLES: List[str] = ['region', 'sequence', 'person']
+
+
+class ColumnarError(Exception):
+    pass
+
+
+def sequence_table(sequences: list, bases: str = 'binary') -> pa.Table:
+    """
+    (id, sequence_type, name, fasta) rows -> id, sequence_type, name, length and bases columns, bases holds the
+    sequence as in analytics.SequenceMatrix (one byte per position, 0 after the end of shorter sequences):
+    :param bases: 'binary' - fixed_size_binary(L), 'positions' - fixed_size_list<uint8>(L), a column per position
+        in pandas / NumPy terms
+    """
+    fasta: List[bytes] = [x[3].encode() for x in sequences]
+    length: int = max((len(x) for x in fasta), default=0)
+    matrix: np.ndarray = analytics.encode(fasta, length)
+
+    if bases == 'binary':
+        bases_array: pa.Array = pa.Array.from_buffers(
+            pa.binary(length), len(sequences), [None, pa.py_buffer(matrix.tobytes())]
+        )
+    elif bases == 'positions':
+        bases_array = pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1), pa.uint8()), length)
+    else:
+        raise ColumnarError(f'unknown bases layout \'{bases}\'')
+
+    return pa.table({
+        'id': pa.array([x[0] for x in sequences], pa.int32()),
+        'sequence_type': pa.array([x[1] for x in sequences], pa.int32()),
+        'name': pa.array([x[2] for x in sequences], pa.string()),
+        'length': pa.array([len(x) for x in fasta], pa.int16()),
+        'bases': bases_array,
+    })
+
+
+def bases_matrix(table: pa.Table) -> np.ndarray:
+    """
+    N x L uint8 matrix of the bases column of a sequence table of either layout, a copy-free view when the
+    column is one chunk (Arrow IPC files opened with pa.memory_map()):
+
+    sequences = pq.read_table('export/sequence.parquet')
+    matrix = bases_matrix(sequences)  # matrix[i, :sequences['length'][i]] is the fasta of sequence i
+    """
+    column: pa.ChunkedArray = table.column('bases')
+    array: pa.Array = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+
+    if pa.types.is_fixed_size_binary(array.type):
+        length: int = array.type.byte_width
+        data: np.ndarray = np.frombuffer(array.buffers()[1], dtype=np.uint8)
+        return data[array.offset * length:(array.offset + len(array)) * length].reshape(len(array), length)
+
+    if pa.types.is_fixed_size_list(array.type):
+        return array.flatten().to_numpy().reshape(len(array), array.type.list_size)
+
+    raise ColumnarError(f'bases column of unexpected type {array.type}')
+
+
+def write_table(table: pa.Table, filename: str):
+    if filename.endswith(FORMATS['parquet']):
+        pq.write_table(table, filename)
+        return
+
+    with pa.OSFile(filename, 'wb') as file, pa.ipc.new_file(file, table.schema) as writer:
+        writer.write_table(table)
+
+
+def read_table(filename: str) -> pa.Table:
+    if filename.endswith(FORMATS['parquet']):
+        return pq.read_table(filename)
+
+    # memory-mapped, the columns are read without a copy
+    return pa.ipc.open_file(pa.memory_map(filename)).read_all()
+
+
+def export(db, directory: str, format_: str = 'parquet', bases: str = 'binary') -> Dict[str, int]:
+    """
+    Writes region.<format>, sequence.<format> and person.<format> (ids and columns of ddl.sql, person.url
+    included) to directory, format_ is 'parquet' or 'arrow' (Arrow IPC). Any database.Database works,
+    embedded.EmbeddedDatabase as well.
+    :return: {table: rows}
+    """
+    if format_ not in FORMATS:
+        raise ColumnarError(f'unknown format \'{format_}\'')
+
+    regions: list = db.execute_query('SELECT id, name FROM public.region ORDER BY id', None)
+    sequences: list = db.execute_query(
+        'SELECT id, sequence_type, name, fasta FROM public.sequence ORDER BY id', None
+    )
+    people: list = db.execute_query('SELECT id, region_id, sequence_id, url FROM public.person ORDER BY id', None)
+
+    tables: Dict[str, pa.Table] = {
+        'region': pa.table({
+            'id': pa.array([x[0] for x in regions], pa.int32()),
+            'name': pa.array([x[1] for x in regions], pa.string()),
+        }),
+        'sequence': sequence_table(sequences, bases),
+        'person': pa.table({
+            'id': pa.array([x[0] for x in people], pa.int32()),
+            'region_id': pa.array([x[1] for x in people], pa.int32()),
+            'sequence_id': pa.array([x[2] for x in people], pa.int32()),
+            'url': pa.array([x[3] for x in people], pa.string()),
+        }),
+    }
+
+    os.makedirs(directory, exist_ok=True)
+    for name, table in tables.items():
+        write_table(table, os.path.join(directory, f'{name}{FORMATS[format_]}'))
+
+    return {name: table.num_rows for name, table in tables.items()}
+
+
+def read_export(directory: str) -> Dict[str, pa.Table]:
+    # {table: pa.Table} of an export() of either format
+    for extension in FORMATS.values():
+        filenames: Dict[str, str] = {name: os.path.join(directory, f'{name}{extension}') for name in TABLES}
+        if all(os.path.exists(x) for x in filenames.values()):
+            return {name: read_table(filename) for name, filename in filenames.items()}
+
+    raise ColumnarError(f'\'{directory}\' has no {", ".join(TABLES)} tables of one format')
+
+
+def _fasta(sequences: pa.Table) -> Dict[int, str]:
+    # sequence id -> fasta
+    matrix: np.ndarray = bases_matrix(sequences)
+    return {
+        id_: row[:length].tobytes().decode()
+        for id_, length, row in zip(sequences.column('id').to_pylist(), sequences.column('length').to_pylist(), matrix)
+    }
+
+
+def exported_records(tables: Dict[str, pa.Table]) -> Iterator[List[str]]:
+    """
+    [version, region, fasta] records of the exported people, as sequence_reader.read_sequences() reads them.
+    The version is the url without main.BASE_URL, people with another url get an empty one (and are rejected).
+    """
+    regions: Dict[int, str] = dict(zip(tables['region'].column('id').to_pylist(),
+                                       tables['region'].column('name').to_pylist()))
+    fasta: Dict[int, str] = _fasta(tables['sequence'])
+
+    person: pa.Table = tables['person']
+    for region_id, sequence_id, url in zip(person.column('region_id').to_pylist(),
+                                           person.column('sequence_id').to_pylist(),
+                                           person.column('url').to_pylist()):
+        version: str = url[len(main.BASE_URL):] if url and url.startswith(main.BASE_URL) else ''
+        yield [version, regions.get(region_id, ''), fasta[sequence_id]]
+
+
+def import_(db, directory: str, reject_filename: str = 'rejected.csv') -> int:
+    """
+    Loads an export() into a database of ddl.sql (or ddl_sqlite.sql) the way main.bulk_main() loads a file:
+    people whose url is loaded already are rejected, regions and sequences are reused by name and fasta, so the
+    ids of the database are kept. Named sequences (EVA, ANDREWS, WILD_TYPE_*) are inserted with their type first.
+    The caller commits.
+    :return: the number of people inserted
+    """
+    tables: Dict[str, pa.Table] = read_export(directory)
+
+    sequences: pa.Table = tables['sequence']
+    fasta: Dict[int, str] = _fasta(sequences)
+    for id_, sequence_type, name in zip(sequences.column('id').to_pylist(),
+                                        sequences.column('sequence_type').to_pylist(),
+                                        sequences.column('name').to_pylist()):
+        if name is not None:
+            db.insert_sequence(fasta[id_], type_=sequence_type, name=name)
+
+    return main.bulk_load(db, exported_records(tables), reject_filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the nrbd database to Parquet / Arrow IPC files or import them')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('directory', help='region, sequence and person files')
+    parser.add_argument('--dsn', default=main.DSN, help='PostgreSQL dsn or sqlite:///<path>')
+    parser.add_argument('--format', default='parquet', choices=list(FORMATS), help='export format')
+    parser.add_argument('--bases', default='binary', choices=['binary', 'positions'],
+                        help='export sequences as fixed_size_binary or fixed_size_list<uint8>, one item per position')
+    parser.add_argument('--reject-file', default='rejected.csv', help='where import writes people it could not load')
+    args = parser.parse_args()
+
+    start_time = time.monotonic()
+    db_ = main.open_database(args.dsn)
+    if args.command == 'export':
+        print('Exported:', export(db_, args.directory, args.format, args.bases))
+    else:
+        print('Imported:', import_(db_, args.directory, args.reject_file))
+        db_.commit()
+    print(f'Executed time: {time.monotonic() - start_time:.3f}s')
@@ -1,15 +1,314 @@
+import collections
+import csv
+import functools
+import hashlib
+import io
+import json
+import os
+import pickle
+import re
+import sys
+import tempfile
+import threading
+import time
+
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+
+# Database methods that run the queries of the others, QueryLog records the public method that called them
+QUERY_HELPERS = {'execute_query', 'select', 'insert', 'copy_rows', 'wrapper'}
+# queries that EXPLAIN ANALYZE may run again: a SELECT or a WITH query without data-modifying statements
+READ_ONLY_QUERY = re.compile(r'^\s*(SELECT|WITH)\b(?!.*\b(INSERT|UPDATE|DELETE|MERGE)\b)', re.IGNORECASE | re.DOTALL)
+
+
+class CopyStream:
+    """
+    File-like adapter that lets COPY FROM STDIN consume an iterable of rows lazily,
+    so staging a big file never holds more than one read() worth of csv in memory.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+
+    def read(self, size=-1):
+        while size < 0 or self._buffer.tell() < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._writer.writerow(row)
+
+        data = self._buffer.getvalue()
+        chunk, rest = (data, '') if size < 0 else (data[:size], data[size:])
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._buffer.write(rest)
+
+        return chunk
+
+
+class IdentityMap:
+    """
+    Bounded LRU map from a natural key (region name, (fasta, sequence_type)) to the already loaded row.
+    Only rows that exist are stored, so a miss always falls through to the database.
+    maxsize=0 disables the map.
+    """
+
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+
+        return item
+
+    def put(self, key, item):
+        if not self._maxsize:
+            return
+
+        self._items[key] = item
+        self._items.move_to_end(key)
+        if len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+class QueryCache:
+    """
+    Results of the analytics of Database by database (Database.identity()), (method, arguments) and dataset version
+    (migrations/0003): an LRU of maxsize results in memory and, with a directory, pickle files that outlive the
+    process. A result is only returned for the database and the version it was computed for, the files of other
+    versions of the same database are removed when a newer one is stored, so several databases can share the
+    directory. Results are shared by the callers, do not modify them.
+    """
+
+    def __init__(self, maxsize=1024, directory=None):
+        self._memory = IdentityMap(maxsize)
+        self._directory = directory
+        # database digest -> the version whose files are in the directory
+        self._directory_versions = {}
+        # PooledDatabase threads share the cache
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _database_digest(database):
+        return hashlib.sha256(database.encode('utf-8')).hexdigest()[:16]
+
+    def _path(self, database, version, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, f'{self._database_digest(database)}-{version}-{digest}.pickle')
+
+    def get(self, database, version, key):
+        with self._lock:
+            result = self._memory.get((database, version, key))
+        if result is not None or self._directory is None:
+            return result
+
+        try:
+            with open(self._path(database, version, key), 'rb') as file:
+                result = pickle.load(file)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            self._memory.put((database, version, key), result)
+        return result
+
+    def put(self, database, version, key, result):
+        with self._lock:
+            self._memory.put((database, version, key), result)
+            if self._directory is None:
+                return
+
+            if self._directory_versions.get(database) != version:
+                self._remove_files(self._database_digest(database), keep_version=version)
+                self._directory_versions[database] = version
+
+        # written under another name and renamed, so a concurrent get() never reads half of a file
+        fd, filename = tempfile.mkstemp(suffix='.tmp', dir=self._directory)
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename, self._path(database, version, key))
+
+    def _remove_files(self, database_digest=None, keep_version=None):
+        # the files of the other versions of one database (all databases if None)
+        for filename in os.listdir(self._directory):
+            if not filename.endswith('.pickle'):
+                continue
+            if database_digest is not None and (not filename.startswith(f'{database_digest}-')
+                                                or filename.startswith(f'{database_digest}-{keep_version}-')):
+                continue
+
+            try:
+                os.remove(os.path.join(self._directory, filename))
+            except FileNotFoundError:
+                pass  # removed by another process
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._directory is not None:
+                self._remove_files()
+                self._directory_versions.clear()
+
+
+class QueryLog:
+    """
+    Timing of the queries of Database.execute_query(): the public Database method that ran it, the query, the wall
+    time and the rows returned (affected for fetch=False). Queries slower than explain_threshold seconds are explained
+    once per query text: read-only ones with EXPLAIN (ANALYZE, BUFFERS), running again inside a savepoint that is
+    rolled back, statements that write with a plain EXPLAIN.
+    summary() aggregates the run per method, write_json() and write_csv() export it to compare runs.
+    """
+
+    CSV_FIELDS = ['method', 'calls', 'rows', 'total_s', 'mean_s', 'max_s']
+
+    def __init__(self, explain_threshold=None):
+        self.explain_threshold = explain_threshold
+        self.queries = []
+        self._explained = set()
+        self._lock = threading.Lock()
+
+    def record(self, method, query, elapsed, rows, plan=None):
+        entry = {'method': method, 'query': ' '.join(query.split()), 'seconds': elapsed, 'rows': rows}
+        if plan is not None:
+            entry['plan'] = plan
+        with self._lock:
+            self.queries.append(entry)
+
+    def should_explain(self, query, elapsed):
+        if self.explain_threshold is None or elapsed < self.explain_threshold:
+            return False
+
+        with self._lock:
+            if query in self._explained:
+                return False
+            self._explained.add(query)
+            return True
+
+    def summary(self):
+        # [{'method': ..., 'calls': ..., 'rows': ..., 'total_s': ..., 'mean_s': ..., 'max_s': ...}, ...], slowest first
+        methods = collections.OrderedDict()
+        for entry in self.queries:
+            method = methods.setdefault(entry['method'], {'method': entry['method'], 'calls': 0, 'rows': 0,
+                                                          'total_s': 0.0, 'max_s': 0.0})
+            method['calls'] += 1
+            method['rows'] += max(entry['rows'], 0)
+            method['total_s'] += entry['seconds']
+            method['max_s'] = max(method['max_s'], entry['seconds'])
+
+        for method in methods.values():
+            method['mean_s'] = method['total_s'] / method['calls']
+
+        return sorted(methods.values(), key=lambda x: x['total_s'], reverse=True)
+
+    def write_json(self, filename):
+        with open(filename, 'w', encoding='utf-8') as file:
+            json.dump({'summary': self.summary(), 'queries': self.queries}, file, indent=2, default=str)
+
+    def write_csv(self, filename):
+        with open(filename, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=self.CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.summary())
+
+    def clear(self):
+        with self._lock:
+            self.queries.clear()
+            self._explained.clear()
+
+
+def cached(method):
+    # answers an analytics method of Database from its QueryCache while the dataset version is the same
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        version = self.dataset_version() if self._cache is not None else None
+        if version is None:
+            return method(self, *args, **kwargs)
+
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        result = self._cache.get(self.identity(), version, key)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            self._cache.put(self.identity(), version, key, result)
+
+        return result
+
+    return wrapper
 
 
 class Database:
-    def __init__(self, conn, debug=False):
+    def __init__(self, conn, debug=False, identity_map_size=0, cache=None, query_log=None):
         self._conn = conn
         self._debug = debug
+        self._regions = IdentityMap(identity_map_size)
+        self._sequences = IdentityMap(identity_map_size)
+        # QueryCache of the analytics, needs dataset_version from migrations/0003_dataset_version.up.sql
+        self._cache = cache
+        # QueryLog of execute_query()
+        self._query_log = query_log
+        self._identity = None
 
     def commit(self):
         self._conn.commit()
 
+    def rollback(self):
+        # rows inserted by the rolled back transaction may be mapped already
+        self._conn.rollback()
+        self._regions.clear()
+        self._sequences.clear()
+
+    def warm_identity_map(self):
+        # one query per table instead of a lookup per row, the most recent rows win when the map is too small
+        if not self._sequences.maxsize:
+            return
+
+        sql = 'SELECT * FROM (SELECT DISTINCT ON (name) * FROM public.region ORDER BY name, id) AS regions ' \
+              'ORDER BY id DESC LIMIT %s'
+        for region in reversed(self.execute_query(sql, [self._regions.maxsize], dict_return=True)):
+            self._regions.put(region['name'], region)
+
+        sql = 'SELECT * FROM (SELECT DISTINCT ON (fasta, sequence_type) * FROM public.sequence ' \
+              'ORDER BY fasta, sequence_type, id) AS sequences ORDER BY id DESC LIMIT %s'
+        for sequence in reversed(self.execute_query(sql, [self._sequences.maxsize], dict_return=True)):
+            self._sequences.put((sequence['fasta'], sequence['sequence_type']), sequence)
+
+    def dataset_version(self):
+        # None when this transaction changed the data, its reads are not counted by the version yet
+        sql = "SELECT version, current_setting('nrbd.dataset_changed', true) FROM public.dataset_version"
+        version, changed = self.execute_query(sql, None)[0]
+        return None if changed == 'on' else version
+
+    def identity(self):
+        # the cluster (system identifier, or the server address without the privilege to read it) and the database,
+        # keys the caches that may be shared by several databases
+        if self._identity is None:
+            sql = "SELECT has_function_privilege('pg_control_system()', 'EXECUTE'), current_database(), " \
+                  "COALESCE(inet_server_addr()::text, 'local'), COALESCE(inet_server_port(), 0)"
+            readable, name, address, port = self.execute_query(sql, None)[0]
+            cluster = f'{address}:{port}'
+            if readable:
+                cluster = str(self.execute_query('SELECT system_identifier FROM pg_control_system()', None)[0][0])
+            self._identity = f'postgresql:{cluster}/{name}'
+
+        return self._identity
+
     def get_cursor(self, dict_return=False):
         return self._conn.cursor(cursor_factory=psycopg2.extras.DictCursor) if dict_return else self._conn.cursor()
 
@@ -21,23 +320,76 @@ class Database:
             print(f'DEBUG --- PARAMS: {params}')
             print(f'DEBUG --- FETCH: {fetch}, DICT RETURN: {dict_return}, EXECUTE MANY: {many}')
 
+        started = time.perf_counter()
         if many:
             cursor.executemany(query, params)
         else:
             cursor.execute(query, params)
+        result = cursor.fetchall() if fetch else cursor.rowcount
+
+        if self._query_log is not None:
+            elapsed = time.perf_counter() - started
+            plan = self._explain(query, params) if not many and self._query_log.should_explain(query, elapsed) else None
+            self._query_log.record(self._calling_method(), query, elapsed, len(result) if fetch else result, plan)
+
+        return result
+
+    def _calling_method(self):
+        # the public method of this Database that runs the query, not the helpers (select(), insert(), ...) between
+        frame = sys._getframe(2)
+        caller = frame.f_code.co_name
+        while frame is not None:
+            name = frame.f_code.co_name
+            if frame.f_locals.get('self') is self and not name.startswith('_') and name not in QUERY_HELPERS:
+                return name
+            frame = frame.f_back
+
+        return caller  # called by another object (analytics.SequenceMatrix, migrate, ...)
+
+    def _explain(self, query, params):
+        # None for statements that cannot be explained (DDL, several statements). Only read-only queries run again
+        # (ANALYZE), the others are planned without firing their triggers or consuming sequence values
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if READ_ONLY_QUERY.match(query) else 'FORMAT JSON'
+        # a failed EXPLAIN aborts the transaction back to the savepoint, in autocommit mode there is nothing to abort
+        savepoint = not self._conn.autocommit
+        saved = False
+        cursor = self.get_cursor()
+        plan = None
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT query_log_explain')
+                saved = True
+            cursor.execute(f'EXPLAIN ({options}) ' + query, params)
+            plan = cursor.fetchone()[0]
+        except psycopg2.Error:
+            plan = None
+        finally:
+            if saved:
+                cursor.execute('ROLLBACK TO SAVEPOINT query_log_explain')
+                cursor.execute('RELEASE SAVEPOINT query_log_explain')
+
+        if plan is None:
+            return None
 
-        return cursor.fetchall() if fetch else None
+        return json.loads(plan) if isinstance(plan, str) else plan
 
-    def insert(self, table, fields, values, id_=True, many=False):
+    def insert(self, table, fields, values, id_=True, many=False, on_conflict=None):
         values_len = len(values[0]) if many else len(values)
         sql = f'INSERT INTO {table} ({", ".join(fields) if len(fields) > 1 else fields[0]}) ' \
               f'VALUES ({"%s, ".join(["" for _ in range(values_len)])}%s)'
 
+        if on_conflict:
+            sql += f' ON CONFLICT {on_conflict}'
+
         if id_:
             sql += ' RETURNING id'
 
-        return self.execute_query(sql, values, many=False)[0][0] if id_ else self.execute_query(sql, values, many=many,
-                                                                                                fetch=False)
+        if not id_:
+            return self.execute_query(sql, values, many=many, fetch=False)
+
+        # None when ON CONFLICT DO NOTHING inserted nothing
+        rows = self.execute_query(sql, values, many=False)
+        return rows[0][0] if rows else None
 
     def select(self, table, filter_=None, params=None, first_=True):
         sql = f'SELECT * FROM {table} WHERE TRUE'
@@ -55,14 +407,29 @@ class Database:
             return None
 
     def get_region(self, name):
+        region = self._regions.get(name)
+        if region is not None:
+            return region
+
         table_name = 'region'
         region = self.select(table_name, ['name = %s'], (name,))
         if not region:
-            region = self.select(table_name, ['id = %s'], [self.insert(table_name, ['name'], [name])])
-
+            # a region a concurrent loader has just created is not rewritten, it is read after its commit
+            region_id = self.insert(table_name, ['name'], [name], on_conflict='(name) DO NOTHING')
+            if region_id is None:
+                region = self.select(table_name, ['name = %s'], [name])
+            else:
+                region = self.select(table_name, ['id = %s'], [region_id])
+
+        self._regions.put(name, region)
         return region
 
     def get_sequence(self, fasta_code, type_=None):
+        if type_ is not None:
+            sequence = self._sequences.get((fasta_code, type_))
+            if sequence is not None:
+                return sequence
+
         conditions = ['fasta = %s']
         values = [fasta_code]
 
@@ -70,7 +437,11 @@ class Database:
             conditions.append('sequence_type = %s')
             values.append(type_)
 
-        return self.select('sequence', conditions, values)
+        sequence = self.select('sequence', conditions, values)
+        if sequence is not None:
+            self._sequences.put((sequence['fasta'], sequence['sequence_type']), sequence)
+
+        return sequence
 
     def get_person(self, url):
         return self.select('person', ['url = %s'], [url])
@@ -109,108 +480,328 @@ class Database:
             fields.append('name')
             values.append(name)
 
-        res = self.insert('sequence', fields, values)
+        # unnamed and named sequences are unique by different keys, see ddl.sql. An existing sequence is not
+        # rewritten (its update triggers and dataset_version are left alone), it is read instead
+        conflict_target = '(sequence_type, name, fasta)' if name is not None else '(sequence_type, fasta) WHERE name IS NULL'
+        res = self.insert('sequence', fields, values, on_conflict=f'{conflict_target} DO NOTHING')
 
-        return self.select(table_name, ['id = %s'], [res])
+        if res is None:
+            conditions = ['sequence_type = %s', 'fasta = %s', 'name = %s' if name is not None else 'name IS NULL']
+            params = [0 if type_ is None else type_, fasta] + ([name] if name is not None else [])
+            sequence = self.select(table_name, conditions, params)
+        else:
+            sequence = self.select(table_name, ['id = %s'], [res])
+        self._sequences.put((fasta, sequence['sequence_type']), sequence)
+
+        return sequence
 
     def insert_person(self, region_id, sequence_id, url):
         self.insert('person', ['region_id', 'sequence_id', 'url'], [region_id, sequence_id, url])
 
+    def insert_people(self, people):
+        # people: (region_id, sequence_id, url), one statement per page instead of one per person
+        cursor = self.get_cursor()
+        sql = 'INSERT INTO person (region_id, sequence_id, url) VALUES %s'
+
+        if self._debug:
+            print(f'DEBUG --- QUERY: {sql}')
+            print(f'DEBUG --- ROWS: {len(people)}')
+
+        psycopg2.extras.execute_values(cursor, sql, people, page_size=1000)
+
+    def get_loaded_urls(self):
+        return {x[0] for x in self.execute_query('SELECT url FROM public.person WHERE url IS NOT NULL', None)}
+
+    def get_checkpoint(self, source_hash):
+        checkpoint = self.select('ingest_checkpoint', ['source_hash = %s'], [source_hash])
+        return checkpoint['record_no'] if checkpoint else 0
+
+    def save_checkpoint(self, source_hash, filename, record_no):
+        sql = """
+            INSERT INTO public.ingest_checkpoint (source_hash, filename, record_no)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (source_hash) DO UPDATE SET filename   = EXCLUDED.filename,
+                                                    record_no  = EXCLUDED.record_no,
+                                                    updated_at = now()
+        """
+        self.execute_query(sql, [source_hash, filename, record_no], fetch=False)
+
+    def get_region_haplotypes(self):
+        """
+        (snapshot, region, fasta, people) of the people with a crawled sequence (sequence_type = 0) and a region,
+        snapshot is the pg_current_snapshot() they are read with (one row with region None if there are none)
+        """
+        sql = """
+            SELECT current.snapshot, haplotype.region, haplotype.fasta, haplotype.count
+            FROM (SELECT pg_current_snapshot()::text AS snapshot) AS current
+                     LEFT JOIN (SELECT public.region.name AS region, public.sequence.fasta, COUNT(*) AS count
+                                FROM (public.person INNER JOIN public.region ON public.person.region_id = public.region.id)
+                                         INNER JOIN public.sequence ON public.person.sequence_id = public.sequence.id
+                                WHERE public.sequence.sequence_type = 0
+                                GROUP BY public.region.name, public.sequence.fasta) AS haplotype ON TRUE
+        """
+        return self.execute_query(sql, None)
+
+    def get_person_changes(self, snapshot, applied_snapshot):
+        """
+        (applied, version, person_id, region, sequence_type, fasta) in order, see person_change in ddl.sql: the
+        changes visible in snapshot of the people that have one that is not visible in applied_snapshot, applied
+        tells if applied_snapshot sees the change
+        """
+        sql = """
+            WITH changed AS (SELECT DISTINCT person_id
+                             FROM public.person_change
+                             WHERE xid >= pg_snapshot_xmin(%s::pg_snapshot)
+                               AND NOT pg_visible_in_snapshot(xid, %s::pg_snapshot)
+                               AND pg_visible_in_snapshot(xid, %s::pg_snapshot))
+            SELECT pg_visible_in_snapshot(xid, %s::pg_snapshot), version, person_id, region, sequence_type, fasta
+            FROM public.person_change
+            WHERE person_id IN (SELECT person_id FROM changed)
+              AND pg_visible_in_snapshot(xid, %s::pg_snapshot)
+            ORDER BY version
+        """
+        return self.execute_query(sql, [applied_snapshot, applied_snapshot, snapshot, applied_snapshot, snapshot])
+
+    def get_pair_histogram(self, region):
+        return self.select('pair_histogram', ['region = %s'], [region])
+
+    def save_pair_histogram(self, region, snapshot, frequencies):
+        # a report that started earlier does not replace the histogram of a later one
+        sql = """
+            INSERT INTO public.pair_histogram (region, snapshot, frequencies)
+            VALUES (%s, %s::pg_snapshot, %s)
+            ON CONFLICT (region) DO UPDATE SET snapshot    = EXCLUDED.snapshot,
+                                               frequencies = EXCLUDED.frequencies
+            WHERE pg_snapshot_xmax(pair_histogram.snapshot) <= pg_snapshot_xmax(EXCLUDED.snapshot)
+        """
+        self.execute_query(sql, [region, snapshot, frequencies], fetch=False)
+
+    def copy_rows(self, table, fields, rows):
+        # the rows hold values, not NULLs: an empty field is loaded as an empty string, as the per-row inserts do
+        cursor = self.get_cursor()
+        columns = ", ".join(fields)
+        sql = f'COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL ({columns}))'
+
+        if self._debug:
+            print(f'DEBUG --- COPY: {sql}')
+
+        cursor.copy_expert(sql, CopyStream(rows))
+        return cursor.rowcount
+
+    def create_person_staging(self):
+        self.execute_query(
+            'CREATE TEMPORARY TABLE person_staging (record_no integer primary key, version text not null, '
+            'region text not null, fasta text not null, url text not null) ON COMMIT DROP',
+            None, fetch=False
+        )
+
+    def stage_people(self, rows):
+        # rows: (record_no, version, region, fasta, url)
+        staged = self.copy_rows('person_staging', ['record_no', 'version', 'region', 'fasta', 'url'], rows)
+        self.execute_query('ANALYZE person_staging', None, fetch=False)
+        return staged
+
+    def reject_staged_people(self):
+        # removes rows the per-row path would fail on and returns them as (record_no, version, region, fasta, reason)
+        sql = """
+            WITH ranked AS (SELECT record_no, ROW_NUMBER() OVER (PARTITION BY url ORDER BY record_no) AS url_rank
+                            FROM person_staging)
+            DELETE FROM person_staging
+            USING ranked
+            WHERE person_staging.record_no = ranked.record_no
+              AND (url_rank > 1 OR EXISTS (SELECT 1 FROM public.person WHERE public.person.url = person_staging.url))
+            RETURNING person_staging.record_no, version, region, fasta,
+                      CASE WHEN url_rank > 1 THEN 'duplicate url in file' ELSE 'url is already loaded' END
+        """
+        return sorted(self.execute_query(sql, None))
+
+    def insert_staged_regions(self):
+        # new regions get ids in order of their first appearance, same as get_region() row by row
+        sql = """
+            INSERT INTO public.region (name)
+            SELECT region
+            FROM person_staging
+            WHERE NOT EXISTS (SELECT 1 FROM public.region WHERE public.region.name = person_staging.region)
+            GROUP BY region
+            ORDER BY MIN(record_no)
+        """
+        self.execute_query(sql, None, fetch=False)
+
+    def insert_staged_sequences(self):
+        sql = """
+            INSERT INTO public.sequence (fasta)
+            SELECT fasta
+            FROM person_staging
+            WHERE NOT EXISTS (SELECT 1
+                              FROM public.sequence
+                              WHERE public.sequence.fasta = person_staging.fasta
+                                AND public.sequence.sequence_type = 0)
+            GROUP BY fasta
+            ORDER BY MIN(record_no)
+        """
+        self.execute_query(sql, None, fetch=False)
+
+    def insert_staged_people(self):
+        sql = """
+            INSERT INTO public.person (region_id, sequence_id, url)
+            SELECT region_ids.id, sequence_ids.id, url
+            FROM (person_staging
+                INNER JOIN (SELECT name, MIN(id) AS id FROM public.region GROUP BY name) AS region_ids
+                           ON region_ids.name = person_staging.region)
+                     INNER JOIN (SELECT fasta, MIN(id) AS id
+                                 FROM public.sequence
+                                 WHERE sequence_type = 0
+                                 GROUP BY fasta) AS sequence_ids ON sequence_ids.fasta = person_staging.fasta
+            ORDER BY record_no
+        """
+        return self.execute_query(sql, None, fetch=False)
+
+    @cached
     def diff_between_base_and_wild(self, base_name, wild_name):
+        # no rows when the sequences are equal, see hamming_distance in migrations/0002_hamming_distance.up.sql
         params = [base_name, wild_name]
         sql = """
-            WITH base_positions AS (SELECT position AS base_pos, value AS eva_value
-              FROM public.sequence INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id
-              WHERE name = %s)
-            SELECT COUNT(*)
-            FROM (public.sequence INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id) 
-            INNER JOIN base_positions ON base_pos = public.fasta_position.position
-            WHERE value != eva_value AND public.sequence.name = %s
-            GROUP BY fasta;
+            SELECT diff_count
+            FROM (SELECT public.hamming_distance(base, wild) AS diff_count
+                  FROM public.sequence AS base CROSS JOIN public.sequence AS wild
+                  WHERE base.name = %s AND wild.name = %s) AS wild_diff
+            WHERE diff_count > 0;
         """
         return self.execute_query(sql, params, dict_return=True)
 
-    def polim(self, base_name, region):
-        sql = f"WITH variables_count AS (SELECT position, COUNT(DISTINCT(value)) AS val_num " \
-              f"FROM ((public.sequence INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id) " \
-              f"INNER JOIN public.person ON public.person.sequence_id = public.sequence.id)  " \
-              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-              f"WHERE sequence_type=0 OR public.sequence.name=%s "
-        params = [base_name]
+    def _allele_counts(self, region):
+        # allele_count of the region, summed over the regions for ALL, see allele_count in ddl.sql
+        sql = "WITH letter_on_position_count AS (SELECT position, value, SUM(count) AS letter_count " \
+              "FROM public.allele_count INNER JOIN public.region ON public.region.id = public.allele_count.region_id "
 
+        params = []
         if region != 'ALL':
             params.append(region)
-            sql += "AND public.region.name = %s "
+            sql += "WHERE public.region.name = %s "
+
+        sql += "GROUP BY position, value) "
+        return sql, params
+
+    @cached
+    def allele_counts(self, region):
+        # [(position, value, count), ...]: how many people of the region have the value on the position
+        sql, params = self._allele_counts(region)
+        sql += "SELECT position, value, letter_count::bigint " \
+               "FROM letter_on_position_count " \
+               "ORDER BY position, value COLLATE \"C\";"
 
-        sql += f"GROUP BY position) " \
-               f"SELECT COUNT(*) " \
-               f"FROM variables_count " \
-               f"WHERE val_num > 1;"
+        return self.execute_query(sql, params)
+
+    @cached
+    def polim(self, base_name, region):
+        # positions where the people of the region have more than one value, base_name is not used
+        # since allele_count holds the crawled sequences only
+        sql, params = self._allele_counts(region)
+        sql += "SELECT COUNT(*) " \
+               "FROM (SELECT position FROM letter_on_position_count GROUP BY position HAVING COUNT(*) > 1) AS variable;"
 
         return self.execute_query(sql, params, dict_return=True)
 
     def calculate_wild(self, region):
-        try:
-            sql = f"WITH letter_on_position_count AS (SELECT position, value, COUNT(value) AS letter_count " \
-                  f"FROM ((public.sequence INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id) " \
-                  f"INNER JOIN public.person ON public.person.sequence_id = public.sequence.id)  " \
-                  f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-                  f"WHERE sequence_type = 0 "
-
-            params = [region]
-            if region != 'ALL':
-                sql += "AND public.region.name = %s "
-
-            sql += f"GROUP BY position, value), " \
-                  f"max_count AS (SELECT position, MAX(letter_count) AS max_count " \
-                  f"FROM letter_on_position_count " \
-                  f"GROUP BY position " \
-                  f"ORDER BY position), " \
-                  f"most_popular AS (SELECT letter_on_position_count.position, value " \
-                  f"FROM letter_on_position_count INNER JOIN max_count ON letter_on_position_count.position = max_count.position " \
-                  f"WHERE letter_count = max_count " \
-                  f"ORDER BY position) " \
-                  f"INSERT INTO public.sequence (sequence_type, name, fasta) VALUES (2, 'WILD_TYPE_{region}', (SELECT STRING_AGG ( " \
-                  f"most_popular.value, '' " \
-                  f"ORDER BY most_popular.position ) most_popular " \
-                  f"FROM most_popular LIMIT 1) );"
-
-            self.execute_query(sql, params, fetch=False, dict_return=True)
-        except psycopg2.errors.UniqueViolation:
-            pass
+        sql, params = self._allele_counts(region)
 
-    def distribution(self, base_name, region):
+        # the smallest value (in byte order) wins a tie, as in analytics.SequenceMatrix.wild_types()
+        sql += f"SELECT STRING_AGG(most_popular.value, '' ORDER BY most_popular.position) " \
+               f"FROM (SELECT DISTINCT ON (position) position, value " \
+               f"FROM letter_on_position_count " \
+               f"ORDER BY position, letter_count DESC, value COLLATE \"C\") AS most_popular;"
+
+        fasta = self.execute_query(sql, params)[0][0]
+        if fasta is not None:
+            self.upsert_wild_types({region: fasta})
+
+    def upsert_wild_types(self, wild_types):
+        # {region: fasta} -> WILD_TYPE_<region> sequences in one statement, a changed wild type replaces the old row
+        cursor = self.get_cursor()
         sql = """
-WITH base_positions AS (SELECT position AS base_pos, value AS eva_value
-                        FROM public.sequence
-                                 INNER JOIN public.fasta_position
-                                            ON public.sequence.id = public.fasta_position.sequence_id
-                        WHERE name = %s),
-     diff_count AS (SELECT public.person.id, COUNT(*) AS d_count
-                    FROM (((public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) INNER JOIN public.region ON public.person.region_id = public.region.id)
-                        INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id)
-                             INNER JOIN base_positions ON base_pos = public.fasta_position.position
-                    WHERE value != eva_value
-                      AND sequence_type = 0
+            WITH wild_type (name, fasta) AS (VALUES %s),
+                 outdated AS (DELETE FROM public.sequence USING wild_type
+                              WHERE public.sequence.sequence_type = 2
+                                AND public.sequence.name = wild_type.name
+                                AND public.sequence.fasta != wild_type.fasta)
+            INSERT INTO public.sequence (sequence_type, name, fasta)
+            SELECT 2, name, fasta
+            FROM wild_type
+            ON CONFLICT (sequence_type, name, fasta) DO NOTHING
         """
+        rows = [(f'WILD_TYPE_{region}', fasta) for region, fasta in wild_types.items()]
+        if not rows:
+            return
+
+        if self._debug:
+            print(f'DEBUG --- QUERY: {sql}')
+            print(f'DEBUG --- ROWS: {len(rows)}')
+
+        psycopg2.extras.execute_values(cursor, sql, rows, page_size=len(rows))
+
+    def _diff_to_base(self, base_name, region):
+        # common CTEs of the distribution queries, fasta_diff(id, diff_num) holds the number of positions
+        # where every person of the region differs from the base sequence, see person_reference_diff in ddl.sql
+        sql = """
+WITH fasta_diff AS (SELECT public.person.id, COALESCE(diff_count, 0) AS diff_num
+                    FROM (public.person INNER JOIN public.region ON public.person.region_id = public.region.id)
+                             LEFT JOIN public.person_reference_diff
+                                       ON public.person.id = public.person_reference_diff.person_id
+                                           AND public.person_reference_diff.reference_id IN (SELECT id
+                                                                                            FROM public.sequence
+                                                                                            WHERE name = %s) """
         params = [base_name]
 
         if region != 'ALL':
             params.append(region)
-            sql += "AND public.region.name = %s "
+            sql += " WHERE public.region.name = %s "
 
         sql += """
-                GROUP BY public.person.id),
-                fasta_diff AS (SELECT public.person.id, COALESCE(d_count, 0) AS diff_num
-                FROM ((public.person  INNER JOIN public.region ON public.person.region_id = public.region.id) 
-                      LEFT JOIN diff_count ON public.person.id = diff_count.id)  """
+        )"""
+
+        return sql, params
 
+    def _diff_each_to_each(self, region):
+        # common CTEs of the "each to each" queries, fasta_diff(diff_num, pair_count) holds the number of
+        # different positions for every pair of distinct sequences (haplotypes) of the region, weighted by the
+        # number of pairs of their people, and 0 for the pairs of people that share a sequence
+        sql = f"WITH sequence_with_duplicate AS ( " \
+              f"SELECT public.person.id, sequence_id, fasta, sequence_type " \
+              f"FROM (public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) " \
+              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
+              f"WHERE sequence_type = 0 "
+        params = []
         if region != 'ALL':
             params.append(region)
-            sql += " WHERE public.region.name = %s "
+            sql += 'AND public.region.name = %s '
+        sql += """
+                    ),
+        haplotype AS (SELECT sequence_id, COUNT(*) AS person_count
+        FROM sequence_with_duplicate
+        GROUP BY sequence_id),
+
+        sequence_pairs AS (SELECT haplotype_1.sequence_id AS sequence_id_1, haplotype_2.sequence_id AS sequence_id_2,
+          haplotype_1.person_count * haplotype_2.person_count AS pair_count
+        FROM haplotype AS haplotype_1 INNER JOIN haplotype AS haplotype_2 ON haplotype_1.sequence_id < haplotype_2.sequence_id),
+
+        diff_count AS (SELECT pair_count, public.hamming_distance(sequence_1, sequence_2) AS d_count
+        FROM (sequence_pairs INNER JOIN public.sequence AS sequence_1 ON sequence_pairs.sequence_id_1 = sequence_1.id)
+        INNER JOIN public.sequence AS sequence_2 ON sequence_pairs.sequence_id_2 = sequence_2.id),
 
-        sql += """ 
-        ), rosp AS (SELECT diff_num, COUNT(*) AS frequency
+        fasta_diff AS (SELECT d_count AS diff_num, pair_count
+        FROM diff_count
+        UNION ALL
+        SELECT 0 AS diff_num, person_count * (person_count - 1) / 2 AS pair_count
+        FROM haplotype
+        WHERE person_count > 1)"""
+
+        return sql, params
+
+    @cached
+    def distribution(self, base_name, region):
+        sql, params = self._diff_to_base(base_name, region)
+        sql += """,
+     rosp AS (SELECT diff_num, COUNT(*) AS frequency
               FROM fasta_diff
               GROUP BY diff_num
               ORDER BY diff_num),
@@ -222,38 +813,10 @@ FROM rosp
 
         return self.execute_query(sql, params, dict_return=True)
 
+    @cached
     def math_expectation(self, base_name, region):
-        sql = """
-WITH base_positions AS (SELECT position AS base_pos, value AS eva_value
-                        FROM public.sequence
-                                 INNER JOIN public.fasta_position
-                                            ON public.sequence.id = public.fasta_position.sequence_id
-                        WHERE name = %s),
-     diff_count AS (SELECT public.person.id, COUNT(*) AS d_count
-                    FROM (((public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) INNER JOIN public.region ON public.person.region_id = public.region.id)
-                        INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id)
-                             INNER JOIN base_positions ON base_pos = public.fasta_position.position
-                    WHERE value != eva_value
-                      AND sequence_type = 0
-        """
-        params = [base_name]
-
-        if region != 'ALL':
-            params.append(region)
-            sql += "AND public.region.name = %s "
-
-        sql += """
-                GROUP BY public.person.id),
-                fasta_diff AS (SELECT public.person.id, COALESCE(d_count, 0) AS diff_num
-                FROM ((public.person  INNER JOIN public.region ON public.person.region_id = public.region.id) 
-                      LEFT JOIN diff_count ON public.person.id = diff_count.id)  """
-
-        if region != 'ALL':
-            params.append(region)
-            sql += " WHERE public.region.name = %s "
-
-        sql += """ 
-        ), 
+        sql, params = self._diff_to_base(base_name, region)
+        sql += """,
      rosp AS (SELECT diff_num, COUNT(*) AS frequency
               FROM fasta_diff
               GROUP BY diff_num
@@ -268,38 +831,10 @@ FROM probability_rosp
 
         return self.execute_query(sql, params, dict_return=True)
 
+    @cached
     def std(self, base_name, region):
-        sql = """
-WITH base_positions AS (SELECT position AS base_pos, value AS eva_value
-                        FROM public.sequence
-                                 INNER JOIN public.fasta_position
-                                            ON public.sequence.id = public.fasta_position.sequence_id
-                        WHERE name = %s),
-     diff_count AS (SELECT public.person.id, COUNT(*) AS d_count
-                    FROM (((public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) INNER JOIN public.region ON public.person.region_id = public.region.id)
-                        INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id)
-                             INNER JOIN base_positions ON base_pos = public.fasta_position.position
-                    WHERE value != eva_value
-                      AND sequence_type = 0
-        """
-        params = [base_name]
-
-        if region != 'ALL':
-            params.append(region)
-            sql += "AND public.region.name = %s "
-
-        sql += """
-                GROUP BY public.person.id),
-                fasta_diff AS (SELECT public.person.id, COALESCE(d_count, 0) AS diff_num
-                FROM ((public.person  INNER JOIN public.region ON public.person.region_id = public.region.id) 
-                      LEFT JOIN diff_count ON public.person.id = diff_count.id)  """
-
-        if region != 'ALL':
-            params.append(region)
-            sql += " WHERE public.region.name = %s "
-
-        sql += """ 
-        ), 
+        sql, params = self._diff_to_base(base_name, region)
+        sql += """,
      rosp AS (SELECT diff_num, COUNT(*) AS frequency
               FROM fasta_diff
               GROUP BY diff_num
@@ -317,38 +852,10 @@ FROM probability_rosp
 
         return self.execute_query(sql, params, dict_return=True)
 
+    @cached
     def mode(self, base_name, region):
-        sql = """
-WITH base_positions AS (SELECT position AS base_pos, value AS eva_value
-                        FROM public.sequence
-                                 INNER JOIN public.fasta_position
-                                            ON public.sequence.id = public.fasta_position.sequence_id
-                        WHERE name = %s),
-     diff_count AS (SELECT public.person.id, COUNT(*) AS d_count
-                    FROM (((public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) INNER JOIN public.region ON public.person.region_id = public.region.id)
-                        INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id)
-                             INNER JOIN base_positions ON base_pos = public.fasta_position.position
-                    WHERE value != eva_value
-                      AND sequence_type = 0
-        """
-        params = [base_name]
-
-        if region != 'ALL':
-            params.append(region)
-            sql += "AND public.region.name = %s "
-
-        sql += """
-                GROUP BY public.person.id),
-                fasta_diff AS (SELECT public.person.id, COALESCE(d_count, 0) AS diff_num
-                FROM ((public.person  INNER JOIN public.region ON public.person.region_id = public.region.id) 
-                      LEFT JOIN diff_count ON public.person.id = diff_count.id)  """
-
-        if region != 'ALL':
-            params.append(region)
-            sql += " WHERE public.region.name = %s "
-
-        sql += """ 
-        ), 
+        sql, params = self._diff_to_base(base_name, region)
+        sql += """,
      rosp AS (SELECT diff_num, COUNT(*) AS frequency
               FROM fasta_diff
               GROUP BY diff_num
@@ -365,38 +872,10 @@ WHERE frequency = (SELECT MAX(frequency)
 
         return self.execute_query(sql, params, dict_return=True)
 
+    @cached
     def min_value(self, base_name, region):
-        sql = """
-WITH base_positions AS (SELECT position AS base_pos, value AS eva_value
-                        FROM public.sequence
-                                 INNER JOIN public.fasta_position
-                                            ON public.sequence.id = public.fasta_position.sequence_id
-                        WHERE name = %s),
-     diff_count AS (SELECT public.person.id, COUNT(*) AS d_count
-                    FROM (((public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) INNER JOIN public.region ON public.person.region_id = public.region.id)
-                        INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id)
-                             INNER JOIN base_positions ON base_pos = public.fasta_position.position
-                    WHERE value != eva_value
-                      AND sequence_type = 0
-        """
-        params = [base_name]
-
-        if region != 'ALL':
-            params.append(region)
-            sql += "AND public.region.name = %s "
-
-        sql += """
-                GROUP BY public.person.id),
-                fasta_diff AS (SELECT public.person.id, COALESCE(d_count, 0) AS diff_num
-                FROM ((public.person  INNER JOIN public.region ON public.person.region_id = public.region.id) 
-                      LEFT JOIN diff_count ON public.person.id = diff_count.id)  """
-
-        if region != 'ALL':
-            params.append(region)
-            sql += " WHERE public.region.name = %s "
-
-        sql += """ 
-        ), 
+        sql, params = self._diff_to_base(base_name, region)
+        sql += """,
      rosp AS (SELECT diff_num, COUNT(*) AS frequency
               FROM fasta_diff
               GROUP BY diff_num
@@ -411,38 +890,10 @@ FROM probability_rosp
 
         return self.execute_query(sql, params, dict_return=True)
 
+    @cached
     def max_value(self, base_name, region):
-        sql = """
-WITH base_positions AS (SELECT position AS base_pos, value AS eva_value
-                        FROM public.sequence
-                                 INNER JOIN public.fasta_position
-                                            ON public.sequence.id = public.fasta_position.sequence_id
-                        WHERE name = %s),
-     diff_count AS (SELECT public.person.id, COUNT(*) AS d_count
-                    FROM (((public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) INNER JOIN public.region ON public.person.region_id = public.region.id)
-                        INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id)
-                             INNER JOIN base_positions ON base_pos = public.fasta_position.position
-                    WHERE value != eva_value
-                      AND sequence_type = 0
-        """
-        params = [base_name]
-
-        if region != 'ALL':
-            params.append(region)
-            sql += "AND public.region.name = %s "
-
-        sql += """
-                GROUP BY public.person.id),
-                fasta_diff AS (SELECT public.person.id, COALESCE(d_count, 0) AS diff_num
-                FROM ((public.person  INNER JOIN public.region ON public.person.region_id = public.region.id) 
-                      LEFT JOIN diff_count ON public.person.id = diff_count.id)  """
-
-        if region != 'ALL':
-            params.append(region)
-            sql += " WHERE public.region.name = %s "
-
-        sql += """ 
-        ), 
+        sql, params = self._diff_to_base(base_name, region)
+        sql += """,
      rosp AS (SELECT diff_num, COUNT(*) AS frequency
               FROM fasta_diff
               GROUP BY diff_num
@@ -457,38 +908,10 @@ FROM probability_rosp
 
         return self.execute_query(sql, params, dict_return=True)
 
+    @cached
     def coeff(self, base_name, region):
-        sql = """
-WITH base_positions AS (SELECT position AS base_pos, value AS eva_value
-                        FROM public.sequence
-                                 INNER JOIN public.fasta_position
-                                            ON public.sequence.id = public.fasta_position.sequence_id
-                        WHERE name = %s),
-     diff_count AS (SELECT public.person.id, COUNT(*) AS d_count
-                    FROM (((public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) INNER JOIN public.region ON public.person.region_id = public.region.id)
-                        INNER JOIN public.fasta_position ON public.sequence.id = public.fasta_position.sequence_id)
-                             INNER JOIN base_positions ON base_pos = public.fasta_position.position
-                    WHERE value != eva_value
-                      AND sequence_type = 0
-        """
-        params = [base_name]
-
-        if region != 'ALL':
-            params.append(region)
-            sql += "AND public.region.name = %s "
-
-        sql += """
-                GROUP BY public.person.id),
-                fasta_diff AS (SELECT public.person.id, COALESCE(d_count, 0) AS diff_num
-                FROM ((public.person  INNER JOIN public.region ON public.person.region_id = public.region.id) 
-                      LEFT JOIN diff_count ON public.person.id = diff_count.id)  """
-
-        if region != 'ALL':
-            params.append(region)
-            sql += " WHERE public.region.name = %s "
-
-        sql += """ 
-        ), 
+        sql, params = self._diff_to_base(base_name, region)
+        sql += """,
      rosp AS (SELECT diff_num, COUNT(*) AS frequency
               FROM fasta_diff
               GROUP BY diff_num
@@ -507,39 +930,17 @@ SELECT (SELECT standart_dev FROM standart_deviation) / (SELECT math_expct FROM m
 
         return self.execute_query(sql, params, dict_return=True)
 
+    @cached
     def distribution_each_to_each(self, region):
-        sql = f"WITH sequence_with_duplicate AS ( " \
-              f"SELECT public.person.id, sequence_id, fasta, sequence_type " \
-              f"FROM (public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) " \
-              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-              f"WHERE sequence_type = 0 "
-        params = []
-        if region != 'ALL':
-            params.append(region)
-            sql += 'AND public.region.name = %s '
-        sql += """
-                    ),
-        help_table AS (SELECT sequence_1.id AS id_1, sequence_2.id AS id_2, 
-          sequence_1.sequence_id AS sequence_id_1, sequence_2.sequence_id AS sequence_id_2, 
-          sequence_1.fasta AS fasta_1, sequence_2.fasta AS fasta_2
-        FROM sequence_with_duplicate AS sequence_1, sequence_with_duplicate AS sequence_2
-        WHERE sequence_1.id != sequence_2.id AND sequence_1.sequence_type = 0 AND sequence_2.sequence_type = 0),
-        
-        diff_count AS (SELECT help_table.id_1 AS id_1, help_table.id_2 AS id_2, COUNT(*) AS d_count
-        FROM (help_table INNER JOIN public.fasta_position AS fasta_position_1 ON help_table.sequence_id_1 = fasta_position_1.sequence_id) 
-        INNER JOIN public.fasta_position AS fasta_position_2 ON help_table.sequence_id_2 = fasta_position_2.sequence_id
-        WHERE fasta_position_1.position = fasta_position_2.position AND fasta_position_1.value != fasta_position_2.value
-        GROUP BY help_table.id_1, help_table.id_2),
-        
-        fasta_diff AS (SELECT COALESCE(d_count, 0) AS diff_num
-        FROM help_table LEFT JOIN diff_count ON (help_table.id_1 = diff_count.id_1 AND help_table.id_2 = diff_count.id_2)),
-        
-        rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
+        sql, params = self._diff_each_to_each(region)
+        sql += """,
+
+        rosp AS (SELECT diff_num, SUM(pair_count)::bigint AS frequency
         FROM fasta_diff
         GROUP BY diff_num
         ORDER BY diff_num),
-        
-        
+
+
         frequency_summ AS (SELECT SUM(frequency) AS f_s
         FROM rosp)
         SELECT diff_num, frequency, (frequency/(SELECT f_s FROM frequency_summ)) AS p
@@ -549,34 +950,12 @@ SELECT (SELECT standart_dev FROM standart_deviation) / (SELECT math_expct FROM m
         res = self.execute_query(sql, params, dict_return=True)
         return res
 
+    @cached
     def math_expectation_each_to_each(self, region):
-        sql = f"WITH sequence_with_duplicate AS ( " \
-              f"SELECT public.person.id, sequence_id, fasta, sequence_type " \
-              f"FROM (public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) " \
-              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-              f"WHERE sequence_type = 0 "
-        params = []
-        if region != 'ALL':
-            params.append(region)
-            sql += 'AND public.region.name = %s '
-        sql += """
-                            ),
-                help_table AS (SELECT sequence_1.id AS id_1, sequence_2.id AS id_2, 
-                  sequence_1.sequence_id AS sequence_id_1, sequence_2.sequence_id AS sequence_id_2, 
-                  sequence_1.fasta AS fasta_1, sequence_2.fasta AS fasta_2
-                FROM sequence_with_duplicate AS sequence_1, sequence_with_duplicate AS sequence_2
-                WHERE sequence_1.id != sequence_2.id AND sequence_1.sequence_type = 0 AND sequence_2.sequence_type = 0),
-
-                diff_count AS (SELECT help_table.id_1 AS id_1, help_table.id_2 AS id_2, COUNT(*) AS d_count
-                FROM (help_table INNER JOIN public.fasta_position AS fasta_position_1 ON help_table.sequence_id_1 = fasta_position_1.sequence_id) 
-                INNER JOIN public.fasta_position AS fasta_position_2 ON help_table.sequence_id_2 = fasta_position_2.sequence_id
-                WHERE fasta_position_1.position = fasta_position_2.position AND fasta_position_1.value != fasta_position_2.value
-                GROUP BY help_table.id_1, help_table.id_2),
-
-                fasta_diff AS (SELECT COALESCE(d_count, 0) AS diff_num
-                FROM help_table LEFT JOIN diff_count ON (help_table.id_1 = diff_count.id_1 AND help_table.id_2 = diff_count.id_2)),
-
-            rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
+        sql, params = self._diff_each_to_each(region)
+        sql += """,
+
+            rosp AS (SELECT diff_num, SUM(pair_count)::bigint AS frequency
             FROM fasta_diff
             GROUP BY diff_num
             ORDER BY diff_num),
@@ -592,35 +971,12 @@ SELECT (SELECT standart_dev FROM standart_deviation) / (SELECT math_expct FROM m
         res = self.execute_query(sql, params, dict_return=True)
         return res
 
+    @cached
     def std_each_to_each(self, region):
-        sql = f"WITH sequence_with_duplicate AS ( " \
-              f"SELECT public.person.id, sequence_id, fasta, sequence_type " \
-              f"FROM (public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) " \
-              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-              f"WHERE sequence_type = 0 "
-        params = []
-        if region != 'ALL':
-            params.append(region)
-            sql += 'AND public.region.name = %s '
-        sql += """
-                            ),
-                help_table AS (SELECT sequence_1.id AS id_1, sequence_2.id AS id_2, 
-                  sequence_1.sequence_id AS sequence_id_1, sequence_2.sequence_id AS sequence_id_2, 
-                  sequence_1.fasta AS fasta_1, sequence_2.fasta AS fasta_2
-                FROM sequence_with_duplicate AS sequence_1, sequence_with_duplicate AS sequence_2
-                WHERE sequence_1.id != sequence_2.id AND sequence_1.sequence_type = 0 AND sequence_2.sequence_type = 0),
-
-                diff_count AS (SELECT help_table.id_1 AS id_1, help_table.id_2 AS id_2, COUNT(*) AS d_count
-                FROM (help_table INNER JOIN public.fasta_position AS fasta_position_1 ON help_table.sequence_id_1 = fasta_position_1.sequence_id) 
-                INNER JOIN public.fasta_position AS fasta_position_2 ON help_table.sequence_id_2 = fasta_position_2.sequence_id
-                WHERE fasta_position_1.position = fasta_position_2.position AND fasta_position_1.value != fasta_position_2.value
-                GROUP BY help_table.id_1, help_table.id_2),
+        sql, params = self._diff_each_to_each(region)
+        sql += """,
 
-                fasta_diff AS (SELECT COALESCE(d_count, 0) AS diff_num
-                FROM help_table LEFT JOIN diff_count ON (help_table.id_1 = diff_count.id_1 AND help_table.id_2 = diff_count.id_2)),
-
-
-            rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
+            rosp AS (SELECT diff_num, SUM(pair_count)::bigint AS frequency
             FROM fasta_diff
             GROUP BY diff_num
             ORDER BY diff_num),
@@ -638,34 +994,12 @@ SELECT (SELECT standart_dev FROM standart_deviation) / (SELECT math_expct FROM m
         res = self.execute_query(sql, params, dict_return=True)
         return res
 
+    @cached
     def mode_each_to_each(self, region):
-        sql = f"WITH sequence_with_duplicate AS ( " \
-              f"SELECT public.person.id, sequence_id, fasta, sequence_type " \
-              f"FROM (public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) " \
-              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-              f"WHERE sequence_type = 0 "
-        params = []
-        if region != 'ALL':
-            params.append(region)
-            sql += 'AND public.region.name = %s '
-        sql += """
-                            ),
-                help_table AS (SELECT sequence_1.id AS id_1, sequence_2.id AS id_2, 
-                  sequence_1.sequence_id AS sequence_id_1, sequence_2.sequence_id AS sequence_id_2, 
-                  sequence_1.fasta AS fasta_1, sequence_2.fasta AS fasta_2
-                FROM sequence_with_duplicate AS sequence_1, sequence_with_duplicate AS sequence_2
-                WHERE sequence_1.id != sequence_2.id AND sequence_1.sequence_type = 0 AND sequence_2.sequence_type = 0),
-
-                diff_count AS (SELECT help_table.id_1 AS id_1, help_table.id_2 AS id_2, COUNT(*) AS d_count
-                FROM (help_table INNER JOIN public.fasta_position AS fasta_position_1 ON help_table.sequence_id_1 = fasta_position_1.sequence_id) 
-                INNER JOIN public.fasta_position AS fasta_position_2 ON help_table.sequence_id_2 = fasta_position_2.sequence_id
-                WHERE fasta_position_1.position = fasta_position_2.position AND fasta_position_1.value != fasta_position_2.value
-                GROUP BY help_table.id_1, help_table.id_2),
-
-                fasta_diff AS (SELECT COALESCE(d_count, 0) AS diff_num
-                FROM help_table LEFT JOIN diff_count ON (help_table.id_1 = diff_count.id_1 AND help_table.id_2 = diff_count.id_2)),
-
-rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
+        sql, params = self._diff_each_to_each(region)
+        sql += """,
+
+            rosp AS (SELECT diff_num, SUM(pair_count)::bigint AS frequency
             FROM fasta_diff
             GROUP BY diff_num
             ORDER BY diff_num),
@@ -674,7 +1008,7 @@ rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
             probability_rosp AS (SELECT diff_num, frequency, (frequency/(SELECT f_s FROM frequency_summ)) AS p
             FROM rosp)
             SELECT diff_num, frequency , p
-            FROM probability_rosp 
+            FROM probability_rosp
             WHERE p = (SELECT MAX(p)
             FROM probability_rosp);
 
@@ -683,34 +1017,12 @@ rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
         res = self.execute_query(sql, params, dict_return=True)
         return res
 
+    @cached
     def min_value_each_to_each(self, region):
-        sql = f"WITH sequence_with_duplicate AS ( " \
-              f"SELECT public.person.id, sequence_id, fasta, sequence_type " \
-              f"FROM (public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) " \
-              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-              f"WHERE sequence_type = 0 "
-        params = []
-        if region != 'ALL':
-            params.append(region)
-            sql += 'AND public.region.name = %s '
-        sql += """
-                            ),
-                help_table AS (SELECT sequence_1.id AS id_1, sequence_2.id AS id_2, 
-                  sequence_1.sequence_id AS sequence_id_1, sequence_2.sequence_id AS sequence_id_2, 
-                  sequence_1.fasta AS fasta_1, sequence_2.fasta AS fasta_2
-                FROM sequence_with_duplicate AS sequence_1, sequence_with_duplicate AS sequence_2
-                WHERE sequence_1.id != sequence_2.id AND sequence_1.sequence_type = 0 AND sequence_2.sequence_type = 0),
-
-                diff_count AS (SELECT help_table.id_1 AS id_1, help_table.id_2 AS id_2, COUNT(*) AS d_count
-                FROM (help_table INNER JOIN public.fasta_position AS fasta_position_1 ON help_table.sequence_id_1 = fasta_position_1.sequence_id) 
-                INNER JOIN public.fasta_position AS fasta_position_2 ON help_table.sequence_id_2 = fasta_position_2.sequence_id
-                WHERE fasta_position_1.position = fasta_position_2.position AND fasta_position_1.value != fasta_position_2.value
-                GROUP BY help_table.id_1, help_table.id_2),
-
-                fasta_diff AS (SELECT COALESCE(d_count, 0) AS diff_num
-                FROM help_table LEFT JOIN diff_count ON (help_table.id_1 = diff_count.id_1 AND help_table.id_2 = diff_count.id_2)),
-
-rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
+        sql, params = self._diff_each_to_each(region)
+        sql += """,
+
+        rosp AS (SELECT diff_num, SUM(pair_count)::bigint AS frequency
         FROM fasta_diff
         GROUP BY diff_num
         ORDER BY diff_num),
@@ -726,34 +1038,12 @@ rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
         res = self.execute_query(sql, params, dict_return=True)
         return res
 
+    @cached
     def max_value_each_to_each(self, region):
-        sql = f"WITH sequence_with_duplicate AS ( " \
-              f"SELECT public.person.id, sequence_id, fasta, sequence_type " \
-              f"FROM (public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) " \
-              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-              f"WHERE sequence_type = 0 "
-        params = []
-        if region != 'ALL':
-            params.append(region)
-            sql += 'AND public.region.name = %s '
-        sql += """
-                            ),
-                help_table AS (SELECT sequence_1.id AS id_1, sequence_2.id AS id_2, 
-                  sequence_1.sequence_id AS sequence_id_1, sequence_2.sequence_id AS sequence_id_2, 
-                  sequence_1.fasta AS fasta_1, sequence_2.fasta AS fasta_2
-                FROM sequence_with_duplicate AS sequence_1, sequence_with_duplicate AS sequence_2
-                WHERE sequence_1.id != sequence_2.id AND sequence_1.sequence_type = 0 AND sequence_2.sequence_type = 0),
-
-                diff_count AS (SELECT help_table.id_1 AS id_1, help_table.id_2 AS id_2, COUNT(*) AS d_count
-                FROM (help_table INNER JOIN public.fasta_position AS fasta_position_1 ON help_table.sequence_id_1 = fasta_position_1.sequence_id) 
-                INNER JOIN public.fasta_position AS fasta_position_2 ON help_table.sequence_id_2 = fasta_position_2.sequence_id
-                WHERE fasta_position_1.position = fasta_position_2.position AND fasta_position_1.value != fasta_position_2.value
-                GROUP BY help_table.id_1, help_table.id_2),
-
-                fasta_diff AS (SELECT COALESCE(d_count, 0) AS diff_num
-                FROM help_table LEFT JOIN diff_count ON (help_table.id_1 = diff_count.id_1 AND help_table.id_2 = diff_count.id_2)),
-
-rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
+        sql, params = self._diff_each_to_each(region)
+        sql += """,
+
+            rosp AS (SELECT diff_num, SUM(pair_count)::bigint AS frequency
             FROM fasta_diff
             GROUP BY diff_num
             ORDER BY diff_num),
@@ -769,34 +1059,12 @@ rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
         res = self.execute_query(sql, params, dict_return=True)
         return res
 
+    @cached
     def coeff_each_to_each(self, region):
-        sql = f"WITH sequence_with_duplicate AS ( " \
-              f"SELECT public.person.id, sequence_id, fasta, sequence_type " \
-              f"FROM (public.sequence INNER JOIN public.person ON public.person.sequence_id = public.sequence.id) " \
-              f"INNER JOIN public.region ON public.region.id = public.person.region_id " \
-              f"WHERE sequence_type = 0 "
-        params = []
-        if region != 'ALL':
-            params.append(region)
-            sql += 'AND public.region.name = %s '
-        sql += """
-                            ),
-                help_table AS (SELECT sequence_1.id AS id_1, sequence_2.id AS id_2, 
-                  sequence_1.sequence_id AS sequence_id_1, sequence_2.sequence_id AS sequence_id_2, 
-                  sequence_1.fasta AS fasta_1, sequence_2.fasta AS fasta_2
-                FROM sequence_with_duplicate AS sequence_1, sequence_with_duplicate AS sequence_2
-                WHERE sequence_1.id != sequence_2.id AND sequence_1.sequence_type = 0 AND sequence_2.sequence_type = 0),
-
-                diff_count AS (SELECT help_table.id_1 AS id_1, help_table.id_2 AS id_2, COUNT(*) AS d_count
-                FROM (help_table INNER JOIN public.fasta_position AS fasta_position_1 ON help_table.sequence_id_1 = fasta_position_1.sequence_id) 
-                INNER JOIN public.fasta_position AS fasta_position_2 ON help_table.sequence_id_2 = fasta_position_2.sequence_id
-                WHERE fasta_position_1.position = fasta_position_2.position AND fasta_position_1.value != fasta_position_2.value
-                GROUP BY help_table.id_1, help_table.id_2),
-
-                fasta_diff AS (SELECT COALESCE(d_count, 0) AS diff_num
-                FROM help_table LEFT JOIN diff_count ON (help_table.id_1 = diff_count.id_1 AND help_table.id_2 = diff_count.id_2)),
-
-rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
+        sql, params = self._diff_each_to_each(region)
+        sql += """,
+
+            rosp AS (SELECT diff_num, SUM(pair_count)::bigint AS frequency
             FROM fasta_diff
             GROUP BY diff_num
             ORDER BY diff_num),
@@ -815,10 +1083,184 @@ rosp AS (SELECT diff_num, COUNT(*)/2 AS frequency
         res = self.execute_query(sql, params, dict_return=True)
         return res
 
+    @staticmethod
+    def _summary(rows):
+        # every row of the summary queries carries the same statistics next to its histogram bin
+        first = rows[0] if rows else {}
+        return {
+            'distribution': [{'diff_num': x['diff_num'], 'frequency': x['frequency'], 'p': x['p']} for x in rows],
+            'values': {
+                'mean': first.get('math_expectation'),
+                'std': first.get('standart_dev'),
+                'mode': first.get('mode'),
+                'min': first.get('min'),
+                'max': first.get('max'),
+                'coeff': first.get('koef')
+            }
+        }
+
+    @cached
+    def distribution_summary(self, base_name, region):
+        """
+        distribution() together with math_expectation(), std(), mode(), min_value(), max_value() and coeff()
+        from a single histogram:
+        {'distribution': [{'diff_num': 0, 'frequency': 10, 'p': 0.5}, ...],
+         'values': {'mean': ..., 'std': ..., 'mode': ..., 'min': ..., 'max': ..., 'coeff': ...}}
+        coeff is None instead of a division by zero when the mean is 0.
+        """
+        sql, params = self._diff_to_base(base_name, region)
+        sql += """,
+     rosp AS (SELECT diff_num, COUNT(*) AS frequency
+              FROM fasta_diff
+              GROUP BY diff_num
+              ORDER BY diff_num),
+     frequency_summ AS (SELECT SUM(frequency) AS f_s
+                        FROM rosp),
+     probability_rosp AS (SELECT diff_num, frequency, (frequency / (SELECT f_s FROM frequency_summ)) AS p
+                          FROM rosp),
+     math_expectation AS (SELECT SUM(diff_num * p) AS math_expct
+                          FROM probability_rosp),
+     standart_deviation AS (SELECT |/SUM((diff_num - (SELECT math_expct FROM math_expectation)) *
+                                         (diff_num - (SELECT math_expct FROM math_expectation)) * p) AS standart_dev
+                            FROM probability_rosp)
+SELECT diff_num, frequency, p,
+       (SELECT math_expct FROM math_expectation) AS math_expectation,
+       (SELECT standart_dev FROM standart_deviation) AS standart_dev,
+       (SELECT MIN(diff_num)
+        FROM probability_rosp
+        WHERE frequency = (SELECT MAX(frequency) FROM probability_rosp)) AS mode,
+       (SELECT MIN(diff_num) FROM probability_rosp) AS min,
+       (SELECT MAX(diff_num) FROM probability_rosp) AS max,
+       (SELECT standart_dev FROM standart_deviation) / NULLIF((SELECT math_expct FROM math_expectation), 0) AS koef
+FROM probability_rosp
+ORDER BY diff_num
+        """
+
+        return self._summary(self.execute_query(sql, params, dict_return=True))
+
+    @cached
+    def distribution_summary_each_to_each(self, region):
+        # the same as distribution_summary() for the "each to each" queries
+        sql, params = self._diff_each_to_each(region)
+        sql += """,
+
+            rosp AS (SELECT diff_num, SUM(pair_count)::bigint AS frequency
+            FROM fasta_diff
+            GROUP BY diff_num
+            ORDER BY diff_num),
+            frequency_summ AS (SELECT SUM(frequency) AS f_s
+            FROM rosp),
+            probability_rosp AS (SELECT diff_num, frequency, (frequency/(SELECT f_s FROM frequency_summ)) AS p
+            FROM rosp),
+            math_expectation AS (SELECT SUM(diff_num*p) AS math_expct
+            FROM probability_rosp),
+            standart_deviation AS (SELECT |/SUM((diff_num - (SELECT math_expct FROM math_expectation)) * (diff_num - (SELECT math_expct FROM math_expectation))*p) AS standart_dev
+            FROM probability_rosp)
+            SELECT diff_num, frequency, p,
+                   (SELECT math_expct FROM math_expectation) AS math_expectation,
+                   (SELECT standart_dev FROM standart_deviation) AS standart_dev,
+                   (SELECT MIN(diff_num) FROM probability_rosp WHERE p = (SELECT MAX(p) FROM probability_rosp)) AS mode,
+                   (SELECT MIN(diff_num) FROM probability_rosp) AS min,
+                   (SELECT MAX(diff_num) FROM probability_rosp) AS max,
+                   (SELECT standart_dev FROM standart_deviation)/NULLIF((SELECT math_expct FROM math_expectation), 0) AS koef
+            FROM probability_rosp
+            ORDER BY diff_num;
+        """
+
+        return self._summary(self.execute_query(sql, params, dict_return=True))
+
+    @cached
+    def distribution_by_region(self, base_name):
+        """
+        distribution_summary() of every region and of 'ALL' relative to one base sequence in one query:
+        {'IF': {'distribution': [...], 'values': {...}}, ..., 'ALL': {...}}
+        The histograms are grouped by region, the one of 'ALL' is their sum.
+        """
+        sql = """
+WITH fasta_diff AS (SELECT public.region.name AS region, COALESCE(diff_count, 0) AS diff_num
+                    FROM (public.person INNER JOIN public.region ON public.person.region_id = public.region.id)
+                             LEFT JOIN public.person_reference_diff
+                                       ON public.person.id = public.person_reference_diff.person_id
+                                           AND public.person_reference_diff.reference_id IN (SELECT id
+                                                                                            FROM public.sequence
+                                                                                            WHERE name = %s)),
+     region_rosp AS (SELECT region, diff_num, COUNT(*) AS frequency
+                     FROM fasta_diff
+                     GROUP BY region, diff_num),
+     rosp AS (SELECT region, diff_num, frequency
+              FROM region_rosp
+              UNION ALL
+              SELECT 'ALL', diff_num, SUM(frequency)::bigint
+              FROM region_rosp
+              GROUP BY diff_num),
+     probability_rosp AS (SELECT region, diff_num, frequency, (frequency / SUM(frequency) OVER (PARTITION BY region)) AS p
+                          FROM rosp),
+     math_expectation AS (SELECT region, SUM(diff_num * p) AS math_expct
+                          FROM probability_rosp
+                          GROUP BY region),
+     standart_deviation AS (SELECT region, |/SUM((diff_num - math_expct) * (diff_num - math_expct) * p) AS standart_dev
+                            FROM probability_rosp INNER JOIN math_expectation USING (region)
+                            GROUP BY region),
+     extremes AS (SELECT region,
+                         (ARRAY_AGG(diff_num ORDER BY frequency DESC, diff_num))[1] AS mode,
+                         MIN(diff_num) AS min,
+                         MAX(diff_num) AS max
+                  FROM probability_rosp
+                  GROUP BY region)
+SELECT region, diff_num, frequency, p,
+       math_expct AS math_expectation,
+       standart_dev,
+       mode,
+       min,
+       max,
+       standart_dev / NULLIF(math_expct, 0) AS koef
+FROM ((probability_rosp INNER JOIN math_expectation USING (region))
+    INNER JOIN standart_deviation USING (region))
+         INNER JOIN extremes USING (region)
+ORDER BY region, diff_num
+        """
+
+        rows = collections.defaultdict(list)
+        for row in self.execute_query(sql, [base_name], dict_return=True):
+            rows[row['region']].append(row)
+
+        res = {region: self._summary(region_rows) for region, region_rows in rows.items()}
+        res.setdefault('ALL', self._summary([]))
+        return res
+
+    @cached
     def get_distinct_regions(self):
         return [x[0] for x in self.execute_query('SELECT distinct name FROM region', None)]
 
 
+class PooledDatabase(Database):
+    """
+    Database for several threads (tab_builder.TabBuilder.build_all()): every thread runs its queries in its own
+    transaction on a connection of a psycopg2 ThreadedConnectionPool, taken on the first query of the thread.
+    The identity maps are shared and not locked, so load with Database.
+    """
+
+    def __init__(self, dsn, maxconn, debug=False, cache=None, query_log=None):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, dsn)
+        super().__init__(None, debug=debug, cache=cache, query_log=query_log)
+
+    @property
+    def _conn(self):
+        # more threads than maxconn raise psycopg2.pool.PoolError
+        return self._pool.getconn(key=threading.get_ident())
+
+    @_conn.setter
+    def _conn(self, conn):
+        pass  # Database.__init__(), the connections come from the pool
+
+    def release(self):
+        # returns the connection of the calling thread to the pool, its transaction is rolled back
+        self._pool.putconn(self._conn, key=threading.get_ident())
+
+    def close(self):
+        self._pool.closeall()
+
+
 if __name__ == '__main__':
     conn_ = psycopg2.connect("dbname='nrbd' user='postgres' host='localhost' password='gulayeva'")
     for r in Database(conn_).execute_query('SELECT 1+2 AS hello', None, dict_return=True):
@@ -1,5 +1,22 @@
 DROP FUNCTION IF EXISTS generate_positions();
 DROP TRIGGER IF EXISTS generate_fasta_positions ON sequence;
+DROP TRIGGER IF EXISTS generate_person_reference_diffs ON person;
+DROP TRIGGER IF EXISTS generate_reference_diffs ON sequence;
+DROP FUNCTION IF EXISTS generate_person_reference_diffs();
+DROP FUNCTION IF EXISTS generate_reference_diffs();
+DROP TRIGGER IF EXISTS update_person_reference_diffs ON person;
+DROP TRIGGER IF EXISTS update_reference_diffs ON sequence;
+DROP FUNCTION IF EXISTS update_person_reference_diffs();
+DROP FUNCTION IF EXISTS update_reference_diffs();
+DROP FUNCTION IF EXISTS count_fasta_differences(varchar, varchar);
+DROP TRIGGER IF EXISTS log_inserted_people ON person;
+DROP TRIGGER IF EXISTS log_updated_people ON person;
+DROP TRIGGER IF EXISTS log_deleted_people ON person;
+DROP FUNCTION IF EXISTS log_person_changes();
+DROP TRIGGER IF EXISTS count_alleles ON person_change;
+DROP FUNCTION IF EXISTS count_alleles();
+DROP TRIGGER IF EXISTS rename_logged_regions ON region;
+DROP FUNCTION IF EXISTS rename_logged_regions();
 
 CREATE FUNCTION generate_positions() RETURNS trigger AS
 $generate_positions$
@@ -17,6 +34,8 @@ create table region
         constraint region_pkey
             primary key,
     name varchar(255) not null
+        constraint region_name_key
+            unique
 );
 
 alter table region
@@ -36,6 +55,12 @@ create table sequence
 alter table sequence
     owner to postgres;
 
+-- UNIQUE (sequence_type, name, fasta) does not apply to unnamed sequences (NULL name),
+-- this one lets concurrent loaders upsert them with ON CONFLICT
+create unique index sequence_unnamed_fasta_key
+    on sequence (sequence_type, fasta)
+    where name is null;
+
 create trigger generate_fasta_positions
     after insert
     on sequence
@@ -76,3 +101,377 @@ create table person
 
 alter table person
     owner to postgres;
+
+create table ingest_checkpoint
+(
+    source_hash char(64)     not null
+        constraint ingest_checkpoint_pkey
+            primary key,
+    filename    varchar(255) not null,
+    record_no   integer      not null,
+    updated_at  timestamp default now() not null
+);
+
+alter table ingest_checkpoint
+    owner to postgres;
+
+-- Number of positions where every person differs from every reference sequence (sequence_type != 0:
+-- EVA, ANDREWS, WILD_TYPE_*), filled by the triggers below when people or references are inserted.
+-- People with a sequence that is not a crawled one (sequence_type != 0) have no rows, they differ in 0 positions
+create table person_reference_diff
+(
+    person_id    integer not null
+        constraint person_reference_diff_person_id_fkey
+            references person
+            on delete cascade,
+    reference_id integer not null
+        constraint person_reference_diff_reference_id_fkey
+            references sequence
+            on delete cascade,
+    diff_count   integer not null,
+    constraint person_reference_diff_pkey
+        primary key (reference_id, person_id)
+);
+
+alter table person_reference_diff
+    owner to postgres;
+
+CREATE FUNCTION count_fasta_differences(fasta_1 varchar, fasta_2 varchar) RETURNS integer AS
+$count_fasta_differences$
+SELECT COUNT(*)::integer
+FROM generate_series(1, LEAST(length(fasta_1), length(fasta_2))) AS position
+WHERE substr(fasta_1, position, 1) != substr(fasta_2, position, 1)
+$count_fasta_differences$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION generate_person_reference_diffs() RETURNS trigger AS
+$generate_person_reference_diffs$
+BEGIN
+    -- every distinct sequence of the inserted people is compared once
+    INSERT INTO person_reference_diff (person_id, reference_id, diff_count)
+    SELECT new_person.id, sequence_diff.reference_id, sequence_diff.diff_count
+    FROM new_person
+             INNER JOIN (SELECT crawled.id AS sequence_id, reference.id AS reference_id,
+                                count_fasta_differences(crawled.fasta, reference.fasta) AS diff_count
+                         FROM sequence AS crawled
+                                  CROSS JOIN sequence AS reference
+                         WHERE crawled.id IN (SELECT sequence_id FROM new_person)
+                           AND crawled.sequence_type = 0
+                           AND reference.sequence_type != 0) AS sequence_diff
+                        ON new_person.sequence_id = sequence_diff.sequence_id;
+    RETURN NULL;
+END
+$generate_person_reference_diffs$ LANGUAGE plpgsql;
+
+CREATE FUNCTION generate_reference_diffs() RETURNS trigger AS
+$generate_reference_diffs$
+BEGIN
+    IF NOT EXISTS(SELECT 1 FROM new_sequence WHERE sequence_type != 0) THEN
+        RETURN NULL;  -- crawled sequences, their people are compared when inserted
+    END IF;
+
+    INSERT INTO person_reference_diff (person_id, reference_id, diff_count)
+    SELECT person.id, sequence_diff.reference_id, sequence_diff.diff_count
+    FROM person
+             INNER JOIN (SELECT crawled.id AS sequence_id, reference.id AS reference_id,
+                                count_fasta_differences(crawled.fasta, reference.fasta) AS diff_count
+                         FROM sequence AS crawled
+                                  CROSS JOIN new_sequence AS reference
+                         WHERE crawled.id IN (SELECT sequence_id FROM person)
+                           AND crawled.sequence_type = 0
+                           AND reference.sequence_type != 0) AS sequence_diff
+                        ON person.sequence_id = sequence_diff.sequence_id;
+    RETURN NULL;
+END
+$generate_reference_diffs$ LANGUAGE plpgsql;
+
+CREATE FUNCTION update_person_reference_diffs() RETURNS trigger AS
+$update_person_reference_diffs$
+BEGIN
+    -- people with another sequence are compared again, other updates (region, url) keep their rows
+    WITH changed AS (SELECT new_person.id
+                     FROM old_person
+                              INNER JOIN new_person ON old_person.id = new_person.id
+                     WHERE old_person.sequence_id != new_person.sequence_id)
+    DELETE
+    FROM person_reference_diff
+    WHERE person_id IN (SELECT id FROM changed);
+
+    WITH changed AS (SELECT new_person.id, new_person.sequence_id
+                     FROM old_person
+                              INNER JOIN new_person ON old_person.id = new_person.id
+                     WHERE old_person.sequence_id != new_person.sequence_id)
+    INSERT
+    INTO person_reference_diff (person_id, reference_id, diff_count)
+    SELECT changed.id, sequence_diff.reference_id, sequence_diff.diff_count
+    FROM changed
+             INNER JOIN (SELECT crawled.id AS sequence_id, reference.id AS reference_id,
+                                count_fasta_differences(crawled.fasta, reference.fasta) AS diff_count
+                         FROM sequence AS crawled
+                                  CROSS JOIN sequence AS reference
+                         WHERE crawled.id IN (SELECT sequence_id FROM changed)
+                           AND crawled.sequence_type = 0
+                           AND reference.sequence_type != 0) AS sequence_diff
+                        ON changed.sequence_id = sequence_diff.sequence_id;
+    RETURN NULL;
+END
+$update_person_reference_diffs$ LANGUAGE plpgsql;
+
+CREATE FUNCTION update_reference_diffs() RETURNS trigger AS
+$update_reference_diffs$
+BEGIN
+    -- a sequence with another fasta or type: its rows as a reference and the rows of its people are computed again
+    WITH changed AS (SELECT new_sequence.id
+                     FROM old_sequence
+                              INNER JOIN new_sequence ON old_sequence.id = new_sequence.id
+                     WHERE old_sequence.fasta != new_sequence.fasta
+                        OR old_sequence.sequence_type != new_sequence.sequence_type)
+    DELETE
+    FROM person_reference_diff
+    WHERE reference_id IN (SELECT id FROM changed)
+       OR person_id IN (SELECT id FROM person WHERE sequence_id IN (SELECT id FROM changed));
+
+    WITH changed AS (SELECT new_sequence.id
+                     FROM old_sequence
+                              INNER JOIN new_sequence ON old_sequence.id = new_sequence.id
+                     WHERE old_sequence.fasta != new_sequence.fasta
+                        OR old_sequence.sequence_type != new_sequence.sequence_type)
+    INSERT
+    INTO person_reference_diff (person_id, reference_id, diff_count)
+    SELECT person.id, sequence_diff.reference_id, sequence_diff.diff_count
+    FROM person
+             INNER JOIN (SELECT crawled.id AS sequence_id, reference.id AS reference_id,
+                                count_fasta_differences(crawled.fasta, reference.fasta) AS diff_count
+                         FROM sequence AS crawled
+                                  CROSS JOIN sequence AS reference
+                         WHERE crawled.id IN (SELECT sequence_id FROM person)
+                           AND crawled.sequence_type = 0
+                           AND reference.sequence_type != 0
+                           AND (crawled.id IN (SELECT id FROM changed) OR reference.id IN (SELECT id FROM changed)))
+                            AS sequence_diff
+                        ON person.sequence_id = sequence_diff.sequence_id;
+    RETURN NULL;
+END
+$update_reference_diffs$ LANGUAGE plpgsql;
+
+-- the references are read on every insert into person
+create index sequence_reference_idx
+    on sequence (id)
+    where sequence_type != 0;
+
+-- statement level, so a multi-row insert (execute_values, INSERT ... SELECT) is handled in one query
+create trigger generate_person_reference_diffs
+    after insert
+    on person
+    referencing new table as new_person
+    for each statement
+execute procedure generate_person_reference_diffs();
+
+create trigger generate_reference_diffs
+    after insert
+    on sequence
+    referencing new table as new_sequence
+    for each statement
+execute procedure generate_reference_diffs();
+
+-- a column list is not allowed with transition tables, the functions skip the rows that keep their sequence
+create trigger update_person_reference_diffs
+    after update
+    on person
+    referencing old table as old_person new table as new_person
+    for each statement
+execute procedure update_person_reference_diffs();
+
+create trigger update_reference_diffs
+    after update
+    on sequence
+    referencing old table as old_sequence new table as new_sequence
+    for each statement
+execute procedure update_reference_diffs();
+
+-- fills the table for people and references loaded before it existed, does nothing on an empty database
+insert into person_reference_diff (person_id, reference_id, diff_count)
+select person.id, reference.id, count_fasta_differences(crawled.fasta, reference.fasta)
+from (person inner join sequence as crawled on person.sequence_id = crawled.id)
+         cross join sequence as reference
+where crawled.sequence_type = 0
+  and reference.sequence_type != 0
+on conflict do nothing;
+
+-- Every insert, update and delete of a person, in order (version). An inserted or updated person is logged with
+-- the region and the sequence it has from then on (change = 1), an updated or deleted one with the person id only
+-- (change = -1). The versions are taken before commit, so a transaction may commit after one with a higher version:
+-- the changes a reader has seen are the ones whose transaction (xid) is visible in its snapshot, see
+-- analytics.update_pair_histogram()
+create table person_change
+(
+    version       bigserial    not null
+        constraint person_change_pkey
+            primary key,
+    xid           xid8         default pg_current_xact_id() not null,
+    person_id     integer      not null,
+    change        smallint     not null,
+    region        varchar(255) null,
+    sequence_type integer      null,
+    fasta         varchar(377) null
+);
+
+alter table person_change
+    owner to postgres;
+
+-- "each to each" histogram of a region with the person changes visible in snapshot (pg_current_snapshot() of the
+-- report that saved it), frequencies of diff_num 0, 1, 2, ...
+create table pair_histogram
+(
+    region      varchar(255) not null
+        constraint pair_histogram_pkey
+            primary key,
+    snapshot    pg_snapshot  not null,
+    frequencies bigint[]     not null
+);
+
+alter table pair_histogram
+    owner to postgres;
+
+CREATE FUNCTION log_person_changes() RETURNS trigger AS
+$log_person_changes$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO person_change (person_id, change)
+        SELECT id, -1
+        FROM old_person
+        ORDER BY id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO person_change (person_id, change, region, sequence_type, fasta)
+        SELECT new_person.id, 1, region.name, sequence.sequence_type, sequence.fasta
+        FROM (new_person LEFT JOIN region ON new_person.region_id = region.id)
+                 LEFT JOIN sequence ON new_person.sequence_id = sequence.id
+        ORDER BY new_person.id;
+    END IF;
+
+    RETURN NULL;
+END
+$log_person_changes$ LANGUAGE plpgsql;
+
+create trigger log_inserted_people
+    after insert
+    on person
+    referencing new table as new_person
+    for each statement
+execute procedure log_person_changes();
+
+create trigger log_updated_people
+    after update
+    on person
+    referencing old table as old_person new table as new_person
+    for each statement
+execute procedure log_person_changes();
+
+create trigger log_deleted_people
+    after delete
+    on person
+    referencing old table as old_person
+    for each statement
+execute procedure log_person_changes();
+
+-- logs the people loaded before the table existed, does nothing on an empty database
+insert into person_change (person_id, change, region, sequence_type, fasta)
+select person.id, 1, region.name, sequence.sequence_type, sequence.fasta
+from (person left join region on person.region_id = region.id)
+         left join sequence on person.sequence_id = sequence.id
+where not exists(select 1 from person_change)
+order by person.id;
+
+-- Number of people (with a crawled sequence, sequence_type = 0) of every region that have the value on the
+-- position, kept up to date from person_change: an inserted person adds its sequence, a deleted one subtracts
+-- the sequence it was logged with (the sequence row itself may be deleted already), rows are removed at 0
+create table allele_count
+(
+    region_id integer    not null
+        constraint allele_count_region_id_fkey
+            references region
+            on delete cascade,
+    position  integer    not null,
+    value     varchar(1) not null,
+    count     integer    not null,
+    constraint allele_count_pkey
+        primary key (region_id, position, value)
+);
+
+alter table allele_count
+    owner to postgres;
+
+create index person_change_person_id_idx
+    on person_change (person_id, version);
+
+create index person_change_xid_idx
+    on person_change (xid);
+
+CREATE FUNCTION count_alleles() RETURNS trigger AS
+$count_alleles$
+BEGIN
+    WITH logged AS (SELECT DISTINCT ON (new_change.version) new_change.change, previous.region, previous.sequence_type,
+                                                            previous.fasta
+                    FROM new_change
+                             INNER JOIN person_change AS previous
+                                        ON previous.person_id = new_change.person_id
+                                            AND previous.version <= new_change.version
+                                            AND previous.change = 1
+                    ORDER BY new_change.version, previous.version DESC),
+         changed AS (SELECT region.id AS region_id, position, substr(fasta, position, 1) AS value, SUM(change) AS count
+                     FROM (logged INNER JOIN region ON logged.region = region.name)
+                              CROSS JOIN generate_series(1, length(fasta)) AS position
+                     WHERE sequence_type = 0
+                     GROUP BY region.id, position, substr(fasta, position, 1))
+    INSERT
+    INTO allele_count (region_id, position, value, count)
+    SELECT region_id, position, value, count
+    FROM changed
+    WHERE count != 0
+    -- concurrent loaders (main.parallel_main()) lock the rows in the same order instead of deadlocking
+    ORDER BY region_id, position, value
+    ON CONFLICT (region_id, position, value) DO UPDATE SET count = allele_count.count + EXCLUDED.count;
+
+    DELETE FROM allele_count WHERE count = 0;
+    RETURN NULL;
+END
+$count_alleles$ LANGUAGE plpgsql;
+
+create trigger count_alleles
+    after insert
+    on person_change
+    referencing new table as new_change
+    for each statement
+execute procedure count_alleles();
+
+-- count_alleles() finds the region of a deleted person by the name it was logged with
+CREATE FUNCTION rename_logged_regions() RETURNS trigger AS
+$rename_logged_regions$
+BEGIN
+    UPDATE person_change
+    SET region = new_region.name
+    FROM old_region
+             INNER JOIN new_region ON old_region.id = new_region.id
+    WHERE person_change.region = old_region.name
+      AND old_region.name != new_region.name;
+    RETURN NULL;
+END
+$rename_logged_regions$ LANGUAGE plpgsql;
+
+create trigger rename_logged_regions
+    after update
+    on region
+    referencing old table as old_region new table as new_region
+    for each statement
+execute procedure rename_logged_regions();
+
+-- counts the people loaded before the table existed, does nothing on an empty database
+insert into allele_count (region_id, position, value, count)
+select person.region_id, position, substr(sequence.fasta, position, 1), count(*)
+from (person inner join sequence on person.sequence_id = sequence.id)
+         cross join generate_series(1, length(sequence.fasta)) as position
+where sequence.sequence_type = 0
+  and person.region_id is not null
+  and not exists(select 1 from allele_count)
+group by person.region_id, position, substr(sequence.fasta, position, 1);
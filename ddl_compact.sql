@@ -0,0 +1,25 @@
+-- Optional compact schema mode, execute after ddl.sql (on an empty or an already loaded database).
+-- Every sequence is stored once, in sequence.fasta, instead of being exploded into 377 fasta_position rows
+-- by a trigger. fasta_position stays available as a view over sequence.fasta, so queries written against
+-- ddl.sql keep working. The analytics (analytics.SequenceMatrix) read sequence.fasta as well.
+-- database.Database works with both schemas.
+
+BEGIN;
+
+DROP TRIGGER IF EXISTS generate_fasta_positions ON sequence;
+DROP FUNCTION IF EXISTS generate_positions();
+
+drop table fasta_position;
+
+create view fasta_position as
+select (sequence.id - 1) * 377 + position           as id,
+       position                                       as position,
+       substr(sequence.fasta, position, 1)::varchar(1) as value,
+       sequence.id                                    as sequence_id
+from sequence
+         cross join lateral generate_series(1, length(sequence.fasta)) as position;
+
+alter view fasta_position
+    owner to postgres;
+
+COMMIT;
@@ -0,0 +1,149 @@
+-- Schema of embedded.EmbeddedDatabase: the tables of ddl.sql that are loaded (region, sequence, person,
+-- ingest_checkpoint) for SQLite. fasta_position, person_reference_diff, person_change and allele_count are left
+-- out, the analytics are computed by analytics.SequenceMatrix. Executed when the database file is opened, so
+-- every statement is idempotent.
+
+PRAGMA foreign_keys = ON;
+
+create table if not exists region
+(
+    id   integer      not null
+        constraint region_pkey
+            primary key autoincrement,
+    name varchar(255) not null
+        constraint region_name_key
+            unique
+);
+
+create table if not exists sequence
+(
+    id            integer           not null
+        constraint sequence_pkey
+            primary key autoincrement,
+    sequence_type integer default 0 not null,
+    name          varchar(255)      null,
+    fasta         varchar(377)      not null,
+    UNIQUE (sequence_type, name, fasta)
+);
+
+create unique index if not exists sequence_unnamed_fasta_key
+    on sequence (sequence_type, fasta)
+    where name is null;
+
+create table if not exists person
+(
+    id          integer not null
+        constraint person_pkey
+            primary key autoincrement,
+    region_id   integer
+        constraint person_region_id_fkey
+            references region
+            on delete set null,
+    url         character varying(255) unique,
+    sequence_id integer not null
+        constraint person_sequence_id_fkey
+            references sequence
+            on delete cascade
+);
+
+create index if not exists person_region_id_idx
+    on person (region_id);
+
+create index if not exists person_sequence_id_idx
+    on person (sequence_id);
+
+create table if not exists ingest_checkpoint
+(
+    source_hash char(64)     not null
+        constraint ingest_checkpoint_pkey
+            primary key,
+    filename    varchar(255) not null,
+    record_no   integer      not null,
+    updated_at  timestamp default current_timestamp not null
+);
+
+-- migrations/0003_dataset_version.up.sql: bumped by every row that changes person, region or a sequence other
+-- than a wild type (sequence_type = 2). Wild types are computed from the people, so they do not change the data
+-- the analytics are cached for
+create table if not exists dataset_version
+(
+    id      boolean default true not null
+        constraint dataset_version_pkey
+            primary key
+        constraint dataset_version_id_check
+            check (id),
+    version bigint  default 0    not null
+);
+
+insert or ignore into dataset_version (id, version)
+values (true, 0);
+
+create trigger if not exists bump_dataset_version_person_insert
+    after insert
+    on person
+begin
+    update dataset_version set version = version + 1;
+end;
+
+create trigger if not exists bump_dataset_version_person_update
+    after update
+    on person
+    when old.region_id is not new.region_id or old.sequence_id is not new.sequence_id
+begin
+    update dataset_version set version = version + 1;
+end;
+
+create trigger if not exists bump_dataset_version_person_delete
+    after delete
+    on person
+begin
+    update dataset_version set version = version + 1;
+end;
+
+create trigger if not exists bump_dataset_version_region_insert
+    after insert
+    on region
+begin
+    update dataset_version set version = version + 1;
+end;
+
+create trigger if not exists bump_dataset_version_region_update
+    after update
+    on region
+    when old.name is not new.name
+begin
+    update dataset_version set version = version + 1;
+end;
+
+create trigger if not exists bump_dataset_version_region_delete
+    after delete
+    on region
+begin
+    update dataset_version set version = version + 1;
+end;
+
+create trigger if not exists bump_dataset_version_sequence_insert
+    after insert
+    on sequence
+    when new.sequence_type != 2
+begin
+    update dataset_version set version = version + 1;
+end;
+
+-- updates that keep the data (the same fasta) do not count
+create trigger if not exists bump_dataset_version_sequence_update
+    after update
+    on sequence
+    when (old.sequence_type != 2 or new.sequence_type != 2)
+        and (old.fasta is not new.fasta or old.name is not new.name or old.sequence_type is not new.sequence_type)
+begin
+    update dataset_version set version = version + 1;
+end;
+
+create trigger if not exists bump_dataset_version_sequence_delete
+    after delete
+    on sequence
+    when old.sequence_type != 2
+begin
+    update dataset_version set version = version + 1;
+end;
@@ -0,0 +1,174 @@
+import datetime
+import os
+import sqlite3
+
+import analytics
+import database
+
+DDL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ddl_sqlite.sql')
+# main.open_database() opens 'sqlite:///nrbd.sqlite' (a relative path) or 'sqlite:////tmp/nrbd.sqlite' with
+# EmbeddedDatabase
+DSN_PREFIX = 'sqlite:///'
+
+
+def _matrix_method(name):
+    # an analytics method of Database computed by the SequenceMatrix of the data
+    def method(self, *args, **kwargs):
+        return getattr(self.matrix(), name)(*args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+class EmbeddedDatabase(database.Database):
+    """
+    Database on an SQLite file (or ':memory:') for loading and reports without a PostgreSQL server:
+
+    db = EmbeddedDatabase('nrbd.sqlite')
+    main.insert_base_sequences(db)
+    TabBuilder(wrapper, db).build('IF')
+
+    The schema is ddl_sqlite.sql. The queries of Database that are portable SQL run as they are (the public schema
+    is dropped and %s becomes ?), the ones that use PostgreSQL features are rewritten here. The analytics are
+    computed by analytics.SequenceMatrix, which gives the same results as the SQL queries, the matrix is loaded
+    again when dataset_version changes. SequenceMatrix(incremental=True) needs the tables of ddl.sql that are not
+    ported.
+    """
+
+    def __init__(self, path, debug=False, identity_map_size=0, timeout=30.0, block_size=analytics.BLOCK_SIZE,
+                 matrix_cache=None):
+        # timeout: seconds a writer waits for the lock of another one (main.parallel_main())
+        # matrix_cache: analytics.MatrixCache the matrix is memory-mapped from
+        conn = sqlite3.connect(path, timeout=timeout)
+        conn.create_function('now', 0, lambda: datetime.datetime.now().isoformat(' '))
+        with open(DDL_FILE, encoding='utf-8') as file:
+            conn.executescript(file.read())
+
+        super().__init__(conn, debug=debug, identity_map_size=identity_map_size)
+        self._path = path
+        self._block_size = block_size
+        self._matrix_cache = matrix_cache
+        self._matrix = None
+        self._matrix_version = None
+
+    def close(self):
+        self._conn.close()
+
+    def identity(self):
+        # in-memory databases are not shared with anyone
+        if self._path == ':memory:':
+            return f'sqlite::memory:{id(self)}'
+        return f'sqlite:{os.path.abspath(self._path)}'
+
+    def dataset_version(self):
+        # None while this connection has uncommitted changes, as in Database
+        if self._conn.in_transaction:
+            return None
+        return self.execute_query('SELECT version FROM dataset_version', None)[0][0]
+
+    def get_cursor(self, dict_return=False):
+        cursor = self._conn.cursor()
+        if dict_return:
+            cursor.row_factory = sqlite3.Row  # row['name'] and row[0], like psycopg2.extras.DictRow
+        return cursor
+
+    def execute_query(self, query, params, fetch=True, dict_return=False, many=False):
+        # psycopg2 placeholders and schema names, no query log (it explains the queries with PostgreSQL)
+        cursor = self.get_cursor(dict_return)
+        query = query.replace('public.', '').replace('%s', '?')
+
+        if self._debug:
+            print(f'DEBUG --- QUERY: {query}')
+            print(f'DEBUG --- PARAMS: {params}')
+            print(f'DEBUG --- FETCH: {fetch}, DICT RETURN: {dict_return}, EXECUTE MANY: {many}')
+
+        if many:
+            cursor.executemany(query, params)
+        else:
+            cursor.execute(query, params or ())
+
+        return cursor.fetchall() if fetch else cursor.rowcount
+
+    def warm_identity_map(self):
+        if not self._sequences.maxsize:
+            return
+
+        sql = 'SELECT * FROM region WHERE id IN (SELECT MIN(id) FROM region GROUP BY name) ORDER BY id DESC LIMIT %s'
+        for region in reversed(self.execute_query(sql, [self._regions.maxsize], dict_return=True)):
+            self._regions.put(region['name'], region)
+
+        sql = 'SELECT * FROM sequence WHERE id IN (SELECT MIN(id) FROM sequence GROUP BY fasta, sequence_type) ' \
+              'ORDER BY id DESC LIMIT %s'
+        for sequence in reversed(self.execute_query(sql, [self._sequences.maxsize], dict_return=True)):
+            self._sequences.put((sequence['fasta'], sequence['sequence_type']), sequence)
+
+    def insert_people(self, people):
+        sql = 'INSERT INTO person (region_id, sequence_id, url) VALUES (%s, %s, %s)'
+        self.execute_query(sql, people, fetch=False, many=True)
+
+    def copy_rows(self, table, fields, rows):
+        sql = f'INSERT INTO {table} ({", ".join(fields)}) VALUES ({", ".join("%s" for _ in fields)})'
+        return self.execute_query(sql, rows, fetch=False, many=True)
+
+    def create_person_staging(self):
+        # dropped by the next load instead of at commit
+        self.execute_query('DROP TABLE IF EXISTS temp.person_staging', None, fetch=False)
+        self.execute_query(
+            'CREATE TEMPORARY TABLE person_staging (record_no integer primary key, version text not null, '
+            'region text not null, fasta text not null, url text not null)',
+            None, fetch=False
+        )
+
+    def reject_staged_people(self):
+        sql = """
+            SELECT record_no, version, region, fasta,
+                   CASE WHEN url_rank > 1 THEN 'duplicate url in file' ELSE 'url is already loaded' END
+            FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY url ORDER BY record_no) AS url_rank
+                  FROM person_staging) AS ranked
+            WHERE url_rank > 1 OR EXISTS (SELECT 1 FROM person WHERE person.url = ranked.url)
+            ORDER BY record_no
+        """
+        rejected = self.execute_query(sql, None)
+        self.execute_query('DELETE FROM person_staging WHERE record_no = %s', [(x[0],) for x in rejected],
+                           fetch=False, many=True)
+        return rejected
+
+    def upsert_wild_types(self, wild_types):
+        rows = [(f'WILD_TYPE_{region}', fasta) for region, fasta in wild_types.items()]
+        self.execute_query('DELETE FROM sequence WHERE sequence_type = 2 AND name = %s AND fasta != %s', rows,
+                           fetch=False, many=True)
+        self.execute_query('INSERT INTO sequence (sequence_type, name, fasta) VALUES (2, %s, %s) '
+                           'ON CONFLICT (sequence_type, name, fasta) DO NOTHING', rows, fetch=False, many=True)
+
+    def matrix(self):
+        # the wild types the matrix stores do not change dataset_version, its references are updated by itself
+        version = self.dataset_version()
+        if self._matrix is None or version is None or version != self._matrix_version:
+            self._matrix = analytics.SequenceMatrix(self, self._block_size, cache=self._matrix_cache)
+            self._matrix_version = version
+        return self._matrix
+
+    diff_between_base_and_wild = _matrix_method('diff_between_base_and_wild')
+    allele_counts = _matrix_method('allele_counts')
+    polim = _matrix_method('polim')
+    calculate_wild = _matrix_method('calculate_wild')
+
+    distribution = _matrix_method('distribution')
+    math_expectation = _matrix_method('math_expectation')
+    std = _matrix_method('std')
+    mode = _matrix_method('mode')
+    min_value = _matrix_method('min_value')
+    max_value = _matrix_method('max_value')
+    coeff = _matrix_method('coeff')
+
+    distribution_each_to_each = _matrix_method('distribution_each_to_each')
+    math_expectation_each_to_each = _matrix_method('math_expectation_each_to_each')
+    std_each_to_each = _matrix_method('std_each_to_each')
+    mode_each_to_each = _matrix_method('mode_each_to_each')
+    min_value_each_to_each = _matrix_method('min_value_each_to_each')
+    max_value_each_to_each = _matrix_method('max_value_each_to_each')
+    coeff_each_to_each = _matrix_method('coeff_each_to_each')
+
+    distribution_summary = _matrix_method('distribution_summary')
+    distribution_summary_each_to_each = _matrix_method('distribution_summary_each_to_each')
+    distribution_by_region = _matrix_method('distribution_by_region')
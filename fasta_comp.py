@@ -1,3 +1,22 @@
+import numpy as np
+
+# IUPAC nucleotide codes as 4-bit masks of the bases they stand for, every code is a different mask
+IUPAC_CODES = {
+    '-': 0b0000,
+    'A': 0b0001, 'C': 0b0010, 'G': 0b0100, 'T': 0b1000,
+    'M': 0b0011, 'R': 0b0101, 'W': 0b1001, 'S': 0b0110, 'Y': 0b1010, 'K': 0b1100,
+    'V': 0b0111, 'H': 0b1011, 'D': 0b1101, 'B': 0b1110,
+    'N': 0b1111,
+}
+CODE_BITS = 4
+PLANES = CODE_BITS + 1  # the last plane marks the positions that the sequence has
+
+_CODES = np.full(256, -1, dtype=np.int16)
+for _letter, _code in IUPAC_CODES.items():
+    _CODES[ord(_letter)] = _code
+_POPCOUNT = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+
 def compare_fasta(base_fasta, target_fasta):
     return [
         (index, target)
@@ -7,8 +26,88 @@ def compare_fasta(base_fasta, target_fasta):
     ]
 
 
+def pack_fasta(fasta_list, length=None):
+    """
+    pack_fasta(['ACGT', 'ACGA']) -> uint64 array of shape (2, PLANES, words)
+    Every position is a bit of CODE_BITS code planes and of the presence plane, 64 positions per word,
+    so a 377 bp sequence takes 5 x 6 words (240 bytes).
+    :param length: number of positions to pack, the longest sequence if None
+    """
+    data = [fasta.encode('ascii') for fasta in fasta_list]
+    length = max((len(x) for x in data), default=0) if length is None else length
+    words = (length + 63) // 64
+
+    letters = np.zeros((len(data), words * 64), dtype=np.uint8)
+    present = np.zeros((len(data), words * 64), dtype=bool)
+    for row, fasta in enumerate(data):
+        fasta = fasta[:length]
+        letters[row, :len(fasta)] = np.frombuffer(fasta, dtype=np.uint8)
+        present[row, :len(fasta)] = True
+
+    codes = _CODES[letters]
+    unknown = present & (codes < 0)
+    if unknown.any():
+        row, position = np.argwhere(unknown)[0]
+        raise ValueError(f'unknown nucleotide code {chr(letters[row, position])!r} at position {position}')
+
+    bits = [(codes >> bit) & 1 == 1 for bit in range(CODE_BITS)] + [present]
+    planes = np.stack([np.packbits(x, axis=1, bitorder='little') for x in bits], axis=1)
+
+    return np.ascontiguousarray(planes).view('<u8')
+
+
+def count_differences(packed_base, packed):
+    """
+    Number of positions that both sequences have and where they differ, as compare_fasta() but counted
+    64 positions at a time: the code planes are XOR-ed, OR-ed together and masked by both presence planes.
+    :param packed_base: one packed sequence (PLANES, words) or many (n, PLANES, words)
+    :param packed: packed sequences (m, PLANES, words)
+    :return: (m,) distances for one base or (n, m) for many, row by row to keep memory at m x words
+    """
+    if packed_base.ndim == 3:
+        return np.stack([count_differences(base, packed) for base in packed_base]) \
+            if len(packed_base) else np.zeros((0, len(packed)), dtype=np.int64)
+
+    different = np.bitwise_or.reduce(packed[:, :CODE_BITS] ^ packed_base[:CODE_BITS], axis=1)
+    different &= packed[:, CODE_BITS] & packed_base[CODE_BITS]
+
+    return _POPCOUNT[different.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+class PackedSequence:
+    """
+    PackedSequence('ACGT').distance(PackedSequence('ACGA')) -> 1
+    """
+    __slots__ = ('fasta_length', 'planes')
+
+    def __init__(self, fasta):
+        self.fasta_length = len(fasta)
+        self.planes = pack_fasta([fasta])[0]
+
+    def __len__(self):
+        return self.fasta_length
+
+    def distance(self, other):
+        length = max(self.planes.shape[1], other.planes.shape[1])
+        return int(count_differences(_pad(self.planes, length), _pad(other.planes, length)[np.newaxis])[0])
+
+    def distances(self, packed):
+        # one against many: packed is pack_fasta() of the other sequences
+        length = max(self.planes.shape[1], packed.shape[2])
+        return count_differences(_pad(self.planes, length), _pad(packed, length))
+
+
+def _pad(planes, words):
+    # sequences of different lengths are compared on the positions of the shorter one
+    missing = words - planes.shape[-1]
+    if missing <= 0:
+        return planes
+    return np.concatenate([planes, np.zeros(planes.shape[:-1] + (missing,), dtype=planes.dtype)], axis=-1)
+
+
 if __name__ == '__main__':
     base_f = 'AAAAA'
     target_f = 'AAABC'
 
     print(compare_fasta(base_f, target_f))
+    print(PackedSequence(base_f).distance(PackedSequence(target_f)))
@@ -1,58 +1,284 @@
+import argparse
+import concurrent.futures
 import csv
+import hashlib
+import itertools
+import os
+import signal
 import time
 
 import psycopg2
 
 import database
+import embedded
+import sequence_reader
 
+DSN = "dbname='nrbd' user='postgres' host='localhost' password='gulayeva'"
+BASE_URL = 'https://www.ncbi.nlm.nih.gov/nuccore/'
 
-def read_fasta(filename):
-    with open(filename) as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-        for row in reader:
-            yield row
+MAX_FASTA_LENGTH = 377
+MAX_NAME_LENGTH = 255
+IDENTITY_MAP_SIZE = 100_000
+CHUNK_SIZE = 1000
+CHECKPOINT_EVERY = 1000
 
+# reference sequences every database starts with (sequence_type=1)
+BASE_SEQUENCES = {
+    'EVA': 'TTCTTTCATGGGGAAGCAGATTTGGGTACCACCCAAGTATTGACTCACCCATCAACAACCGCTATGTATTTCGTACATTACTGCCAGCCACCATGAATATTGTACAGTACCATAAATACTTGACCACCTGTAGTACATAAAAACCCAATCCACATCAAAACCCTCCCCCCATGCTTACAAGCAAGTACAGCAATCAACCTTCAACTGTCACACATCAACTGCAACTCCAAAGCCACCCCTCACCCACTAGGATATCAACAAACCTACCCACCCTTAACAGTACATAGCACATAAAGCCATTTACCGTACATAGCACATTACAGTCAAATCCCTTCTCGTCCCCATGGATGACCCCCCTCAGATAGGGGTCCCTTGAC',
+    'ANDREWS': 'TTCTTTCATGGGGAAGCAGATTTGGGTACCACCCAAGTATTGACTCACCCATCAACAACCGCTATGTATTTCGTACATTACTGCCAGCCACCATGAATATTGTACGGTACCATAAATACTTGACCACCTGTAGTACATAAAAACCCAATCCACATCAAAACCCCCTCCCCATGCTTACAAGCAAGTACAGCAATCAACCCTCAACTATCACACATCAACTGCAACTCCAAAGCCACCCCTCACCCACTAGGATACCAACAAACCTACCCACCCTTAACAGTACATAGTACATAAAGCCATTTACCGTACATAGCACATTACAGTCAAATCCCTTCTCGTCCCCATGGATGACCCCCCTCAGATAGGGGTCCCTTGAC',
+}
 
-def main():
-    conn = psycopg2.connect("dbname='nrbd' user='postgres' host='localhost' password='gulayeva'")
-    # conn = psycopg2.connect("dbname='nrbd' user='postgres' host='localhost' password='root'")
-    # conn.set_session(autocommit=True) # enabling autocommit
-    db = database.Database(conn)
+_worker_db = None
+
+
+def open_database(dsn, **kwargs):
+    # an embedded.EmbeddedDatabase for 'sqlite:///<path>', PostgreSQL otherwise
+    if dsn.startswith(embedded.DSN_PREFIX):
+        return embedded.EmbeddedDatabase(dsn[len(embedded.DSN_PREFIX):], **kwargs)
+    return database.Database(psycopg2.connect(dsn), **kwargs)
+
+
+def insert_base_sequences(db):
+    for name, fasta in BASE_SEQUENCES.items():
+        db.insert_sequence(fasta, type_=1, name=name)
+
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
 
-    # base_sequence = db.get_base_sequence(1)
-    db.insert_sequence(
-        'TTCTTTCATGGGGAAGCAGATTTGGGTACCACCCAAGTATTGACTCACCCATCAACAACCGCTATGTATTTCGTACATTACTGCCAGCCACCATGAATATTGTACAGTACCATAAATACTTGACCACCTGTAGTACATAAAAACCCAATCCACATCAAAACCCTCCCCCCATGCTTACAAGCAAGTACAGCAATCAACCTTCAACTGTCACACATCAACTGCAACTCCAAAGCCACCCCTCACCCACTAGGATATCAACAAACCTACCCACCCTTAACAGTACATAGCACATAAAGCCATTTACCGTACATAGCACATTACAGTCAAATCCCTTCTCGTCCCCATGGATGACCCCCCTCAGATAGGGGTCCCTTGAC',
-        type_=1, name="EVA"
-    )
-    db.insert_sequence(
-        'TTCTTTCATGGGGAAGCAGATTTGGGTACCACCCAAGTATTGACTCACCCATCAACAACCGCTATGTATTTCGTACATTACTGCCAGCCACCATGAATATTGTACGGTACCATAAATACTTGACCACCTGTAGTACATAAAAACCCAATCCACATCAAAACCCCCTCCCCATGCTTACAAGCAAGTACAGCAATCAACCCTCAACTATCACACATCAACTGCAACTCCAAAGCCACCCCTCACCCACTAGGATACCAACAAACCTACCCACCCTTAACAGTACATAGTACATAAAGCCATTTACCGTACATAGCACATTACAGTCAAATCCCTTCTCGTCCCCATGGATGACCCCCCTCAGATAGGGGTCCCTTGAC',
-        type_=1, name="ANDREWS"
-    )
-    conn.commit()
 
-    fasta = read_fasta('result.csv')
-    next(fasta, None)  # skip csv headers
+class Checkpoint:
+    """
+    Resume state of one source file (identified by its sha256): records up to record_no were loaded
+    by an earlier run and are skipped without touching the database, records whose url is already
+    in person (prefetched with one query) are skipped as well.
+    """
 
-    base_url = 'https://www.ncbi.nlm.nih.gov/nuccore/'
+    def __init__(self, db, filename):
+        self._db = db
+        self._filename = filename
+        self._source_hash = file_hash(filename)
+        self._loaded_urls = db.get_loaded_urls()
+        self.record_no = db.get_checkpoint(self._source_hash)
+        self.last_record_no = self.record_no
+        self.skipped = 0
+
+    def pending(self, fasta):
+        # (record_no, row) of the records that still have to be loaded
+        for record_no, row in enumerate(fasta, start=1):
+            self.last_record_no = record_no
+            if record_no <= self.record_no:
+                continue
+
+            url = f'{BASE_URL}{row[0]}'
+            if url in self._loaded_urls:
+                self.skipped += 1
+                continue
+
+            self._loaded_urls.add(url)
+            yield record_no, row
+
+    def save(self, record_no):
+        # saved in the caller's transaction, so it is committed together with the rows it covers
+        self.record_no = record_no
+        self._db.save_checkpoint(self._source_hash, self._filename, record_no)
+
+
+def main(dsn=DSN, filename='result.csv', format_=None):
+    db = open_database(dsn, identity_map_size=IDENTITY_MAP_SIZE)
+
+    # base_sequence = db.get_base_sequence(1)
+    insert_base_sequences(db)
+    db.commit()
+    db.warm_identity_map()
+
+    checkpoint = Checkpoint(db, filename)
+    fasta = sequence_reader.read_sequences(filename, format_)
 
     processed = 0
 
-    for f in fasta:
+    for record_no, f in checkpoint.pending(fasta):
         sequence = db.get_sequence(f[2], 0)
         if sequence is None:
             sequence = db.insert_sequence(f[2])
 
         region = db.get_region(f[1])
-        url = f'{base_url}{f[0]}'
+        url = f'{BASE_URL}{f[0]}'
         db.insert_person(region['id'], sequence['id'], url)
 
-        conn.commit()
+        if record_no % CHECKPOINT_EVERY == 0:
+            checkpoint.save(record_no)
+
+        db.commit()
 
         processed += 1
         print(f'\rProcessed: {processed}', end='', flush=True)
 
+    checkpoint.save(checkpoint.last_record_no)
+    db.commit()
+    print(f'\rProcessed: {processed}, skipped as already loaded: {checkpoint.skipped}', end='', flush=True)
+
+
+def validate_row(row):
+    # the rows main() cannot load: missing columns (more are ignored) and values longer than their columns.
+    # Empty values are loaded as they are
+    if len(row) < 3:
+        return f'expected 3 columns, got {len(row)}'
+    if len(row[2]) > MAX_FASTA_LENGTH:
+        return f'fasta is longer than {MAX_FASTA_LENGTH}'
+    if len(row[1]) > MAX_NAME_LENGTH or len(f'{BASE_URL}{row[0]}') > MAX_NAME_LENGTH:
+        return f'region or url is longer than {MAX_NAME_LENGTH}'
+
+    return None
+
+
+def staged_rows(fasta, rejects):
+    # records are numbered from 1 in the order of the source file, headers are not counted
+    for record_no, row in enumerate(fasta, start=1):
+        reason = validate_row(row)
+        if reason is not None:
+            rejects.writerow([record_no, *row, reason])
+            continue
+
+        yield record_no, row[0], row[1], row[2], f'{BASE_URL}{row[0]}'
+
+
+def bulk_main(dsn=DSN, filename='result.csv', reject_filename='rejected.csv', format_=None):
+    """
+    Loads the same data as main() but with a few set-based statements instead of ~5 round trips per row:
+    the file is streamed into a temporary table with COPY, new regions and sequences are inserted in
+    order of their first appearance (so ids match the per-row path) and people are inserted in one go.
+    Rows that cannot be loaded are written to reject_filename together with the reason.
+    """
+    db = open_database(dsn)
+
+    insert_base_sequences(db)
+    db.commit()
+
+    processed = bulk_load(db, sequence_reader.read_sequences(filename, format_), reject_filename)
+    db.commit()
+    print(f'Processed: {processed}', end='', flush=True)
+
+
+def bulk_load(db, fasta, reject_filename):
+    # [version, region, fasta] records -> the number of people inserted, the caller commits
+    with open(reject_filename, 'w', newline='') as reject_file:
+        rejects = csv.writer(reject_file)
+        rejects.writerow(['record', 'version', 'region', 'fasta', 'reason'])
+
+        db.create_person_staging()
+        db.stage_people(staged_rows(fasta, rejects))
+        rejects.writerows(db.reject_staged_people())
+
+        db.insert_staged_regions()
+        db.insert_staged_sequences()
+        return db.insert_staged_people()
+
+
+def init_worker(dsn):
+    global _worker_db
+    # Ctrl-C is handled by the parent, which lets the chunks in flight finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_db = open_database(dsn, identity_map_size=IDENTITY_MAP_SIZE)
+    _worker_db.warm_identity_map()
+
+
+def load_chunk(rows):
+    db = _worker_db
+    people = []
+
+    for f in rows:
+        sequence = db.get_sequence(f[2], 0)
+        if sequence is None:
+            sequence = db.insert_sequence(f[2])
+
+        region = db.get_region(f[1])
+        # upserted rows are committed right away, so other workers never wait on a lock held for a whole chunk
+        # (a no-op when both lookups were answered by the identity map)
+        db.commit()
+
+        people.append((region['id'], sequence['id'], f'{BASE_URL}{f[0]}'))
+
+    db.insert_people(people)
+    db.commit()
+
+    return len(people)
+
+
+def parallel_main(dsn=DSN, filename='result.csv', workers=None, chunk_size=CHUNK_SIZE, format_=None):
+    """
+    Splits the file into chunks of chunk_size rows and loads them from a pool of worker processes,
+    each with its own connection. Regions and sequences are created with upserts, so workers that
+    meet the same new value concurrently end up with the same row.
+    """
+    db = open_database(dsn)
+    insert_base_sequences(db)
+    db.commit()
+
+    workers = workers or os.cpu_count()
+
+    checkpoint = Checkpoint(db, filename)
+    fasta = sequence_reader.read_sequences(filename, format_)
+    records = checkpoint.pending(fasta)
+    chunks = enumerate(iter(lambda: list(itertools.islice(records, chunk_size)), []))
+
+    processed = 0
+    # chunks finish out of order, the checkpoint only moves past chunks that finished without a gap
+    chunk_ends = {}
+    finished = {}
+    next_chunk = 0
+
+    def submit(executor, chunk_index, chunk):
+        future = executor.submit(load_chunk, [row for _, row in chunk])
+        chunk_ends[future] = chunk_index, chunk[-1][0]
+        return future
+
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker, initargs=(dsn,)) as executor:
+        # keep a couple of chunks per worker in flight instead of reading the whole file into the queue
+        pending = {submit(executor, *chunk) for chunk in itertools.islice(chunks, workers * 2)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                processed += future.result()
+                chunk_index, last_record_no = chunk_ends.pop(future)
+                finished[chunk_index] = last_record_no
+                print(f'\rProcessed: {processed}', end='', flush=True)
+
+            if next_chunk in finished:
+                while next_chunk in finished:
+                    last_record_no = finished.pop(next_chunk)
+                    next_chunk += 1
+                checkpoint.save(last_record_no)
+                db.commit()
+
+            pending |= {submit(executor, *chunk) for chunk in itertools.islice(chunks, len(done))}
+
+    checkpoint.save(checkpoint.last_record_no)
+    db.commit()
+    print(f'\rProcessed: {processed}, skipped as already loaded: {checkpoint.skipped}', end='', flush=True)
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load crawled sequences into the nrbd database')
+    parser.add_argument('filename', nargs='?', default='result.csv',
+                        help='csv, multi-fasta, JSON Lines or JSON array, optionally gzip-compressed')
+    parser.add_argument('--format', choices=['csv', 'fasta', 'jsonl', 'json'], help='detected if omitted')
+    parser.add_argument('--dsn', default=DSN)
+    parser.add_argument('--bulk', action='store_true', help='load the file with COPY and set-based inserts')
+    parser.add_argument('--reject-file', default='rejected.csv', help='where --bulk writes rows it could not load')
+    parser.add_argument('--workers', type=int, help='load the file from this many processes')
+    args = parser.parse_args()
+
     start_time = time.monotonic()
-    main()
+    if args.bulk:
+        bulk_main(args.dsn, args.filename, args.reject_file, format_=args.format)
+    elif args.workers:
+        parallel_main(args.dsn, args.filename, args.workers, format_=args.format)
+    else:
+        main(args.dsn, args.filename, format_=args.format)
     print(f'\nExecuted time: {time.monotonic() - start_time:.3f}s')
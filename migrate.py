@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import re
+import sys
+
+import psycopg2
+
+import database
+
+DSN = "dbname='nrbd' user='postgres' host='localhost' password='gulayeva'"
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.(up|down)\.sql$')
+
+# relations with fewer (estimated) rows are scanned sequentially by any sane plan
+LARGE_TABLE_ROWS = 10_000
+
+# read-only analytics of database.Database that check_plans() explains
+BASE_QUERIES = [
+    'distribution', 'math_expectation', 'std', 'mode', 'min_value', 'max_value', 'coeff', 'distribution_summary',
+]
+EACH_TO_EACH_QUERIES = [
+    'distribution_each_to_each', 'math_expectation_each_to_each', 'std_each_to_each', 'mode_each_to_each',
+    'min_value_each_to_each', 'max_value_each_to_each', 'coeff_each_to_each', 'distribution_summary_each_to_each',
+]
+
+
+class MigrationError(Exception):
+    pass
+
+
+def available_migrations(directory=MIGRATIONS_DIR):
+    """
+    {1: {'name': 'analytic_indexes', 'up': '.../0001_analytic_indexes.up.sql', 'down': '...'}, ...}
+    Every version needs both scripts, versions are applied in numeric order.
+    """
+    migrations = {}
+    for filename in sorted(os.listdir(directory)):
+        match = MIGRATION_FILE.match(filename)
+        if match is None:
+            continue
+
+        version, name, direction = int(match.group(1)), match.group(2), match.group(3)
+        migration = migrations.setdefault(version, {'name': name})
+        if migration['name'] != name:
+            raise MigrationError(f'migration {version} has scripts with different names')
+        migration[direction] = os.path.join(directory, filename)
+
+    for version, migration in migrations.items():
+        if 'up' not in migration or 'down' not in migration:
+            raise MigrationError(f'migration {version} needs both an up and a down script')
+
+    return migrations
+
+
+def applied_versions(db):
+    db.execute_query("""
+        CREATE TABLE IF NOT EXISTS public.schema_migration
+        (
+            version    integer      NOT NULL
+                CONSTRAINT schema_migration_pkey
+                    PRIMARY KEY,
+            name       varchar(255) NOT NULL,
+            applied_at timestamp DEFAULT now() NOT NULL
+        )
+    """, None, fetch=False)
+
+    return [row[0] for row in db.execute_query('SELECT version FROM public.schema_migration ORDER BY version', None)]
+
+
+def _run_script(db, filename):
+    with open(filename, encoding='utf-8') as file:
+        db.execute_query(file.read(), None, fetch=False)
+
+
+def upgrade(db, target=None, directory=MIGRATIONS_DIR):
+    """
+    Applies the migrations that are not applied yet, up to target (all if None).
+    Every migration is committed with its schema_migration row, so a failed one leaves the earlier ones applied.
+    :return: the applied versions
+    """
+    migrations = available_migrations(directory)
+    applied = set(applied_versions(db))
+    db.commit()
+
+    done = []
+    for version in sorted(migrations):
+        if version in applied or (target is not None and version > target):
+            continue
+
+        try:
+            _run_script(db, migrations[version]['up'])
+            db.execute_query('INSERT INTO public.schema_migration (version, name) VALUES (%s, %s)',
+                             [version, migrations[version]['name']], fetch=False)
+            db.commit()
+        except psycopg2.Error:
+            db.rollback()
+            raise
+
+        done.append(version)
+
+    return done
+
+
+def downgrade(db, target=0, directory=MIGRATIONS_DIR):
+    """
+    Reverts the applied migrations newer than target, the newest first.
+    :return: the reverted versions
+    """
+    migrations = available_migrations(directory)
+    applied = applied_versions(db)
+    db.commit()
+
+    done = []
+    for version in reversed(applied):
+        if version <= target:
+            break
+        if version not in migrations:
+            raise MigrationError(f'migration {version} is applied but its scripts are missing')
+
+        try:
+            _run_script(db, migrations[version]['down'])
+            db.execute_query('DELETE FROM public.schema_migration WHERE version = %s', [version], fetch=False)
+            db.commit()
+        except psycopg2.Error:
+            db.rollback()
+            raise
+
+        done.append(version)
+
+    return done
+
+
+def _sequential_scans(plan):
+    # relation names of the Seq Scan nodes of an EXPLAIN (FORMAT JSON) plan tree
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from _sequential_scans(child)
+
+
+class PlanChecker(database.Database):
+    """
+    Database that explains the queries instead of running them (they return no rows) and records the
+    sequential scans of tables with at least min_rows (estimated) rows:
+    {'query': method, 'relation': table, 'rows': estimate}.
+    """
+
+    def __init__(self, conn, min_rows=LARGE_TABLE_ROWS, **kwargs):
+        super().__init__(conn, **kwargs)
+        self.min_rows = min_rows
+        self.query_name = None
+        self.findings = []
+
+    def _table_rows(self, relation):
+        rows = super().execute_query('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)', [relation])
+        return rows[0][0] if rows and rows[0][0] is not None else 0
+
+    def execute_query(self, query, params, fetch=True, dict_return=False, many=False):
+        if not fetch or many:
+            return super().execute_query(query, params, fetch, dict_return, many)
+
+        plan = super().execute_query('EXPLAIN (FORMAT JSON) ' + query, params)[0][0]
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        for relation in sorted(set(_sequential_scans(plan[0]['Plan']))):
+            rows = self._table_rows(relation)
+            if rows >= self.min_rows:
+                self.findings.append({'query': self.query_name, 'relation': relation, 'rows': rows})
+
+        return []
+
+
+def check_plans(checker, region, base_names=('EVA', 'ANDREWS')):
+    """
+    Explains the analytics of database.Database for one region (the ones for 'ALL' read every person,
+    a sequential scan is the right plan for them) and returns the findings of the PlanChecker.
+    """
+    queries = [(name, [base_name, region]) for base_name in base_names for name in BASE_QUERIES]
+    queries += [(name, [region]) for name in EACH_TO_EACH_QUERIES]
+    queries += [('polim', [base_names[0], region]), ('allele_counts', [region])]
+    queries += [('distribution_by_region', [base_name]) for base_name in base_names]
+
+    for name, args in queries:
+        checker.query_name = name
+        getattr(checker, name)(*args)
+    checker.rollback()
+
+    return checker.findings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upgrade or downgrade the nrbd database schema')
+    parser.add_argument('command', choices=['up', 'down', 'status', 'check'])
+    parser.add_argument('--to', type=int, help='target version: the newest for up, 0 (ddl.sql) for down')
+    parser.add_argument('--dsn', default=DSN)
+    parser.add_argument('--region', help='region whose queries check explains, the first one if omitted')
+    parser.add_argument('--min-rows', type=int, default=LARGE_TABLE_ROWS,
+                        help='check reports sequential scans of tables with this many rows')
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        conn_ = psycopg2.connect(args.dsn)
+        checker_ = PlanChecker(conn_, min_rows=args.min_rows)
+        # the checker returns no rows, the regions are read by a plain Database on the same connection
+        region_ = args.region or next(iter(database.Database(conn_).get_distinct_regions()), 'ALL')
+        findings_ = check_plans(checker_, region_)
+        for finding in findings_:
+            print(f"{finding['query']}: sequential scan on {finding['relation']} ({finding['rows']} rows)")
+        print(f'{len(findings_)} sequential scans of large tables in the queries for {region_}')
+        sys.exit(1 if findings_ else 0)
+
+    db_ = database.Database(psycopg2.connect(args.dsn))
+    if args.command == 'up':
+        print('Applied:', upgrade(db_, args.to))
+    elif args.command == 'down':
+        print('Reverted:', downgrade(db_, args.to or 0))
+    else:
+        applied_ = applied_versions(db_)
+        db_.commit()
+        for version_, migration_ in sorted(available_migrations().items()):
+            print(f"{version_:04d} {migration_['name']}: {'applied' if version_ in applied_ else 'pending'}")
@@ -0,0 +1,5 @@
+drop index if exists person_reference_diff_person_id_idx;
+drop index if exists sequence_name_idx;
+drop index if exists person_sequence_id_idx;
+drop index if exists person_region_id_idx;
+drop index if exists fasta_position_sequence_id_idx;
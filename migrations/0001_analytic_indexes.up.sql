@@ -0,0 +1,29 @@
+-- Secondary indexes for the lookups of database.py, so they do not fall back to sequential scans.
+-- fasta_position is a view in the compact schema (ddl_compact.sql), its index is only created on the table.
+
+DO
+$fasta_position_sequence_id_idx$
+BEGIN
+    IF EXISTS(SELECT 1 FROM pg_class WHERE relname = 'fasta_position' AND relkind = 'r') THEN
+        -- the positions of a sequence, value included so the joins are answered from the index
+        CREATE INDEX IF NOT EXISTS fasta_position_sequence_id_idx
+            ON fasta_position (sequence_id, position) INCLUDE (value);
+    END IF;
+END
+$fasta_position_sequence_id_idx$;
+
+-- the people of a region, with the sequence to join
+create index if not exists person_region_id_idx
+    on person (region_id) include (sequence_id);
+
+-- the people of a sequence, also read when a sequence is deleted (on delete cascade)
+create index if not exists person_sequence_id_idx
+    on person (sequence_id);
+
+-- the reference sequences by name (EVA, ANDREWS, WILD_TYPE_*), UNIQUE (sequence_type, name, fasta) starts with the type
+create index if not exists sequence_name_idx
+    on sequence (name);
+
+-- the primary key starts with reference_id, this one serves deletes of people (on delete cascade)
+create index if not exists person_reference_diff_person_id_idx
+    on person_reference_diff (person_id);
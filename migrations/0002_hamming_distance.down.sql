@@ -0,0 +1,5 @@
+drop function if exists hamming_distance(sequence, sequence);
+drop function if exists hamming_distance(varchar, bit varying, varchar, bit varying);
+alter table sequence
+    drop column if exists bits;
+drop function if exists fasta_bits(varchar);
@@ -0,0 +1,49 @@
+-- Number of different positions of two sequences computed in the database: every sequence keeps its fasta as a
+-- bit string (sequence.bits, 16 bits per position, one per IUPAC code), two different codes differ in 2 bits,
+-- so the distance is the number of ones of bits_1 XOR bits_2 divided by 2. Sequences of different lengths are
+-- compared on the positions of the shorter one, like count_fasta_differences() and fasta_comp.compare_fasta().
+
+CREATE FUNCTION fasta_bits(fasta varchar) RETURNS bit varying AS
+$fasta_bits$
+-- NULL for a fasta with other characters than the IUPAC codes, hamming_distance() compares it by characters
+SELECT CASE
+           WHEN bool_and(code > 0)
+               THEN string_agg(overlay(repeat('0', 16) PLACING '1' FROM GREATEST(code, 1) FOR 1), '' ORDER BY position)::bit varying
+           END
+FROM generate_series(1, length(fasta)) AS position
+         CROSS JOIN LATERAL strpos('-ACGTMRWSYKVHDBN', substr(fasta, position, 1)) AS code
+$fasta_bits$ LANGUAGE sql IMMUTABLE;
+
+alter table sequence
+    add column bits bit varying generated always as (fasta_bits(fasta)) stored;
+
+DO
+$hamming_distance$
+DECLARE
+    -- bit_count() is there since PostgreSQL 14
+    ones text := CASE
+                     WHEN current_setting('server_version_num')::integer >= 140000 THEN 'bit_count(%s)'
+                     ELSE 'length(replace((%s)::text, ''0'', ''''))' END;
+BEGIN
+    EXECUTE format($function$
+        CREATE FUNCTION hamming_distance(fasta_1 varchar, bits_1 bit varying, fasta_2 varchar, bits_2 bit varying)
+            RETURNS integer AS
+        $body$
+        SELECT CASE
+                   WHEN bits_1 IS NULL OR bits_2 IS NULL THEN count_fasta_differences(fasta_1, fasta_2)
+                   WHEN length(bits_1) = length(bits_2) THEN (%s / 2)::integer
+                   ELSE (%s / 2)::integer
+                   END
+        $body$ LANGUAGE sql IMMUTABLE
+        $function$,
+        format(ones, 'bits_1 # bits_2'),
+        format(ones, 'substring(bits_1 FOR LEAST(length(bits_1), length(bits_2))) # '
+                         'substring(bits_2 FOR LEAST(length(bits_1), length(bits_2)))'));
+END
+$hamming_distance$;
+
+-- hamming_distance(sequence_1, sequence_2) for two rows of sequence
+CREATE FUNCTION hamming_distance(sequence_1 sequence, sequence_2 sequence) RETURNS integer AS
+$hamming_distance$
+SELECT hamming_distance(sequence_1.fasta, sequence_1.bits, sequence_2.fasta, sequence_2.bits)
+$hamming_distance$ LANGUAGE sql IMMUTABLE;
@@ -0,0 +1,9 @@
+drop trigger if exists mark_dataset_changed on person;
+drop trigger if exists mark_dataset_changed on sequence;
+drop trigger if exists mark_dataset_changed on region;
+drop trigger if exists bump_dataset_version on person;
+drop trigger if exists bump_dataset_version on sequence;
+drop trigger if exists bump_dataset_version on region;
+drop function if exists mark_dataset_changed();
+drop function if exists bump_dataset_version();
+drop table if exists dataset_version;
@@ -0,0 +1,61 @@
+-- A counter of the committed transactions that changed person, sequence or region, for caches of the analytics
+-- (database.QueryCache). It is bumped once per transaction by deferred triggers, at commit, so concurrent loaders
+-- only hold its row lock while they commit. nrbd.dataset_changed marks the transaction as soon as it writes:
+-- its own reads see the changes before they are counted and must not be answered from a cache.
+
+create table dataset_version
+(
+    id      boolean default true not null
+        constraint dataset_version_pkey
+            primary key
+        constraint dataset_version_id_check
+            check (id),
+    version bigint  default 0    not null
+);
+
+alter table dataset_version
+    owner to postgres;
+
+insert into dataset_version (id, version)
+values (true, 0);
+
+CREATE FUNCTION mark_dataset_changed() RETURNS trigger AS
+$mark_dataset_changed$
+BEGIN
+    PERFORM set_config('nrbd.dataset_changed', 'on', true);
+    IF TG_OP = 'TRUNCATE' AND current_setting('nrbd.dataset_version_bumped', true) IS DISTINCT FROM 'on' THEN
+        -- no row triggers fire, the counter is bumped right away
+        UPDATE dataset_version SET version = version + 1;
+        PERFORM set_config('nrbd.dataset_version_bumped', 'on', true);
+    END IF;
+    RETURN NULL;
+END
+$mark_dataset_changed$ LANGUAGE plpgsql;
+
+CREATE FUNCTION bump_dataset_version() RETURNS trigger AS
+$bump_dataset_version$
+BEGIN
+    IF current_setting('nrbd.dataset_version_bumped', true) IS DISTINCT FROM 'on' THEN
+        UPDATE dataset_version SET version = version + 1;
+        PERFORM set_config('nrbd.dataset_version_bumped', 'on', true);
+    END IF;
+    RETURN NULL;
+END
+$bump_dataset_version$ LANGUAGE plpgsql;
+
+DO
+$dataset_version_triggers$
+DECLARE
+    table_name text;
+BEGIN
+    FOREACH table_name IN ARRAY ARRAY ['person', 'sequence', 'region']
+        LOOP
+            EXECUTE format('create trigger mark_dataset_changed after insert or update or delete or truncate on %I '
+                               'for each statement execute procedure mark_dataset_changed()', table_name);
+            -- constraint triggers are row level only, the function updates the counter on the first row
+            EXECUTE format('create constraint trigger bump_dataset_version after insert or update or delete on %I '
+                               'deferrable initially deferred '
+                               'for each row execute procedure bump_dataset_version()', table_name);
+        END LOOP;
+END
+$dataset_version_triggers$;
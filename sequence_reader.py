@@ -0,0 +1,185 @@
+import csv
+import gzip
+import json
+import os
+from typing import Iterator, List, TextIO
+
+DEFAULT_REGION: str = 'UND'
+CHUNK_SIZE: int = 1 << 16
+
+FORMATS: dict = {
+    '.csv': 'csv',
+    '.fasta': 'fasta',
+    '.fa': 'fasta',
+    '.fas': 'fasta',
+    '.fna': 'fasta',
+    '.fsa': 'fasta',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.json': 'json',
+}
+
+
+class SequenceReaderError(Exception):
+    pass
+
+
+def open_text(filename: str) -> TextIO:
+    """
+    Opens plain or gzip-compressed (detected by the magic bytes, not the name) input as text.
+    """
+    with open(filename, 'rb') as file:
+        magic: bytes = file.read(2)
+
+    if magic == b'\x1f\x8b':
+        return gzip.open(filename, 'rt', newline='')
+
+    return open(filename, newline='')
+
+
+def detect_format(filename: str, stream: TextIO = None) -> str:
+    name: str = filename[:-3] if filename.endswith('.gz') else filename
+    extension: str = os.path.splitext(name)[1].lower()
+    if extension in FORMATS:
+        return FORMATS[extension]
+
+    if stream is None:
+        raise SequenceReaderError(f'cannot detect format of \'{filename}\'')
+
+    # peeking does not move the gzip/text stream: read the first character and rewind
+    first: str = stream.read(CHUNK_SIZE).lstrip()[:1]
+    stream.seek(0)
+
+    return {'>': 'fasta', '[': 'json', '{': 'jsonl'}.get(first, 'csv')
+
+
+def read_csv(stream: TextIO) -> Iterator[List[str]]:
+    """
+    Crawler csv: version,region,fasta with a header line. Rows are passed as they are,
+    so malformed ones can be rejected by the caller.
+    """
+    reader = csv.reader(stream, delimiter=',')
+    next(reader, None)  # skip csv headers
+    for row in reader:
+        yield row
+
+
+def read_multi_fasta(stream: TextIO, region: str = DEFAULT_REGION) -> Iterator[List[str]]:
+    """
+    >JX896112.1|IF                     version and region separated by '|'
+    >JX896112.1 region=IF description  region given as a token
+    >JX896112.1 description            region defaults to `region`
+    Sequence lines are joined and upper-cased, ';' comment lines are skipped.
+    """
+    header: str = None
+    lines: List[str] = []
+
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith(';'):
+            continue
+
+        if line.startswith('>'):
+            if header is not None:
+                yield _fasta_record(header, lines, region)
+            header, lines = line[1:], []
+        elif header is None:
+            raise SequenceReaderError('sequence data before the first fasta header')
+        else:
+            lines.append(line)
+
+    if header is not None:
+        yield _fasta_record(header, lines, region)
+
+
+def _fasta_record(header: str, lines: List[str], region: str) -> List[str]:
+    if '|' in header:
+        version, header_region = (part.strip() for part in header.split('|')[:2])
+        return [version, header_region or region, ''.join(lines).upper()]
+
+    tokens: List[str] = header.split()
+    version: str = tokens[0] if tokens else ''
+    for token in tokens[1:]:
+        if token.startswith('region='):
+            region = token[len('region='):]
+
+    return [version, region, ''.join(lines).upper()]
+
+
+def read_json_lines(stream: TextIO) -> Iterator[List[str]]:
+    for line in stream:
+        if line.strip():
+            yield _json_record(json.loads(line))
+
+
+def read_json_array(stream: TextIO, chunk_size: int = CHUNK_SIZE) -> Iterator[List[str]]:
+    """
+    Incremental parser for a top-level array of records (result.json): the file is read in chunks
+    and every element is decoded as soon as it is complete, so only one element is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer: str = ''
+    position: int = 0
+    opened: bool = False
+    eof: bool = False
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+
+        if position < len(buffer):
+            if not opened:
+                if buffer[position] != '[':
+                    raise SequenceReaderError('expected a JSON array')
+                opened = True
+                position += 1
+                continue
+
+            if buffer[position] == ']':
+                return
+
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield _json_record(item)
+                continue
+
+        if eof:
+            raise SequenceReaderError('unexpected end of JSON array')
+
+        chunk: str = stream.read(chunk_size)
+        eof = not chunk
+        buffer, position = buffer[position:] + chunk, 0
+
+
+def _json_record(item: dict) -> List[str]:
+    return [item.get('version', ''), item.get('region', ''), item.get('fasta', '')]
+
+
+def read_sequences(filename: str, format_: str = None) -> Iterator[List[str]]:
+    """
+    read_sequences('result.json.gz') -> ['JX896112.1', 'UND', 'TTCTTTCATG...'], ...
+    :param filename: csv, multi-fasta, JSON Lines or JSON array file, optionally gzip-compressed
+    :param format_: 'csv', 'fasta', 'jsonl' or 'json'; detected from the name or the content if None
+    :return: lazy iterator of [version, region, fasta] records
+    """
+    with open_text(filename) as stream:
+        format_ = format_ or detect_format(filename, stream)
+        readers: dict = {
+            'csv': read_csv,
+            'fasta': read_multi_fasta,
+            'jsonl': read_json_lines,
+            'json': read_json_array,
+        }
+        if format_ not in readers:
+            raise SequenceReaderError(f'unknown format \'{format_}\'')
+
+        yield from readers[format_](stream)
+
+
+if __name__ == '__main__':
+    for record in read_sequences('result.json'):
+        print(record[0], record[1], record[2][:20])
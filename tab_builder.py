@@ -1,34 +1,50 @@
+import concurrent.futures
+import threading
+from typing import Dict, List, Union
+
 import psycopg2
 
+import analytics
 import database
 import xlsx_wrapper
 
+# base sequences of every tab, their distributions are computed for all regions at once
+SHARED_BASES = ['EVA', 'ANDREWS']
+
 
 class TabBuilder:
-    def __init__(self, wrapper: xlsx_wrapper.XlsxWrapper, db: database.Database, dist_range: int = 20):
+    def __init__(
+            self,
+            wrapper: xlsx_wrapper.XlsxWrapper,
+            db: Union[database.Database, analytics.SequenceMatrix],
+            dist_range: int = 20
+    ):
+        # db: SequenceMatrix computes the statistics in memory instead of SQL
         self._dist_range: int = dist_range
         self._wrapper: xlsx_wrapper.XlsxWrapper = wrapper
-        self._db: database.Database = db
+        self._db: Union[database.Database, analytics.SequenceMatrix] = db
+        # base_name -> distribution_by_region(base_name), all regions are computed once per shared base sequence
+        self._by_region: Dict[str, Dict[str, dict]] = {}
+        # one lock per base_name, so the threads of build_all() compute every base once
+        self._by_region_locks: Dict[str, threading.Lock] = {}
 
-    def build_distribution(self, tab: str, base_name: str = None):
-        # base_name: str --- None - for with each other; 'EVA', etc. - for others
+    def _summary(self, tab: str, base_name: str = None) -> dict:
         if base_name is None:
-            res = self._db.rosp_each_to_each(tab)
-            math_expectation = self._db.math_expectation_each_to_each(tab)[0]['math_expectation']
-            std = self._db.std_each_to_each(tab)[0]['standart_dev']
-            mode = self._db.mode_each_to_each(tab)[0]['diff_num']
-            min_value = self._db.min_value_each_to_each(tab)[0]['min']
-            max_value = self._db.max_value_each_to_each(tab)[0]['max']
-            coeff = self._db.coeff_each_to_each(tab)[0]['koef']
+            return self._db.distribution_summary_each_to_each(tab)
 
-        else:
-            res = self._db.distribution(base_name, tab)
-            math_expectation = self._db.math_expectation(base_name, tab)[0]['math_expectation']
-            std = self._db.std(base_name, tab)[0]['standart_dev']
-            mode = self._db.mode(base_name, tab)[0]['diff_num']
-            min_value = self._db.min_value(base_name, tab)[0]['min']
-            max_value = self._db.max_value(base_name, tab)[0]['max']
-            coeff = self._db.coeff(base_name, tab)[0]['koef']
+        # the wild type of a tab is only compared with its own region
+        if base_name not in SHARED_BASES:
+            return self._db.distribution_summary(base_name, tab)
+
+        # the first tab that needs a shared base computes it for all of them, the others wait for it
+        with self._by_region_locks.setdefault(base_name, threading.Lock()):
+            if base_name not in self._by_region:
+                self._by_region[base_name] = self._db.distribution_by_region(base_name)
+        # regions without people are not in the results
+        return self._by_region[base_name].get(tab) or self._db.distribution_summary(base_name, tab)
+
+    def _insert_distribution(self, tab: str, base_name: str, summary: dict):
+        res = summary['distribution']
 
         line_1 = [j["frequency"] for i in range(self._dist_range) for j in res if j["diff_num"] == i]
         line_2 = [j["p"] for i in range(self._dist_range) for j in res if j["diff_num"] == i]
@@ -42,39 +58,79 @@ class TabBuilder:
             tab,
             {
                 dist_name_1: line_1, dist_name_2: line_2,
-                'values': {
-                    'mean': math_expectation,
-                    'std': std,
-                    'mode': mode,
-                    'min': min_value,
-                    'max': max_value,
-                    'coeff': coeff
-                }
+                'values': summary['values']
             }
         )
 
-    def build_wild_type_and_poly(self, tab: str):
+    def build_distribution(self, tab: str, base_name: str = None):
+        # base_name: str --- None - for with each other; 'EVA', etc. - for others
+        self._insert_distribution(tab, base_name, self._summary(tab, base_name))
+
+    def _wild_type_and_poly(self, tab: str) -> list:
         wild_type = self._db.select("public.sequence", [f"name='WILD_TYPE_{tab}'"], first_=True)
 
         poly_eva = self._db.polim('EVA', tab)
         poly_andrews = self._db.polim('ANDREWS', tab)
         poly_wild = self._db.polim('WILD_TYPE_ALL', tab)
 
-        self._wrapper.insert_wild_type(
-            tab, wild_type[3], poly_eva[0][0], poly_andrews[0][0], poly_wild[0][0], 0
-        )
+        return [wild_type[3], poly_eva[0][0], poly_andrews[0][0], poly_wild[0][0], 0]
 
-    def build(self, tab: str = 'ALL'):
-        dist_range = [x for x in range(self._dist_range)]
-        self._wrapper.insert_distances(tab, dist_range)
+    def build_wild_type_and_poly(self, tab: str):
+        self._wrapper.insert_wild_type(tab, *self._wild_type_and_poly(tab))
 
+    def collect(self, tab: str = 'ALL') -> dict:
+        """
+        Everything build() writes to the sheet of the tab, read from the database without touching the wrapper,
+        so the tabs can be collected from several threads (with a database.PooledDatabase).
+        """
         self._db.calculate_wild(tab)
         self._db.commit()
 
-        for base_name in ['EVA', 'ANDREWS', f'WILD_TYPE_{tab}', None]:  # None for 'with each other'
-            self.build_distribution(tab, base_name)
+        data = {
+            'distributions': [
+                (base_name, self._summary(tab, base_name))
+                for base_name in ['EVA', 'ANDREWS', f'WILD_TYPE_{tab}', None]  # None for 'with each other'
+            ],
+            'wild_type_and_poly': self._wild_type_and_poly(tab),
+        }
+        self._db.commit()  # statistics the data source keeps in the database
+
+        return data
 
-        self.build_wild_type_and_poly(tab)
+    def write(self, tab: str, data: dict):
+        # the wrapper is not thread-safe, tabs are written one by one
+        self._wrapper.insert_distances(tab, [x for x in range(self._dist_range)])
+
+        for base_name, summary in data['distributions']:
+            self._insert_distribution(tab, base_name, summary)
+
+        self._wrapper.insert_wild_type(tab, *data['wild_type_and_poly'])
+
+    def build(self, tab: str = 'ALL'):
+        self.write(tab, self.collect(tab))
+
+    def build_all(self, tabs: List[str], workers: int = 1):
+        """
+        Collects the tabs from `workers` threads and writes them in the given order as soon as they are ready.
+        Use workers > 1 with a database.PooledDatabase (a connection per thread) only, SequenceMatrix and
+        Database are not thread-safe.
+        """
+        if workers <= 1:
+            for tab in tabs:
+                self.build(tab)
+            return
+
+        def collect(tab: str) -> dict:
+            try:
+                return self.collect(tab)
+            finally:
+                if isinstance(self._db, database.PooledDatabase):
+                    self._db.release()  # the threads end with the executor, their connections go back to the pool
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            collected = [executor.submit(collect, tab) for tab in tabs]
+            for tab, data in zip(tabs, collected):
+                self.write(tab, data.result())
 
 
 if __name__ == '__main__':
@@ -83,11 +139,16 @@ if __name__ == '__main__':
         psycopg2.connect("dbname='nrbd' user='postgres' host='localhost' password='postgres'"),
         debug=True
     )
+    # loads every sequence once, the statistics are computed with NumPy, "each to each" ones are updated
+    # with the people loaded since the previous report
+    db_ = analytics.SequenceMatrix(db_, incremental=True)
+    # or compute them in SQL with a connection per region:
+    # db_ = database.PooledDatabase("dbname='nrbd' user='postgres' host='localhost' password='postgres'", 7)
 
     districts = ['ALL', 'IF', 'BK', 'BG', 'ST', 'CH', 'KHM']
     # districts = ['ALL', *db_.get_distinct_regions()] # failed on MODE calculation for 'ANDREWS' + 'B' region
 
-    for tab_ in districts:
-        TabBuilder(wrapper_, db_).build(tab_)
+    builder_ = TabBuilder(wrapper_, db_)
+    builder_.build_all(districts, workers=7 if isinstance(db_, database.PooledDatabase) else 1)
 
     wrapper_.save()
@@ -0,0 +1,57 @@
+import os
+import sys
+import uuid
+
+import psycopg2
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+import database  # noqa: E402
+
+# a connection allowed to create databases, the tests that need PostgreSQL are skipped without it:
+# NRBD_TEST_ADMIN_DSN="dbname=postgres user=postgres host=localhost" python -m pytest
+ADMIN_DSN = os.environ.get('NRBD_TEST_ADMIN_DSN')
+
+
+@pytest.fixture
+def pg_create():
+    """
+    create() makes a new database of ddl.sql (and ddl_compact.sql if compact) and the migrations and returns
+    its dsn. The databases are dropped after the test.
+    """
+    if not ADMIN_DSN:
+        pytest.skip('NRBD_TEST_ADMIN_DSN is not set')
+
+    creator = benchmark.Benchmark(ADMIN_DSN)
+    names = []
+
+    def create(compact=False):
+        names.append(f'nrbd_test_{uuid.uuid4().hex[:12]}')
+        return benchmark.Benchmark(ADMIN_DSN, compact=compact).create_database(names[-1])
+
+    yield create
+
+    for name in names:
+        creator.drop_database(name)
+
+
+@pytest.fixture
+def pg_connect(pg_create):
+    """
+    connect() opens a database.Database on a new database of ddl.sql and the migrations, every call a connection
+    of its own. The database is dropped after the test.
+    """
+    dsn = pg_create()
+    connections = []
+
+    def connect():
+        conn = psycopg2.connect(dsn)
+        connections.append(conn)
+        return database.Database(conn)
+
+    yield connect
+
+    for conn in connections:
+        conn.close()
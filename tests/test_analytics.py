@@ -0,0 +1,146 @@
+import collections
+import itertools
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+import analytics
+import embedded
+import main
+
+IUPAC = 'ACGTMRWSYKVHDBN-'
+
+
+def random_fasta(rng, count, lengths=(370, 377)):
+    # EVA with random IUPAC substitutions, of mixed lengths
+    eva = main.BASE_SEQUENCES['EVA']
+    fasta = []
+    for _ in range(count):
+        letters = list(eva[:rng.integers(lengths[0], lengths[1] + 1)])
+        for position in rng.choice(len(letters), size=rng.integers(0, 12), replace=False):
+            letters[position] = IUPAC[rng.integers(len(IUPAC))]
+        fasta.append(''.join(letters))
+    return fasta
+
+
+def differences(fasta_1, fasta_2):
+    # positions that both sequences have, as count_fasta_differences() of ddl.sql
+    return sum(x != y for x, y in zip(fasta_1, fasta_2))
+
+
+def brute_force_histogram(pairs, length):
+    frequencies = np.zeros(length + 1, dtype=np.int64)
+    for fasta_1, fasta_2 in pairs:
+        frequencies[differences(fasta_1, fasta_2)] += 1
+    return frequencies
+
+
+@pytest.mark.parametrize('dividend, divisor, quotient', [
+    # SELECT a::numeric / b::numeric
+    (1, 3, '0.33333333333333333333'),
+    (2, 3, '0.66666666666666666667'),
+    (0, 7, '0.00000000000000000000'),
+    (10000, 3, '3333.3333333333333333'),
+    (1, 7, '0.14285714285714285714'),
+    (5, 10, '0.50000000000000000000'),
+    (123456789, 1000, '123456.789000000000'),
+    (1, 100000, '0.000010000000000000000000'),
+    (99999, 100000, '0.99999000000000000000'),
+    (2, 2, '1.00000000000000000000'),
+    (9999, 10000, '0.99990000000000000000'),
+    (10000, 9999, '1.0001000100010001'),
+])
+def test_numeric_div(dividend, divisor, quotient):
+    result = analytics.numeric_div(dividend, divisor)
+    assert result == Decimal(quotient)
+    assert format(result, 'f') == quotient
+
+
+@pytest.mark.parametrize('block_size', [1, 3, analytics.BLOCK_SIZE])
+def test_pairwise_histogram(block_size):
+    rng = np.random.default_rng(12)
+    fasta = random_fasta(rng, 9)
+    weights = rng.integers(1, 4, size=len(fasta))
+    people = [x for x, weight in zip(fasta, weights) for _ in range(weight)]
+    length = max(len(x) for x in fasta)
+
+    frequencies = analytics.pairwise_histogram(
+        analytics.encode([x.encode() for x in fasta], length), weights, block_size
+    )
+    assert frequencies.tolist() == brute_force_histogram(itertools.combinations(people, 2), length).tolist()
+
+
+@pytest.mark.parametrize('block_size', [1, 4, analytics.BLOCK_SIZE])
+def test_cross_histogram(block_size):
+    rng = np.random.default_rng(13)
+    fasta_1, fasta_2 = random_fasta(rng, 7), random_fasta(rng, 5)
+    weights_1, weights_2 = rng.integers(1, 4, size=len(fasta_1)), rng.integers(1, 4, size=len(fasta_2))
+    people_1 = [x for x, weight in zip(fasta_1, weights_1) for _ in range(weight)]
+    people_2 = [x for x, weight in zip(fasta_2, weights_2) for _ in range(weight)]
+    length = max(len(x) for x in fasta_1 + fasta_2)
+
+    frequencies = analytics.cross_histogram(
+        analytics.encode([x.encode() for x in fasta_1], length), weights_1,
+        analytics.encode([x.encode() for x in fasta_2], length), weights_2, block_size
+    )
+    assert frequencies.tolist() == brute_force_histogram(itertools.product(people_1, people_2), length).tolist()
+
+
+@pytest.fixture
+def embedded_db():
+    # 60 people of three regions, a few of them share a sequence
+    rng = np.random.default_rng(14)
+    db = embedded.EmbeddedDatabase(':memory:')
+    main.insert_base_sequences(db)
+    fasta = random_fasta(rng, 40)
+    for number in range(60):
+        region = db.get_region(['BG', 'RU', 'IF'][number % 3])
+        sequence = db.insert_sequence(fasta[rng.integers(len(fasta))])
+        db.insert_person(region['id'], sequence['id'], f'person/{number}')
+    db.commit()
+    yield db
+    db.close()
+
+
+def people_fasta(db, region):
+    return [x[0] for x in db.execute_query(
+        'SELECT sequence.fasta FROM (person INNER JOIN region ON person.region_id = region.id) '
+        'INNER JOIN sequence ON person.sequence_id = sequence.id '
+        'WHERE sequence.sequence_type = 0 AND %s IN (\'ALL\', region.name) ORDER BY person.id', [region]
+    )]
+
+
+@pytest.mark.parametrize('region', ['BG', 'RU', 'ALL'])
+def test_engine_matches_recomputation(embedded_db, region):
+    fasta = people_fasta(embedded_db, region)
+    length = max(len(x) for x in fasta)
+    matrix = analytics.SequenceMatrix(embedded_db, block_size=7)
+
+    each_to_each = brute_force_histogram(itertools.combinations(fasta, 2), length)
+    assert matrix.distribution_summary_each_to_each(region) == analytics.summary(each_to_each)
+
+    for base_name, base in main.BASE_SEQUENCES.items():
+        to_base = brute_force_histogram(((base, x) for x in fasta), length)
+        assert matrix.distribution_summary(base_name, region) == analytics.summary(to_base)
+
+
+def test_engine_wild_types_match_recomputation(embedded_db):
+    wild_types = analytics.SequenceMatrix(embedded_db).wild_types()
+    for region in ['BG', 'RU', 'ALL']:
+        fasta = people_fasta(embedded_db, region)
+        expected = []
+        for position in range(max(len(x) for x in fasta)):
+            counts = collections.Counter(x[position] for x in fasta if position < len(x))
+            # the most frequent value, the smallest one wins a tie
+            expected.append(min(counts, key=lambda value: (-counts[value], value)))
+        assert wild_types[region] == ''.join(expected)
+
+
+def test_embedded_allele_counts_match_recomputation(embedded_db):
+    for region in ['BG', 'RU', 'ALL']:
+        counts = collections.Counter(
+            (position + 1, value) for fasta in people_fasta(embedded_db, region) for position, value in enumerate(fasta)
+        )
+        assert embedded_db.allele_counts(region) == [(*key, counts[key]) for key in sorted(counts)]
+    assert embedded_db.allele_counts('XX') == []
@@ -0,0 +1,32 @@
+import psycopg2
+
+import database
+import main
+
+FASTA = [main.BASE_SEQUENCES['EVA'], main.BASE_SEQUENCES['ANDREWS'][:300], 'ACGTACGTAC', 'NNACGTY']
+
+
+def load(dsn):
+    conn = psycopg2.connect(dsn)
+    db = database.Database(conn)
+    main.insert_base_sequences(db)
+    region_id = db.get_region('BG')['id']
+    for number, fasta in enumerate(FASTA):
+        db.insert_person(region_id, db.insert_sequence(fasta)['id'], f'person/{number}')
+    db.commit()
+    return conn, db
+
+
+def test_fasta_position_view_matches_the_table(pg_create):
+    conn, db = load(pg_create())
+    compact_conn, compact_db = load(pg_create(compact=True))
+
+    sql = 'SELECT sequence_id, position, value FROM fasta_position ORDER BY 1, 2'
+    positions = db.execute_query(sql, None)
+    assert len(positions) == sum(len(x) for x in FASTA) + sum(len(x) for x in main.BASE_SEQUENCES.values())
+    assert compact_db.execute_query(sql, None) == positions
+
+    for base_name in main.BASE_SEQUENCES:
+        assert compact_db.distribution_summary(base_name, 'BG') == db.distribution_summary(base_name, 'BG')
+    conn.close()
+    compact_conn.close()
@@ -0,0 +1,37 @@
+import embedded
+import main
+
+
+def load_references(db):
+    main.insert_base_sequences(db)
+    ids = [db.get_region('BG')['id'], db.insert_sequence('ACGTACGTAC')['id'],
+           db.insert_sequence('ACGTACGTAC', type_=2, name='WILD_TYPE_BG')['id']]
+    ids += [db.get_sequence(fasta, 1)['id'] for fasta in main.BASE_SEQUENCES.values()]
+    db.commit()
+    return ids
+
+
+def test_existing_rows_are_not_rewritten(pg_connect):
+    db = pg_connect()
+    ids = load_references(db)
+    version = db.dataset_version()
+    row_versions = db.execute_query('SELECT xmin::text FROM sequence UNION ALL SELECT xmin::text FROM region', None)
+
+    # a new Database has an empty identity map, every row is upserted again
+    again = pg_connect()
+    assert load_references(again) == ids
+    assert again.dataset_version() == version
+    assert again.execute_query('SELECT xmin::text FROM sequence UNION ALL SELECT xmin::text FROM region',
+                               None) == row_versions
+
+
+def test_existing_rows_are_not_rewritten_embedded(tmp_path):
+    db = embedded.EmbeddedDatabase(str(tmp_path / 'nrbd.sqlite'))
+    ids = load_references(db)
+    version = db.dataset_version()
+
+    again = embedded.EmbeddedDatabase(str(tmp_path / 'nrbd.sqlite'))
+    assert load_references(again) == ids
+    assert again.dataset_version() == version
+    db.close()
+    again.close()
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import fasta_comp
+
+IUPAC = ''.join(fasta_comp.IUPAC_CODES)
+
+
+@pytest.fixture
+def fasta():
+    # random IUPAC sequences of mixed lengths, across word boundaries (64 positions)
+    rng = np.random.default_rng(12)
+    return [''.join(rng.choice(list(IUPAC), size=length)) for length in rng.integers(0, 200, size=25)]
+
+
+def test_distance_matches_compare_fasta(fasta):
+    for fasta_1 in fasta:
+        for fasta_2 in fasta:
+            expected = len(fasta_comp.compare_fasta(fasta_1, fasta_2))
+            assert fasta_comp.PackedSequence(fasta_1).distance(fasta_comp.PackedSequence(fasta_2)) == expected
+
+
+def test_one_against_many(fasta):
+    packed = fasta_comp.pack_fasta(fasta)
+    for fasta_1 in fasta:
+        expected = [len(fasta_comp.compare_fasta(fasta_1, x)) for x in fasta]
+        assert fasta_comp.PackedSequence(fasta_1).distances(packed).tolist() == expected
+        assert fasta_comp.count_differences(fasta_comp.pack_fasta([fasta_1], packed.shape[2] * 64)[0],
+                                            packed).tolist() == expected
+
+
+def test_many_against_many(fasta):
+    packed = fasta_comp.pack_fasta(fasta)
+    expected = [[len(fasta_comp.compare_fasta(x, y)) for y in fasta] for x in fasta]
+    assert fasta_comp.count_differences(packed, packed).tolist() == expected
+    assert fasta_comp.count_differences(packed[:0], packed).shape == (0, len(fasta))
+
+
+def test_layout():
+    packed = fasta_comp.pack_fasta(['ACGT' * 94 + 'A'])
+    assert packed.shape == (1, fasta_comp.PLANES, 6)
+    assert packed.nbytes == 240
+    assert len(fasta_comp.PackedSequence('ACGTN')) == 5
+
+
+def test_unknown_code():
+    with pytest.raises(ValueError, match="'X' at position 2"):
+        fasta_comp.pack_fasta(['ACGT', 'ACXT'])
@@ -0,0 +1,62 @@
+import csv
+
+import psycopg2
+
+import database
+import embedded
+import main
+
+ROWS = [
+    ['JX000001.1', 'BG', 'ACGTACGTAC'],
+    ['JX000002.1', 'RU', 'ACGTACGTTT'],
+    ['', 'BG', 'ACGTACGTAC'],
+    ['JX000003.1', '', 'TCGAACGTAC'],
+    ['JX000004.1', 'IF', ''],
+    ['JX000005.1', 'RU', 'ACGTACGTTT', 'an extra column'],
+    ['JX000001.1', 'RU', 'GGGTACGTAA'],
+    ['JX000006.1', 'BG', 'GGGTACGTAA'],
+]
+
+
+def tables(db):
+    return {
+        table: db.execute_query(f'SELECT {columns} FROM {table} ORDER BY id', None)
+        for table, columns in [('region', 'id, name'), ('sequence', 'id, sequence_type, name, fasta'),
+                               ('person', 'id, region_id, sequence_id, url')]
+    }
+
+
+def load(tmp_path, main_dsn, bulk_dsn):
+    filename = tmp_path / 'people.csv'
+    with open(filename, 'w', newline='') as file:
+        csv.writer(file).writerows([['version', 'region', 'fasta']] + ROWS)
+
+    main.main(main_dsn, str(filename))
+    main.bulk_main(bulk_dsn, str(filename), str(tmp_path / 'rejected.csv'))
+
+    with open(tmp_path / 'rejected.csv', newline='') as file:
+        assert [x[0] for x in csv.reader(file)][1:] == ['7']
+
+
+def test_bulk_main_loads_what_main_loads(tmp_path):
+    load(tmp_path, f'{embedded.DSN_PREFIX}{tmp_path / "main.sqlite"}', f'{embedded.DSN_PREFIX}{tmp_path / "bulk.sqlite"}')
+
+    main_db, bulk_db = embedded.EmbeddedDatabase(str(tmp_path / 'main.sqlite')), \
+        embedded.EmbeddedDatabase(str(tmp_path / 'bulk.sqlite'))
+    loaded = tables(main_db)
+    assert len(loaded['person']) == len(ROWS) - 1
+    assert tables(bulk_db) == loaded
+    main_db.close()
+    bulk_db.close()
+
+
+def test_bulk_main_loads_what_main_loads_postgres(tmp_path, pg_create):
+    main_dsn, bulk_dsn = pg_create(), pg_create()
+    load(tmp_path, main_dsn, bulk_dsn)
+
+    connections = [psycopg2.connect(main_dsn), psycopg2.connect(bulk_dsn)]
+    loaded = tables(database.Database(connections[0]))
+    assert len(loaded['person']) == len(ROWS) - 1
+    assert tables(database.Database(connections[1])) == loaded
+    for conn in connections:
+        conn.close()
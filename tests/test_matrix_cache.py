@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import pytest
+
+import analytics
+import embedded
+import main
+
+FASTA = ['ACGTACGTAC', 'ACGTACGTTT', 'TCGAACGTAC', 'ACGTACG', 'GGGTACGTAA']
+
+
+def open_database(path, people, region='BG', **kwargs):
+    db = embedded.EmbeddedDatabase(str(path), **kwargs)
+    main.insert_base_sequences(db)
+    region_id = db.get_region(region)['id']
+    for number in range(people):
+        db.insert_person(region_id, db.insert_sequence(FASTA[number % len(FASTA)])['id'], f'person/{number}')
+    db.commit()
+    return db
+
+
+def versions(cache_directory):
+    # <database digest>/<dataset_version> directories, without the temporary ones
+    return sorted(
+        os.path.join(database, version)
+        for database in os.listdir(cache_directory)
+        for version in os.listdir(os.path.join(cache_directory, database))
+        if not version.startswith('.')
+    )
+
+
+def assert_arrays_equal(loaded, db):
+    arrays, meta = analytics.read_arrays(db)
+    assert loaded[1] == meta
+    for name in analytics.MATRIX_ARRAYS:
+        assert np.array_equal(loaded[0][name], arrays[name])
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = open_database(tmp_path / 'nrbd.sqlite', 4)
+    yield db
+    db.close()
+
+
+def test_version_is_memory_mapped(db, tmp_path):
+    cache = analytics.MatrixCache(str(tmp_path / 'cache'))
+    written = cache.load(db)
+    database_directory = os.listdir(tmp_path / 'cache')[0]
+    assert versions(tmp_path / 'cache') == [os.path.join(database_directory, str(db.dataset_version()))]
+
+    loaded = cache.load(db)
+    assert isinstance(loaded[0]['matrix'], np.memmap)
+    assert_arrays_equal(written, db)
+    assert_arrays_equal(loaded, db)
+
+
+def test_changed_data_replaces_the_version(db, tmp_path):
+    cache = analytics.MatrixCache(str(tmp_path / 'cache'))
+    cache.load(db)
+    old_versions = versions(tmp_path / 'cache')
+
+    db.insert_person(db.get_region('RU')['id'], db.insert_sequence('TTTTACGTAC')['id'], 'person/added')
+    # uncommitted changes are read from the database and not cached
+    assert db.dataset_version() is None
+    assert_arrays_equal(cache.load(db), db)
+    assert versions(tmp_path / 'cache') == old_versions
+
+    db.commit()
+    loaded = cache.load(db)
+    assert_arrays_equal(loaded, db)
+    assert 'RU' in loaded[1]['regions']
+    assert len(versions(tmp_path / 'cache')) == 1
+    assert versions(tmp_path / 'cache') != old_versions
+
+
+def test_databases_share_the_directory(tmp_path):
+    cache = analytics.MatrixCache(str(tmp_path / 'cache'))
+    db_1 = open_database(tmp_path / 'nrbd_1.sqlite', 4, region='BG')
+    db_2 = open_database(tmp_path / 'nrbd_2.sqlite', 4, region='RU')
+    assert db_1.dataset_version() == db_2.dataset_version()
+
+    assert cache.load(db_1)[1]['regions'] == ['BG']
+    assert cache.load(db_2)[1]['regions'] == ['RU']
+    assert cache.load(db_1)[1]['regions'] == ['BG']
+    assert len(versions(tmp_path / 'cache')) == 2
+    db_1.close()
+    db_2.close()
+
+
+def test_removed_version_is_read_from_the_database(db, tmp_path):
+    # another process replaced the version between the check and np.load()
+    cache = analytics.MatrixCache(str(tmp_path / 'cache'))
+    cache.load(db)
+    os.remove(os.path.join(tmp_path / 'cache', versions(tmp_path / 'cache')[0], 'matrix.npy'))
+
+    loaded = cache.load(db)
+    assert not isinstance(loaded[0]['matrix'], np.memmap)
+    assert_arrays_equal(loaded, db)
+
+
+def test_report_follows_the_data(tmp_path):
+    cache = analytics.MatrixCache(str(tmp_path / 'cache'))
+    cached = open_database(tmp_path / 'nrbd.sqlite', 6, matrix_cache=cache)
+    uncached = embedded.EmbeddedDatabase(str(tmp_path / 'nrbd.sqlite'))
+
+    for change in range(4):
+        if change:
+            cached.insert_person(cached.get_region('BG')['id'], cached.insert_sequence(FASTA[change])['id'],
+                                 f'person/added/{change}')
+            cached.commit()
+
+        for region in ['BG', 'ALL']:
+            assert cached.distribution_summary('EVA', region) == uncached.distribution_summary('EVA', region)
+            assert cached.distribution_summary_each_to_each(region) == \
+                uncached.distribution_summary_each_to_each(region)
+
+    cached.close()
+    uncached.close()
@@ -0,0 +1,88 @@
+import itertools
+
+import numpy as np
+
+import analytics
+
+FASTA = ['ACGTACGTAC', 'ACGTACGTTT', 'TCGAACGTAC', 'ACGTACGTAC', 'GGGTACGTAA', 'ACCTACGTAC']
+
+
+def recomputed(db, region):
+    # brute force: differences of every pair of people of the region
+    fasta = [x[0] for x in db.execute_query(
+        'SELECT sequence.fasta FROM (person INNER JOIN region ON person.region_id = region.id) '
+        'INNER JOIN sequence ON person.sequence_id = sequence.id '
+        'WHERE sequence.sequence_type = 0 AND %s IN (\'ALL\', region.name)', [region]
+    )]
+    frequencies = np.zeros(len(FASTA[0]) + 1, dtype=np.int64)
+    for fasta_1, fasta_2 in itertools.combinations(fasta, 2):
+        frequencies[sum(x != y for x, y in zip(fasta_1, fasta_2))] += 1
+    return np.trim_zeros(frequencies, 'b').tolist()
+
+
+def report(db, regions=('BG', 'RU', 'ALL')):
+    histograms = analytics.PairHistograms(db)
+    result = {x: histograms.update(x).tolist() for x in regions}
+    db.commit()
+    return result
+
+
+def test_incremental_matches_recomputation(pg_connect):
+    db = pg_connect()
+    regions = {x: db.get_region(x)['id'] for x in ('BG', 'RU')}
+    sequences = [db.insert_sequence(x)['id'] for x in FASTA]
+    for number, sequence_id in enumerate(sequences):
+        db.insert_person(regions['BG' if number % 2 else 'RU'], sequence_id, f'person/{number}')
+    db.commit()
+    assert report(db) == {x: recomputed(db, x) for x in ('BG', 'RU', 'ALL')}
+
+    # added, moved to another region, changed sequence and deleted people
+    db.insert_person(regions['BG'], sequences[0], 'person/added')
+    db.execute_query('UPDATE person SET region_id = %s WHERE url = %s', [regions['BG'], 'person/0'], fetch=False)
+    db.execute_query('UPDATE person SET sequence_id = %s WHERE url = %s', [sequences[4], 'person/1'], fetch=False)
+    db.execute_query('DELETE FROM person WHERE url = %s', ['person/3'], fetch=False)
+    db.commit()
+    assert report(db) == {x: recomputed(db, x) for x in ('BG', 'RU', 'ALL')}
+
+
+def test_unchanged_empty_histogram(pg_connect):
+    # regions without pairs (one person in BG, none in RU) save empty histograms, changes of another region leave
+    # them as they are
+    db = pg_connect()
+    regions = {x: db.get_region(x)['id'] for x in ('BG', 'RU')}
+    sequences = [db.insert_sequence(x)['id'] for x in FASTA]
+    db.insert_person(regions['BG'], sequences[0], 'person/0')
+    db.commit()
+    assert report(db) == {'BG': [], 'RU': [], 'ALL': []}
+    assert db.get_pair_histogram('BG')['frequencies'] == []
+
+    db.insert_person(regions['BG'], sequences[1], 'person/1')
+    db.commit()
+    assert report(db) == {x: recomputed(db, x) for x in ('BG', 'RU', 'ALL')}
+    assert db.get_pair_histogram('RU')['frequencies'] == []
+
+
+def test_late_commit_is_counted(pg_connect):
+    # a loader that takes its person_change version first and commits after a report is not skipped by the next
+    # one. The loaders write to different regions, the allele_count rows of one region serialize them
+    setup = pg_connect()
+    regions = {x: setup.get_region(x)['id'] for x in ('BG', 'RU')}
+    sequences = [setup.insert_sequence(x)['id'] for x in FASTA]
+    setup.insert_person(regions['BG'], sequences[0], 'person/0')
+    setup.commit()
+
+    loader_1, loader_2, reporter = pg_connect(), pg_connect(), pg_connect()
+    loader_1.insert_person(regions['RU'], sequences[1], 'person/1')
+    loader_2.insert_person(regions['BG'], sequences[2], 'person/2')
+    loader_2.insert_person(regions['BG'], sequences[3], 'person/3')
+    loader_2.commit()
+    assert report(reporter) == {x: recomputed(reporter, x) for x in ('BG', 'RU', 'ALL')}
+
+    loader_1.commit()
+    versions = dict(reporter.execute_query(
+        'SELECT person.url, person_change.version '
+        'FROM person_change INNER JOIN person ON person_change.person_id = person.id', None
+    ))
+    assert versions['person/1'] < versions['person/2']
+    assert report(reporter) == {x: recomputed(reporter, x) for x in ('BG', 'RU', 'ALL')}
+    assert reporter.get_pair_histogram('ALL')['frequencies'] == recomputed(reporter, 'ALL')
@@ -0,0 +1,78 @@
+import analytics
+import main
+
+FASTA = [
+    main.BASE_SEQUENCES['EVA'],
+    main.BASE_SEQUENCES['EVA'][:360] + 'ACGTACGTAC',
+    main.BASE_SEQUENCES['ANDREWS'][:300],
+    'N' + main.BASE_SEQUENCES['ANDREWS'][1:370] + 'Y',
+]
+
+
+def reference_diffs(db):
+    return db.execute_query(
+        'SELECT person_id, reference_id, diff_count FROM person_reference_diff ORDER BY 1, 2', None
+    )
+
+
+def recomputed_reference_diffs(db):
+    # every person with a crawled sequence against every reference, on the positions of the shorter sequence
+    people = db.execute_query(
+        'SELECT person.id, sequence.fasta FROM person INNER JOIN sequence ON person.sequence_id = sequence.id '
+        'WHERE sequence.sequence_type = 0', None
+    )
+    references = db.execute_query('SELECT id, fasta FROM sequence WHERE sequence_type != 0', None)
+    return sorted(
+        (person_id, reference_id, sum(x != y for x, y in zip(fasta, reference)))
+        for person_id, fasta in people
+        for reference_id, reference in references
+    )
+
+
+def test_person_reference_diff_follows_people_and_references(pg_connect):
+    db = pg_connect()
+    regions = [db.get_region(x)['id'] for x in ('BG', 'RU')]
+    # people loaded before the references are compared when the references are inserted
+    for number, fasta in enumerate(FASTA[:2]):
+        db.insert_person(regions[number % 2], db.insert_sequence(fasta)['id'], f'person/{number}')
+    main.insert_base_sequences(db)
+    db.insert_people([
+        (regions[number % 2], db.insert_sequence(fasta)['id'], f'person/{number}')
+        for number, fasta in enumerate(FASTA[2:], start=2)
+    ])
+    db.commit()
+    assert reference_diffs(db) == recomputed_reference_diffs(db)
+
+    # the wild types are references as well
+    for region in ['BG', 'RU', 'ALL']:
+        db.calculate_wild(region)
+    db.commit()
+    assert reference_diffs(db) == recomputed_reference_diffs(db)
+
+    matrix = analytics.SequenceMatrix(db)
+    for base_name in ['EVA', 'ANDREWS', 'WILD_TYPE_BG']:
+        for region in ['BG', 'RU', 'ALL']:
+            assert db.distribution_summary(base_name, region) == matrix.distribution_summary(base_name, region)
+
+    # the steps of test_triggers.py
+    regions = {x: db.get_region(x)['id'] for x in ('BG', 'RU')}
+    sequences = [db.get_sequence(x, 0)['id'] for x in FASTA]
+    db.insert_person(regions['BG'], sequences[3], 'person/added')
+    db.execute_query('UPDATE person SET region_id = %s WHERE url = %s', [regions['BG'], 'person/0'], fetch=False)
+    db.execute_query('UPDATE person SET sequence_id = %s WHERE url = %s', [sequences[2], 'person/1'], fetch=False)
+    db.execute_query('UPDATE region SET name = %s WHERE name = %s', ['RU_2', 'RU'], fetch=False)
+    db.execute_query('DELETE FROM person WHERE url = %s', ['person/3'], fetch=False)
+    db.commit()
+    assert reference_diffs(db) == recomputed_reference_diffs(db)
+
+    # references and crawled sequences that change their fasta or type
+    db.execute_query('UPDATE sequence SET fasta = %s WHERE name = %s', [FASTA[1], 'ANDREWS'], fetch=False)
+    db.execute_query('UPDATE sequence SET fasta = %s WHERE id = %s', [FASTA[0][:200], sequences[2]], fetch=False)
+    db.execute_query('UPDATE sequence SET sequence_type = 1 WHERE id = %s', [sequences[0]], fetch=False)
+    db.commit()
+    assert reference_diffs(db) == recomputed_reference_diffs(db)
+
+    matrix = analytics.SequenceMatrix(db)
+    for base_name in ['EVA', 'ANDREWS']:
+        for region in ['BG', 'RU_2', 'ALL']:
+            assert db.distribution_summary(base_name, region) == matrix.distribution_summary(base_name, region)
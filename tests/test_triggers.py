@@ -0,0 +1,100 @@
+import threading
+
+import numpy as np
+
+import analytics
+
+FASTA = ['ACGTACGTAC', 'ACGTACGTTT', 'TCGAACGTAC', 'ACGTACG', 'GGGTACGTAA', 'ACCTAYGTACNN']
+
+
+def allele_counts(db):
+    return db.execute_query('SELECT region_id, position, value, count FROM allele_count ORDER BY 1, 2, 3', None)
+
+
+def recomputed_allele_counts(db):
+    return db.execute_query(
+        'SELECT person.region_id, position, substr(sequence.fasta, position, 1), COUNT(*) '
+        'FROM (person INNER JOIN sequence ON person.sequence_id = sequence.id) '
+        'CROSS JOIN generate_series(1, length(sequence.fasta)) AS position '
+        'WHERE sequence.sequence_type = 0 AND person.region_id IS NOT NULL '
+        'GROUP BY 1, 2, 3 ORDER BY 1, 2, 3', None
+    )
+
+
+def logged_people(db):
+    # the latest person_change of every person that is not deleted: (person_id, region, fasta)
+    return db.execute_query(
+        'SELECT DISTINCT ON (person_id) person_id, region, fasta FROM person_change '
+        'ORDER BY person_id, version DESC', None
+    )
+
+
+def current_people(db):
+    return db.execute_query(
+        'SELECT person.id, region.name, sequence.fasta '
+        'FROM (person LEFT JOIN region ON person.region_id = region.id) '
+        'LEFT JOIN sequence ON person.sequence_id = sequence.id ORDER BY person.id', None
+    )
+
+
+def test_allele_count_and_person_change_follow_people(pg_connect):
+    db = pg_connect()
+    regions = {x: db.get_region(x)['id'] for x in ('BG', 'RU')}
+    sequences = [db.insert_sequence(x)['id'] for x in FASTA]
+    db.insert_people([
+        (regions['BG' if number % 2 else 'RU'], sequence_id, f'person/{number}')
+        for number, sequence_id in enumerate(sequences)
+    ])
+    db.commit()
+    assert allele_counts(db) == recomputed_allele_counts(db)
+    assert [x for x in logged_people(db) if x[1] is not None] == current_people(db)
+
+    db.insert_person(regions['BG'], sequences[5], 'person/added')
+    db.execute_query('UPDATE person SET region_id = %s WHERE url = %s', [regions['BG'], 'person/0'], fetch=False)
+    db.execute_query('UPDATE person SET sequence_id = %s WHERE url = %s', [sequences[4], 'person/1'], fetch=False)
+    db.execute_query('UPDATE region SET name = %s WHERE name = %s', ['RU_2', 'RU'], fetch=False)
+    db.execute_query('DELETE FROM person WHERE url IN (%s, %s)', ['person/2', 'person/3'], fetch=False)
+    db.commit()
+    assert allele_counts(db) == recomputed_allele_counts(db)
+    assert [x for x in logged_people(db) if x[1] is not None] == current_people(db)
+
+    # Database.polim() and allele_counts() read allele_count, SequenceMatrix counts the people
+    matrix = analytics.SequenceMatrix(db)
+    for region in ('BG', 'RU_2', 'ALL'):
+        assert [tuple(x) for x in db.polim('EVA', region)] == matrix.polim('EVA', region)
+        assert [tuple(x) for x in db.allele_counts(region)] == matrix.allele_counts(region)
+    assert db.allele_counts('RU') == matrix.allele_counts('RU') == []
+
+
+def test_concurrent_loaders(pg_connect):
+    # main.parallel_main() inserts the people of a chunk in one statement per transaction, the allele_count rows
+    # are upserted in the same order by all of them
+    setup = pg_connect()
+    regions = [setup.get_region(x)['id'] for x in ('BG', 'RU', 'IF')]
+    sequences = [setup.insert_sequence(x)['id'] for x in FASTA]
+    setup.commit()
+
+    errors = []
+
+    def load(loader, db):
+        rng = np.random.default_rng(loader)
+        try:
+            for chunk in range(20):
+                db.insert_people([
+                    (regions[rng.integers(len(regions))], sequences[rng.integers(len(sequences))],
+                     f'person/{loader}/{chunk}/{number}')
+                    for number in range(50)
+                ])
+                db.commit()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=load, args=(loader, pg_connect())) for loader in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert setup.execute_query('SELECT COUNT(*) FROM person', None)[0][0] == 4 * 20 * 50
+    assert allele_counts(setup) == recomputed_allele_counts(setup)
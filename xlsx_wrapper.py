@@ -187,7 +187,8 @@ class XlsxWrapper:
         return names, values
 
 
-def create_sheet(wrapper, db, region):
+def create_sheet(wrapper, db, region, by_region=None):
+    # by_region: base name -> db.distribution_by_region(), shared by the sheets to compute every region at once
     # First row of the document: distances
     print(region)
     print("__________________________________")
@@ -200,60 +201,39 @@ def create_sheet(wrapper, db, region):
     print(wild_type)
 
     for base_name in ['EVA', 'ANDREWS', f'WILD_TYPE_{region}']:
-        res = db.distribution(base_name, region)
+        if by_region is None or base_name not in ('EVA', 'ANDREWS'):
+            # the wild type of the sheet is only compared with its own region
+            summary = db.distribution_summary(base_name, region)
+        else:
+            if base_name not in by_region:
+                by_region[base_name] = db.distribution_by_region(base_name)
+            summary = by_region[base_name].get(region) or db.distribution_summary(base_name, region)
         line_1 = [0 for i in dist_range]
         line_2 = [0 for i in dist_range]
         for i in dist_range:
-            for j in res:
+            for j in summary['distribution']:
                 if j["diff_num"] == i:
                     line_1[i] = j["frequency"]
                     line_2[i] = j["p"]
 
-        math_expectation = db.math_expectation(base_name, region)[0]['math_expectation']
-        std = db.std(base_name, region)[0]['standart_dev']
-        mode = db.mode(base_name, region)[0]['diff_num']
-        min_value = db.min_value(base_name, region)[0]['min']
-        max_value = db.max_value(base_name, region)[0]['max']
-        coeff = db.coeff(base_name, region)[0]['koef']
         wrapper.insert_distribution(
-            region, {f'Розподіл відносно {base_name}': line_1, f'Розподіл відносно {base_name} (частка)': line_2, 'values': {
-                'mean': math_expectation,
-                'std': std,
-                'mode': mode,
-                'min': min_value,
-                'max': max_value,
-                'coeff': coeff}}
+            region, {f'Розподіл відносно {base_name}': line_1, f'Розподіл відносно {base_name} (частка)': line_2,
+                     'values': summary['values']}
         )
 
-    res = db.distribution_each_to_each(region)
+    summary = db.distribution_summary_each_to_each(region)
     line_1 = [0 for i in dist_range]
     line_2 = [0 for i in dist_range]
     for i in dist_range:
-        for j in res:
+        for j in summary['distribution']:
             if j["diff_num"] == i:
                 line_1[i] = j["frequency"]
                 line_2[i] = j["p"]
 
-    math_expectation = db.math_expectation_each_to_each(region)[0]['math_expectation']
-    print(math_expectation)
-    std = db.std_each_to_each(region)[0]['standart_dev']
-    print(std)
-    mode = db.mode_each_to_each(region)[0]['diff_num']
-    print(mode)
-    min_value = db.min_value_each_to_each(region)[0]['min']
-    print(min_value)
-    max_value = db.max_value_each_to_each(region)[0]['max']
-    print(max_value)
-    coeff = db.coeff_each_to_each(region)[0]['koef']
-    print(coeff)
+    print(summary['values'])
     wrapper.insert_distribution(
-        region, {'Розподіл кожен з кожним': line_1, 'Розподіл кожен з кожним (частка)': line_2, 'values': {
-            'mean': math_expectation,
-                'std': std,
-                'mode': mode,
-                'min': min_value,
-                'max': max_value,
-                'coeff': coeff}}
+        region, {'Розподіл кожен з кожним': line_1, 'Розподіл кожен з кожним (частка)': line_2,
+                 'values': summary['values']}
     )
     # The last rows of the sheet with wild type and population statistics
     polim_ANDREWS_WILD = db.diff_between_base_and_wild('ANDREWS', f'WILD_TYPE_{region}')
@@ -286,7 +266,8 @@ if __name__ == '__main__':
     db = database.Database(conn)
     wrapper = XlsxWrapper('final5.xlsx')
     regions = ['ALL', 'IF', 'BK', 'BG', 'ST', 'CH', 'KHM']
+    by_region = {}
     for region in regions:
-        create_sheet(wrapper, db, region)
+        create_sheet(wrapper, db, region, by_region)
 
     wrapper.save()